@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+'''GridFS read/write latency per chunk size strategy and object size.
+
+Usage::
+
+    make mongodb
+    PYTHONPATH=. python benchmarks/chunk_size.py [mongodb_uri] [rounds]
+'''
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+
+from thumbor_mongodb.utils import get_chunk_size
+
+SIZES = [8 * 1024, 64 * 1024, 512 * 1024, 4 * 1024 * 1024, 12 * 1024 * 1024]
+STRATEGIES = {
+    'default': {},
+    'auto': {'chunk_size': 'auto'},
+    'classes': {'size_classes': [
+        (64 * 1024, 64 * 1024),
+        (1024 * 1024, 256 * 1024),
+        (None, 1024 * 1024),
+    ]},
+}
+
+
+async def measure(bucket, data, chunk_size, rounds):
+    writes, reads = [], []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        file_id = await bucket.upload_from_stream(
+            'benchmark', data, chunk_size_bytes=chunk_size
+        )
+        writes.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        grid_out = await bucket.open_download_stream(file_id)
+        await grid_out.read()
+        reads.append(time.perf_counter() - start)
+
+        await bucket.delete(file_id)
+    return statistics.median(writes), statistics.median(reads)
+
+
+async def main(uri, rounds):
+    client = AsyncIOMotorClient(uri)
+    bucket = AsyncIOMotorGridFSBucket(client['thumbor_benchmark'])
+
+    print(f"{'size':>10} {'strategy':>10} {'chunk':>10} "
+          f"{'chunks':>7} {'write ms':>9} {'read ms':>9}")
+    for size in SIZES:
+        data = os.urandom(size)
+        for name, options in STRATEGIES.items():
+            chunk_size = get_chunk_size(size, **options) or 261120
+            write, read = await measure(bucket, data, chunk_size, rounds)
+            print(f"{size:>10} {name:>10} {chunk_size:>10} "
+                  f"{-(-size // chunk_size):>7} "
+                  f"{write * 1000:>9.2f} {read * 1000:>9.2f}")
+
+    await client.drop_database('thumbor_benchmark')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(
+        sys.argv[1] if len(sys.argv) > 1 else 'mongodb://localhost:27017',
+        int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+    ))
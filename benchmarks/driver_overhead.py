@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+'''Per operation latency of the storage get hot path for each Motor driver.
+
+Runs the same index lookup and GridFS download the storage does on ``get``,
+through the Tornado and the asyncio Motor classes, on the same event loop.
+
+Usage::
+
+    make mongodb
+    PYTHONPATH=. python benchmarks/driver_overhead.py [mongodb_uri] [rounds]
+'''
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+from thumbor_mongodb.mongodb.driver import DRIVERS, get_driver
+
+SIZE = 16 * 1024
+
+
+async def measure(client_class, bucket_class, uri, rounds):
+    client = client_class(uri)
+    database = client['thumbor_benchmark']
+    bucket = bucket_class(database)
+    file_id = await bucket.upload_from_stream('benchmark', os.urandom(SIZE))
+    await database.images.insert_one({'path': 'benchmark', 'file_id': file_id})
+
+    finds, gets = [], []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        stored = await database.images.find_one(
+            {'path': 'benchmark'}, {'file_id': True}
+        )
+        finds.append(time.perf_counter() - start)
+
+        grid_out = await bucket.open_download_stream(stored['file_id'])
+        await grid_out.read()
+        gets.append(time.perf_counter() - start)
+
+    await client.drop_database('thumbor_benchmark')
+    client.close()
+    return statistics.median(finds), statistics.median(gets)
+
+
+async def main(uri, rounds):
+    print(f"{'driver':>8} {'find_one us':>12} {'get us':>9}")
+    results = {}
+    for name in DRIVERS:
+        client_class, bucket_class = get_driver(name)
+        results[name] = await measure(client_class, bucket_class, uri, rounds)
+        find, get = results[name]
+        print(f"{name:>8} {find * 1e6:>12.1f} {get * 1e6:>9.1f}")
+
+    saved = results['tornado'][1] - results['asyncio'][1]
+    print(f"asyncio saves {saved * 1e6:.1f} us per get "
+          f"({saved / results['tornado'][1]:.1%})")
+
+
+if __name__ == '__main__':
+    asyncio.run(main(
+        sys.argv[1] if len(sys.argv) > 1 else 'mongodb://localhost:27017',
+        int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+    ))
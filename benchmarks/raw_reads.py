@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+'''CPU time per get of GridOut reads and raw chunk batch reads.
+
+Reads the same files through ``GridOut``, which looks ``fs.files`` up and
+decodes every chunk document, and through ``ChunkReader``, which assembles
+the payloads of raw chunk batches given the length from the index document.
+
+Usage::
+
+    make mongodb
+    PYTHONPATH=. python benchmarks/raw_reads.py [mongodb_uri] [rounds]
+'''
+
+import asyncio
+import os
+import sys
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+
+from thumbor_mongodb.mongodb.chunks import ChunkReader
+
+SIZES = [16 * 1024, 256 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+CHUNK_SIZE = 255 * 1024
+
+
+async def measure(read, rounds):
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(rounds):
+        await read()
+    return (
+        (time.perf_counter() - wall) / rounds,
+        (time.process_time() - cpu) / rounds,
+    )
+
+
+async def main(uri, rounds):
+    client = AsyncIOMotorClient(uri)
+    database = client['thumbor_benchmark']
+    bucket = AsyncIOMotorGridFSBucket(database)
+    reader = ChunkReader(database, bucket)
+
+    async def grid_out_read(file_id):
+        grid_out = await bucket.open_download_stream(file_id)
+        return await grid_out.read()
+
+    print(f"{'size':>10} {'reader':>8} {'wall us':>9} {'cpu us':>9}")
+    for size in SIZES:
+        data = os.urandom(size)
+        file_id = await bucket.upload_from_stream(
+            'benchmark', data, chunk_size_bytes=CHUNK_SIZE
+        )
+        assert await reader.read(file_id, size) == data
+
+        readers = {
+            'gridout': lambda: grid_out_read(file_id),
+            'raw': lambda: reader.read(file_id, size),
+        }
+        for name, read in readers.items():
+            wall, cpu = await measure(read, rounds)
+            print(f"{size:>10} {name:>8} "
+                  f"{wall * 1000000:>9.0f} {cpu * 1000000:>9.0f}")
+        await bucket.delete(file_id)
+
+    await client.drop_database('thumbor_benchmark')
+    client.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(
+        sys.argv[1] if len(sys.argv) > 1 else 'mongodb://localhost:27017',
+        int(sys.argv[2]) if len(sys.argv) > 2 else 200,
+    ))
@@ -24,6 +24,7 @@ setup(
     packages=find_packages(include=[
         'thumbor_mongodb',
         'thumbor_mongodb.mongodb',
+        'thumbor_mongodb.handler_lists',
         'thumbor_mongodb.storages',
         'thumbor_mongodb.result_storages'
     ]),
@@ -43,6 +44,12 @@ setup(
         "Topic :: Internet :: WWW/HTTP :: Dynamic Content",
         "Topic :: Multimedia :: Graphics :: Presentation",
     ],
+    entry_points={
+        'console_scripts': [
+            'thumbor-mongodb-explain=thumbor_mongodb.explain:main',
+            'thumbor-mongodb-transfer=thumbor_mongodb.transfer:main',
+        ],
+    },
     install_requires=[
         'thumbor>=7.0.0,<8.0.0',
         'motor>=2.1.0,<3.0.0'
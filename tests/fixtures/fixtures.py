@@ -10,3 +10,11 @@ from os.path import join, abspath, dirname
 IMAGE_PATH = join(abspath(dirname(__file__)), 'image.png')
 with open(IMAGE_PATH, 'rb') as img:
     IMAGE_BYTES = img.read()
+
+# The svg element starts past the first 512 bytes, as with editor exports.
+SVG_BYTES = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<!-- ' + b'Generated by an editor. ' * 24 + b'-->\n'
+    b'<svg xmlns="http://www.w3.org/2000/svg" width="10" height="10">'
+    b'<rect width="10" height="10"/></svg>\n'
+)
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+from unittest import TestCase
+
+import mock
+from preggy import expect
+
+from thumbor_mongodb.handler_lists.warmup import get_handlers, warm_up
+from thumbor_mongodb.mongodb.cache import LocalCache
+
+
+class LocalCacheTestCase(TestCase):
+    def test_can_get_stored_value(self):
+        cache = LocalCache(10)
+        expect(cache.set("a", b"12345", 5)).to_equal(True)
+        expect(cache.get("a")).to_equal(b"12345")
+        expect(cache.get("b")).to_be_null()
+
+    def test_evicts_least_recently_used(self):
+        cache = LocalCache(10)
+        cache.set("a", b"12345", 5)
+        cache.set("b", b"12345", 5)
+        cache.get("a")
+        cache.set("c", b"12345", 5)
+
+        expect(cache.get("a")).not_to_be_null()
+        expect(cache.get("b")).to_be_null()
+        expect(cache.size).to_equal(10)
+
+    def test_does_not_store_values_bigger_than_cache(self):
+        cache = LocalCache(4)
+        expect(cache.set("a", b"12345", 5)).to_equal(False)
+        expect(cache.size).to_equal(0)
+
+    def test_can_delete_value(self):
+        cache = LocalCache(10)
+        cache.set("a", b"12345", 5)
+        cache.delete("a")
+        cache.delete("b")
+        expect(cache.get("a")).to_be_null()
+        expect(cache.size).to_equal(0)
+
+
+class WarmUpHandlerListTestCase(TestCase):
+    def test_schedules_the_warm_up_without_routes(self):
+        context = mock.Mock()
+        with mock.patch(
+            'thumbor_mongodb.handler_lists.warmup.IOLoop'
+        ) as ioloop:
+            expect(get_handlers(context)).to_equal([])
+
+        ioloop.current.return_value.add_callback.assert_called_once_with(
+            warm_up, context
+        )
+
+    def test_warms_up_the_mongodb_storages_only(self):
+        storage = mock.Mock(warm_up=mock.AsyncMock(return_value=2))
+        result_storage = mock.Mock(warm_up=mock.AsyncMock(return_value=3))
+        context = mock.Mock()
+        context.modules.storage = storage
+        context.modules.result_storage = result_storage
+        expect(asyncio.run(warm_up(context))).to_equal(5)
+
+        context.modules.result_storage = object()
+        expect(asyncio.run(warm_up(context))).to_equal(2)
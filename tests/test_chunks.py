@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+from unittest import TestCase
+
+import bson
+import mock
+from gridfs.errors import CorruptGridFile, NoFile
+from preggy import expect
+
+from tests.fixtures.fixtures import IMAGE_BYTES
+from thumbor_mongodb.mongodb.chunks import (
+    ChunkAssembler, ChunkReader, chunk_payloads
+)
+
+
+def raw_batch(*docs):
+    return b''.join(bson.encode(doc) for doc in docs)
+
+
+class FakeChunks:
+    def __init__(self, *batches):
+        self.batches = batches
+
+    def find_raw_batches(self, query, projection, sort):
+        async def batches():
+            for batch in self.batches:
+                yield batch
+        return batches()
+
+
+class ChunkPayloadsTestCase(TestCase):
+    def test_yields_payloads_without_decoding(self):
+        payloads = list(chunk_payloads(raw_batch(
+            {'data': b'abc'}, {'data': b''}, {'data': b'defg'}
+        )))
+        expect(all(isinstance(p, memoryview) for p in payloads)).to_be_true()
+        expect([bytes(p) for p in payloads]).to_equal([b'abc', b'', b'defg'])
+
+    def test_finds_data_in_other_layouts(self):
+        payloads = chunk_payloads(raw_batch({'n': 0, 'data': b'abc'}))
+        expect([bytes(p) for p in payloads]).to_equal([b'abc'])
+
+
+class ChunkAssemblerTestCase(TestCase):
+    def test_assembles_chunks(self):
+        assembler = ChunkAssembler('id', 6)
+        assembler.add(memoryview(b'abc'))
+        assembler.add(memoryview(b'def'))
+        expect(assembler.contents()).to_equal(b'abcdef')
+
+    def test_rejects_chunks_past_the_length(self):
+        assembler = ChunkAssembler('id', 2)
+        with expect.error_to_happen(CorruptGridFile):
+            assembler.add(b'abc')
+
+    def test_reports_missing_chunks_as_missing_files(self):
+        assembler = ChunkAssembler('id', 6)
+        assembler.add(b'abc')
+        with expect.error_to_happen(NoFile):
+            assembler.contents()
+
+
+class ChunkReaderTestCase(TestCase):
+    def get_reader(self, *batches):
+        reader = ChunkReader(mock.MagicMock(), mock.Mock())
+        reader.chunks = FakeChunks(*batches)
+        return reader
+
+    def test_reads_files_of_known_length(self):
+        half = len(IMAGE_BYTES) // 2
+        reader = self.get_reader(
+            raw_batch({'data': IMAGE_BYTES[:half]}),
+            raw_batch({'data': IMAGE_BYTES[half:]}),
+        )
+        expect(asyncio.run(
+            reader.read('id', len(IMAGE_BYTES))
+        )).to_equal(IMAGE_BYTES)
+
+    def test_missing_files_raise(self):
+        reader = self.get_reader()
+        with expect.error_to_happen(NoFile):
+            asyncio.run(reader.read('id', len(IMAGE_BYTES)))
+
+    def test_reads_files_of_unknown_length_with_the_bucket(self):
+        reader = self.get_reader()
+        grid_out = mock.Mock(read=mock.AsyncMock(return_value=b'abc'))
+        reader.bucket.open_download_stream = mock.AsyncMock(
+            return_value=grid_out
+        )
+        expect(asyncio.run(reader.read('id'))).to_equal(b'abc')
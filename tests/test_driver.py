@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import sys
+from unittest import TestCase, skipIf
+
+import mock
+from motor import motor_tornado
+from preggy import expect
+
+from thumbor_mongodb.mongodb.driver import get_driver
+
+
+class GetDriverTestCase(TestCase):
+    def test_defaults_to_tornado(self):
+        expect(get_driver()).to_equal(
+            (motor_tornado.MotorClient, motor_tornado.MotorGridFSBucket)
+        )
+
+    @skipIf(
+        sys.version_info >= (3, 11),
+        "Motor 2 asyncio support needs asyncio.coroutine, gone in 3.11"
+    )
+    def test_can_select_asyncio(self):
+        client_class, bucket_class = get_driver('asyncio')
+        expect(client_class.__name__).to_equal('AsyncIOMotorClient')
+        expect(bucket_class.__name__).to_equal('AsyncIOMotorGridFSBucket')
+
+    @skipIf(
+        sys.version_info < (3, 11), "Motor 2 asyncio support loads before 3.11"
+    )
+    def test_explains_why_asyncio_cannot_load(self):
+        with self.assertRaises(ValueError) as raised:
+            get_driver('asyncio')
+        expect(str(raised.exception)).to_include('Python 3.10 or older')
+
+    def test_reports_drivers_failing_to_import(self):
+        with mock.patch(
+            'thumbor_mongodb.mongodb.driver.import_module',
+            side_effect=ImportError("cannot import name 'coroutine'")
+        ):
+            with self.assertRaises(ValueError) as raised:
+                get_driver('asyncio')
+        expect(str(raised.exception)).to_include("'coroutine'")
+        expect(str(raised.exception)).to_include('Motor')
+
+    def test_rejects_unknown_driver(self):
+        with self.assertRaises(ValueError):
+            get_driver('twisted')
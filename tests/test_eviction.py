@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+from unittest import TestCase
+
+import mock
+from preggy import expect
+
+from thumbor_mongodb.mongodb.eviction import LRUEvictor, stored_length
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, *args):
+        return self
+
+    def limit(self, count):
+        return FakeCursor(self.docs[:count])
+
+    async def to_list(self, length=None):
+        return list(self.docs)
+
+
+class FakeCollection:
+    '''Index documents of one storage, sharing the database's GridFS.'''
+
+    name = 'images'
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def aggregate(self, pipeline):
+        return FakeCursor([{
+            'size': sum(doc.get('content_length', 0) for doc in self.docs),
+        }])
+
+    def find(self, query, projection=None):
+        return FakeCursor(self.docs)
+
+    async def delete_many(self, query):
+        ids = set(query['_id']['$in'])
+        self.docs = [doc for doc in self.docs if doc['_id'] not in ids]
+
+
+def evictor(collection, max_bytes, batch_size=10):
+    database = mock.MagicMock()
+    database.__getitem__.return_value.delete_many = mock.AsyncMock()
+    return LRUEvictor(database, collection, max_bytes, 60, batch_size)
+
+
+class StoredLengthTestCase(TestCase):
+    def test_counts_single_and_variant_documents(self):
+        expect(stored_length({'content_length': 10})).to_equal(10)
+        expect(stored_length({'variants': {
+            'webp': {'content_length': 10}, 'original': {'content_length': 5},
+        }})).to_equal(15)
+        expect(stored_length({})).to_equal(0)
+
+
+class LRUEvictorTestCase(TestCase):
+    def test_evicts_no_more_than_the_excess(self):
+        collection = FakeCollection([
+            {'_id': i, 'file_id': i, 'content_length': 100} for i in range(10)
+        ])
+        removed = asyncio.run(evictor(collection, 750, batch_size=2).evict())
+
+        expect(removed).to_equal(3)
+        expect([doc['_id'] for doc in collection.docs]).to_equal(
+            [3, 4, 5, 6, 7, 8, 9]
+        )
+
+    def test_ignores_the_bytes_of_other_storages(self):
+        # The shared fs.chunks may hold far more than this budget.
+        collection = FakeCollection([
+            {'_id': i, 'file_id': i, 'content_length': 100} for i in range(3)
+        ])
+        expect(asyncio.run(evictor(collection, 300).evict())).to_equal(0)
+        expect(collection.docs).to_length(3)
+
+    def test_stops_on_entries_of_unknown_length(self):
+        collection = FakeCollection([{'_id': 1, 'file_id': 1}])
+        collection.aggregate = lambda pipeline: FakeCursor([{'size': 10}])
+        expect(asyncio.run(evictor(collection, 0).evict())).to_equal(1)
+
+    def test_only_the_lease_holder_evicts(self):
+        lru = evictor(FakeCollection([]), 1)
+        lru.leases = mock.Mock(
+            ensure_index=mock.AsyncMock(),
+            acquire=mock.AsyncMock(return_value=False),
+        )
+        lru.collection.create_index = mock.AsyncMock()
+        lru.evict = mock.AsyncMock()
+
+        async def run_once():
+            with mock.patch(
+                'thumbor_mongodb.mongodb.eviction.asyncio.sleep',
+                side_effect=[None, asyncio.CancelledError]
+            ):
+                with self.assertRaises(asyncio.CancelledError):
+                    await lru.run()
+
+        asyncio.run(run_once())
+        lru.leases.acquire.assert_awaited_once()
+        expect(lru.evict.called).to_be_false()
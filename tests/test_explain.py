@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+from unittest import TestCase
+
+from preggy import expect
+
+from thumbor_mongodb.explain import check_plan
+
+
+def explain(plan):
+    return {'queryPlanner': {'winningPlan': plan}}
+
+
+COVERED = {
+    'stage': 'LIMIT',
+    'inputStage': {
+        'stage': 'PROJECTION_COVERED',
+        'inputStage': {'stage': 'IXSCAN'},
+    },
+}
+FETCHED = {
+    'stage': 'LIMIT',
+    'inputStage': {
+        'stage': 'FETCH',
+        'inputStage': {'stage': 'IXSCAN'},
+    },
+}
+
+
+class CheckPlanTestCase(TestCase):
+    def test_accepts_covered_plan(self):
+        expect(check_plan(explain(COVERED), True)).to_equal([])
+
+    def test_rejects_fetch_when_covered(self):
+        expect(check_plan(explain(FETCHED), True)).to_equal(['FETCH'])
+        expect(check_plan(explain(FETCHED), False)).to_equal([])
+
+    def test_rejects_collection_scan(self):
+        plan = explain({'stage': 'LIMIT', 'inputStage': {
+            'stage': 'COLLSCAN'
+        }})
+        expect(check_plan(plan, False)).to_equal(['COLLSCAN'])
+
+    def test_checks_every_shard(self):
+        plan = explain({'stage': 'SINGLE_SHARD', 'shards': [
+            {'shardName': 'a', 'winningPlan': COVERED},
+            {'shardName': 'b', 'winningPlan': FETCHED},
+        ]})
+        expect(check_plan(plan, True)).to_equal(['FETCH'])
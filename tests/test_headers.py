@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+from unittest import TestCase
+
+from preggy import expect
+from tornado.httputil import HTTPHeaders
+
+from thumbor_mongodb.mongodb.headers import (
+    HeaderFilter, decode_headers, encode_headers
+)
+
+
+class HeaderFilterTestCase(TestCase):
+    def test_keeps_allowlisted_headers_in_order(self):
+        headers = HTTPHeaders()
+        headers.add('Server', 'Thumbor/7.0.0')
+        headers.add('vary', 'Accept')
+        headers.add('Vary', 'Accept')
+        headers.add('Vary', 'Origin')
+        headers.add('Cache-Control', 'max-age=60,public')
+
+        header_filter = HeaderFilter(['cache-control', 'VARY', 'Vary'], 1024)
+        expect(header_filter.filter(headers)).to_equal({
+            'Cache-Control': 'max-age=60,public',
+            'Vary': 'Accept, Origin',
+        })
+
+    def test_caps_stored_size(self):
+        header_filter = HeaderFilter(['Cache-Control', 'Vary'], 30)
+        expect(header_filter.filter({
+            'Cache-Control': 'max-age=60',
+            'Vary': 'Accept',
+        })).to_equal({'Cache-Control': 'max-age=60'})
+
+
+class HeaderEncodingTestCase(TestCase):
+    def test_encodes_known_names(self):
+        headers = {'Cache-Control': 'max-age=60', 'X-Custom': 'a'}
+        encoded = encode_headers(headers)
+        expect(encoded).to_equal({'0': 'max-age=60', 'X-Custom': 'a'})
+        expect(decode_headers(encoded)).to_equal(headers)
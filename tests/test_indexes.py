@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+from unittest import TestCase
+
+from preggy import expect
+
+from thumbor_mongodb.mongodb.indexes import (
+    INDEX_SET_VERSION, IndexManager, covering_indexes
+)
+from thumbor_mongodb.mongodb.schema import Schema
+
+
+class CoveringIndexesTestCase(TestCase):
+    def test_covers_fields_and_id(self):
+        indexes = covering_indexes(
+            [Schema(1)], ['path', 'created_at', 'file_id']
+        )
+        expect(indexes).to_equal({
+            'path_1_created_at_-1_file_id_1__id_1': [
+                ('path', 1), ('created_at', -1), ('file_id', 1), ('_id', 1)
+            ],
+        })
+
+    def test_creates_one_index_per_schema_and_shard_key(self):
+        indexes = covering_indexes(
+            [Schema(2), Schema(1)], ['key_hash', 'key', 'created_at'],
+            shard_key='key_hash'
+        )
+        expect(sorted(indexes)).to_equal([
+            'key_hash_1_key_1_created_at_-1__id_1',
+            'key_hash_hashed',
+            'kh_1_k_1_c_-1__id_1',
+            'kh_hashed',
+        ])
+
+
+class IndexManagerTestCase(TestCase):
+    def test_only_drops_owned_indexes(self):
+        manager = IndexManager(None, None, 'images.path', {
+            'path_1_created_at_-1_file_id_1__id_1': [],
+        }, {'path', 'p'})
+        existing = {
+            '_id_': {'key': [('_id', 1)]},
+            'path_1_created_at_-1': {'key': [('path', 1)]},
+            'p_1_c_-1': {'key': [('p', 1)]},
+            'path_1_created_at_-1_file_id_1__id_1': {'key': [('path', 1)]},
+            'key_1_created_at_-1': {'key': [('key', 1)]},
+            'accessed_at_1': {'key': [('accessed_at', 1)]},
+        }
+        expect(manager.obsolete(existing)).to_equal([
+            'path_1_created_at_-1', 'p_1_c_-1',
+        ])
+
+    def test_only_drops_when_moving_up_a_version(self):
+        manager = IndexManager(None, None, 'images.path', {'a_1': []}, {'a'})
+        older = {'version': INDEX_SET_VERSION - 1, 'indexes': ['b_1']}
+        other = {'version': INDEX_SET_VERSION, 'indexes': ['b_1']}
+        newer = {'version': INDEX_SET_VERSION + 1, 'indexes': ['b_1']}
+
+        expect(manager.actions(None)).to_equal((True, True))
+        expect(manager.actions(older)).to_equal((True, True))
+        expect(manager.actions(manager.record)).to_equal((False, False))
+        expect(manager.actions(other)).to_equal((True, False))
+        expect(manager.actions(newer)).to_equal((False, False))
+        expect(manager.actions(newer, force=True)).to_equal((True, True))
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+from unittest import TestCase
+
+from preggy import expect
+
+from thumbor_mongodb.mongodb.lease import LocalNames, backoff
+
+
+class BackoffTestCase(TestCase):
+    def test_doubles_delays_up_to_the_maximum(self):
+        expect(list(backoff(2, 0.25, 0.5))).to_equal(
+            [0.25, 0.5, 0.5, 0.5, 0.25]
+        )
+
+    def test_waits_no_longer_than_asked(self):
+        expect(list(backoff(0.5, 0.25, 1))).to_equal([0.25, 0.25])
+        expect(list(backoff(0))).to_equal([])
+
+
+class LocalNamesTestCase(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.names = LocalNames(size=2, clock=lambda: self.now)
+
+    def test_forgets_names_once_expired(self):
+        self.names.add('a', 10)
+        expect('a' in self.names).to_be_true()
+        self.now = 10
+        expect('a' in self.names).to_be_false()
+        expect(len(self.names)).to_equal(0)
+
+    def test_forgets_the_oldest_names_first(self):
+        self.names.add('a', 10)
+        self.names.add('b', 10)
+        self.names.add('a', 10)
+        self.names.add('c', 10)
+        expect('a' in self.names).to_be_true()
+        expect('b' in self.names).to_be_false()
+        expect('c' in self.names).to_be_true()
+
+    def test_discards_names(self):
+        self.names.add('a', 10)
+        self.names.discard('a')
+        self.names.discard('b')
+        expect('a' in self.names).to_be_false()
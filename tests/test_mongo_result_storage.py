@@ -8,11 +8,17 @@
 # http://www.opensource.org/licenses/mit-license
 # Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
 
+import asyncio
+import io
+import sys
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import partial
+from unittest import TestCase, skipIf
 
 import mock
 from preggy import expect
+from pymongo.errors import DuplicateKeyError
 from tornado.ioloop import IOLoop
 from tornado.testing import AsyncHTTPTestCase, gen_test
 
@@ -22,7 +28,16 @@ from thumbor.config import Config
 from thumbor.context import RequestParameters, Context
 from thumbor.importer import Importer
 from thumbor.result_storages import ResultStorageResult
-from thumbor_mongodb.result_storages.mongo_result_storage import Storage
+from thumbor_mongodb.explain import explain_storage
+from thumbor_mongodb.mongodb.cache import CacheWarmer, LocalCache
+from thumbor_mongodb.mongodb.connector_result_storage import MongoConnector
+from thumbor_mongodb.mongodb.driver import get_driver
+from thumbor_mongodb.mongodb.eviction import AccessTracker, LRUEvictor
+from thumbor_mongodb.mongodb.schema import Schema
+from thumbor_mongodb.result_storages.mongo_result_storage import (
+    COVERED_LOOKUPS, REFRESHING, TIMED_OUT_RENDERS, Storage
+)
+from thumbor_mongodb.utils import key_hash
 
 
 class BaseMongoResultStorageTestCase(AsyncHTTPTestCase):
@@ -209,3 +224,685 @@ class BaseMongoResultStorageTestCase(AsyncHTTPTestCase):
         expect(insert).to_equal("image_2.jpg")
         expect(insert).Not.to_be_an_error()
 
+    @gen_test
+    async def test_can_track_last_access(self):
+        config = self.get_config()
+        config.RESULT_STORAGE_EXPIRATION_SECONDS = 5
+        ctx = mock.Mock(
+            config=config,
+            request=mock.Mock(
+                url="image_access.jpg"
+            )
+        )
+        storage = Storage(ctx)
+        await storage.put(IMAGE_BYTES)
+        stored = await storage.storage.find_one({
+            'key': storage.get_key_from_request()
+        })
+
+        tracker = AccessTracker(storage.storage, 1, 10)
+        tracker.record(stored['_id'])
+        updated = await tracker.flush()
+        expect(updated).to_equal(1)
+
+        stored = await storage.storage.find_one({'_id': stored['_id']})
+        expect(stored['accessed_at']).not_to_be_null()
+
+    @gen_test
+    async def test_can_evict_least_recently_used(self):
+        config = self.get_config()
+        config.RESULT_STORAGE_EXPIRATION_SECONDS = 5
+        ctx = mock.Mock(
+            config=config,
+            request=mock.Mock(
+                url="image_evict.jpg"
+            )
+        )
+        storage = Storage(ctx)
+        await storage.put(IMAGE_BYTES)
+
+        evictor = LRUEvictor(storage.database, storage.storage, 1, 60, 100)
+        removed = await evictor.evict()
+        expect(removed).to_be_greater_than(0)
+
+        result = await storage.get()
+        expect(result).to_be_null()
+
+    @gen_test
+    async def test_can_warm_up_popular_results(self):
+        config = self.get_config()
+        config.RESULT_STORAGE_EXPIRATION_SECONDS = 5
+        ctx = mock.Mock(
+            config=config,
+            request=mock.Mock(
+                url="image_popular.jpg"
+            )
+        )
+        storage = Storage(ctx)
+        await storage.put(IMAGE_BYTES)
+        key = storage.get_key_from_request()
+        await storage.storage.update_many(
+            {'key': key}, {'$set': {'hits': 1000000}}
+        )
+
+        cache = LocalCache(len(IMAGE_BYTES) * 10)
+        warmer = CacheWarmer(
+            storage.database, storage.storage, cache, 'key',
+            Storage.cache_value
+        )
+        loaded = await warmer.warm_up(1, len(IMAGE_BYTES), 10)
+        expect(loaded).to_equal(1)
+        expect(cache.get(key)[2]).to_equal(IMAGE_BYTES)
+        expect(cache.get(key)[3]["ContentLength"]).to_equal(len(IMAGE_BYTES))
+
+    @gen_test
+    async def test_can_get_image_with_hashed_key(self):
+        config = self.get_config()
+        config.RESULT_STORAGE_EXPIRATION_SECONDS = 5
+        config.MONGO_RESULT_STORAGE_HASHED_KEY = True
+        ctx = mock.Mock(
+            config=config,
+            request=mock.Mock(
+                url="image_hashed.jpg"
+            )
+        )
+        storage = Storage(ctx)
+        await storage.put(IMAGE_BYTES)
+
+        key = storage.get_key_from_request()
+        doc = await storage.storage.find_one({'key': key})
+        expect(doc['key_hash']).to_equal(key_hash(key))
+
+        result = await storage.get()
+        expect(result.successful).to_equal(True)
+        expect(len(result)).to_equal(7339)
+
+    @gen_test
+    async def test_can_get_image_in_compact_schema(self):
+        config = self.get_config()
+        config.RESULT_STORAGE_EXPIRATION_SECONDS = 5
+        config.MONGO_RESULT_STORAGE_SCHEMA_VERSION = 2
+        config.MONGO_STORE_METADATA = True
+        ctx = mock.Mock(
+            config=config,
+            request=mock.Mock(
+                url="image_compact.jpg"
+            ),
+            headers={'Cache-Control': 'max-age=60'}
+        )
+        storage = Storage(ctx)
+        await storage.put(IMAGE_BYTES)
+
+        doc = await storage.storage.find_one({
+            'k': storage.get_key_from_request()
+        })
+        expect(doc['v']).to_equal(2)
+        expect(doc['t']).to_equal(1)
+
+        result = await storage.get()
+        expect(result.successful).to_equal(True)
+        expect(len(result)).to_equal(7339)
+        expect(result.metadata['ContentType']).to_equal('image/png')
+        expect(result.metadata['Cache-Control']).to_equal('max-age=60')
+
+    @gen_test
+    async def test_can_get_image_without_expiration(self):
+        config = self.get_config()
+        config.RESULT_STORAGE_EXPIRATION_SECONDS = 0
+        ctx = mock.Mock(
+            config=config,
+            request=mock.Mock(
+                url="image_no_expiration.jpg"
+            )
+        )
+        storage = Storage(ctx)
+        await storage.put(IMAGE_BYTES)
+
+        result = await storage.get()
+        expect(result.successful).to_equal(True)
+
+    @gen_test
+    async def test_lookups_are_covered_by_indexes(self):
+        await self.storage.connector.ensure_index(force=True)
+        out = io.StringIO()
+        failures = await explain_storage(
+            self.storage, "result:image.jpg", COVERED_LOOKUPS, out
+        )
+        expect(failures).to_equal(0)
+
+    @gen_test
+    async def test_large_metadata_stays_out_of_covered_lookups(self):
+        config = self.get_config()
+        config.RESULT_STORAGE_EXPIRATION_SECONDS = 5
+        config.MONGO_STORE_METADATA = True
+        config.MONGO_STORE_METADATA_HEADERS = ['Cache-Control']
+        cache_control = 'max-age=60, ' + 'x' * 900
+        ctx = mock.Mock(
+            config=config,
+            request=mock.Mock(url="image_large_metadata.jpg"),
+            headers={'Cache-Control': cache_control}
+        )
+        storage = Storage(ctx)
+        await storage.put(IMAGE_BYTES)
+        await storage.connector.ensure_index(force=True)
+
+        out = io.StringIO()
+        failures = await explain_storage(
+            storage, storage.get_key_from_request(), COVERED_LOOKUPS, out
+        )
+        expect(failures).to_equal(0)
+
+        result = await storage.get()
+        expect(result.metadata['Cache-Control']).to_equal(cache_control)
+
+    @gen_test
+    async def test_stores_allowlisted_headers_only(self):
+        config = self.get_config()
+        config.RESULT_STORAGE_EXPIRATION_SECONDS = 5
+        config.MONGO_STORE_METADATA = True
+        config.MONGO_STORE_METADATA_HEADERS = ['Cache-Control']
+        ctx = mock.Mock(
+            config=config,
+            request=mock.Mock(
+                url="image_headers.jpg"
+            ),
+            headers={'Cache-Control': 'max-age=60', 'Server': 'Thumbor'}
+        )
+        storage = Storage(ctx)
+        await storage.put(IMAGE_BYTES)
+
+        doc = await storage.storage.find_one({
+            'key': storage.get_key_from_request()
+        })
+        expect(doc['metadata']).to_equal({'0': 'max-age=60'})
+
+        result = await storage.get()
+        expect(result.metadata['Cache-Control']).to_equal('max-age=60')
+        expect(result.metadata).Not.to_include('Server')
+        expect(result.metadata['ContentLength']).to_equal(7339)
+
+    @gen_test
+    async def test_can_get_precomputed_metadata(self):
+        config = self.get_config()
+        config.RESULT_STORAGE_EXPIRATION_SECONDS = 5
+        config.MONGO_STORE_METADATA = True
+        config.MONGO_STORE_METADATA_PRECOMPUTED = True
+        ctx = mock.Mock(
+            config=config,
+            request=mock.Mock(
+                url="image_precomputed.jpg"
+            ),
+            headers={'Vary': 'Accept'}
+        )
+        storage = Storage(ctx)
+        await storage.put(IMAGE_BYTES)
+
+        result = await storage.get()
+        expect(result.metadata['Vary']).to_equal('Accept')
+        expect(result.metadata['ContentType']).to_equal('image/png')
+        expect(result.metadata['ContentLength']).to_equal(7339)
+        expect(result.last_modified).to_be_instance_of(datetime)
+
+    @gen_test
+    async def test_can_store_under_an_explicit_key(self):
+        config = self.get_config()
+        ctx = mock.Mock(
+            config=config,
+            request=mock.Mock(url="imported.jpg")
+        )
+        storage = Storage(ctx)
+
+        await storage.store(
+            "result:imported.jpg", IMAGE_BYTES, {'0': 'max-age=60'}
+        )
+
+        result = await storage.get()
+        expect(result.buffer).to_equal(IMAGE_BYTES)
+        expect(result.metadata['Cache-Control']).to_equal('max-age=60')
+        expect(result.metadata['ContentType']).to_equal('image/png')
+
+    def get_variants_storage(self, url, accepts_webp):
+        config = self.get_config()
+        config.AUTO_WEBP = True
+        config.MONGO_RESULT_STORAGE_VARIANTS = True
+        ctx = mock.Mock(
+            config=config,
+            request=RequestParameters(url=url, accepts_webp=accepts_webp)
+        )
+        return Storage(ctx)
+
+    @gen_test
+    async def test_serves_best_variant_and_reports_missing_ones(self):
+        url = "variants.jpg"
+        storage = self.get_variants_storage(url, accepts_webp=False)
+        await storage.put(IMAGE_BYTES)
+        expect(storage.get_key_from_request()).to_equal(f"variants:{url}")
+
+        storage = self.get_variants_storage(url, accepts_webp=True)
+        result = await storage.get()
+        expect(result.buffer).to_equal(IMAGE_BYTES)
+        expect(result.metadata['ContentType']).to_equal('image/png')
+        expect(storage.missing_variants).to_equal(['webp'])
+
+        missing = [item async for item in storage.find_missing_variants()]
+        expect(missing).to_include((url, ['webp']))
+
+    @gen_test
+    async def test_records_variants_thumbor_did_not_convert(self):
+        url = "variants_unavailable.jpg"
+        storage = self.get_variants_storage(url, accepts_webp=True)
+        # Thumbor did not convert this result to WebP.
+        await storage.put(IMAGE_BYTES)
+
+        doc = await storage.storage.find_one({'key': f"variants:{url}"})
+        expect(list(doc['variants'])).to_equal(['original'])
+        expect(doc['unavailable']).to_equal(['webp'])
+
+        result = await storage.get()
+        expect(result.buffer).to_equal(IMAGE_BYTES)
+        expect(storage.missing_variants).to_equal([])
+
+    @gen_test
+    async def test_replaces_a_variant_and_its_file(self):
+        url = "variants_replaced.jpg"
+        storage = self.get_variants_storage(url, accepts_webp=False)
+        await storage.put(IMAGE_BYTES)
+        doc = await storage.storage.find_one({'key': f"variants:{url}"})
+        file_id = doc['variants']['original']['file_id']
+
+        await storage.put(IMAGE_BYTES)
+        docs = await storage.storage.find(
+            {'key': f"variants:{url}"}
+        ).to_list(length=None)
+        expect(docs).to_length(1)
+        expect(docs[0]['variants']['original']['file_id']).not_to_equal(
+            file_id
+        )
+        expect(await storage.database['fs.files'].find_one(
+            {'_id': file_id}
+        )).to_be_null()
+
+    @gen_test
+    async def test_serves_stale_results_within_the_grace_period(self):
+        config = self.get_config()
+        config.RESULT_STORAGE_EXPIRATION_SECONDS = 1
+        config.MONGO_RESULT_STORAGE_STALE_SECONDS = 60
+        config.MONGO_RESULT_STORAGE_REFRESH_URL = 'http://127.0.0.1:1'
+        ctx = mock.Mock(
+            config=config,
+            request=RequestParameters(url="image_stale.jpg")
+        )
+        storage = Storage(ctx)
+        await storage.put(IMAGE_BYTES)
+
+        result = await storage.get()
+        expect(result.metadata).Not.to_include('Stale')
+
+        time.sleep(2)
+        result = await storage.get()
+        expect(result.buffer).to_equal(IMAGE_BYTES)
+        expect(result.metadata['Stale']).to_be_true()
+
+        ctx.request.headers = {'X-Thumbor-Mongodb-Refresh': 'token'}
+        expect(await storage.get()).not_to_be_null()
+        await storage.connector.leases.acquire(
+            storage.lease_name('refresh'), 'token', 60
+        )
+        expect(await storage.get()).to_be_null()
+
+        await storage.put(IMAGE_BYTES)
+        expect(await storage.connector.leases.holds(
+            storage.lease_name('refresh'), 'token'
+        )).to_be_false()
+
+    @gen_test
+    async def test_renders_a_missing_result_once(self):
+        config = self.get_config()
+        config.RESULT_STORAGE_EXPIRATION_SECONDS = 5
+        config.MONGO_RESULT_STORAGE_RENDER_LEASE_SECONDS = 30
+        config.MONGO_RESULT_STORAGE_RENDER_WAIT = 0.2
+        storages = [
+            Storage(mock.Mock(
+                config=config,
+                request=RequestParameters(url="image_render_lease.jpg")
+            ))
+            for _ in range(2)
+        ]
+
+        expect(await storages[0].get()).to_be_null()
+        expect(storages[0].render_token).not_to_be_null()
+        expect(await storages[1].get()).to_be_null()
+        expect(storages[1].render_token).to_be_null()
+
+        leases = storages[0].connector.leases
+        name = storages[0].lease_name('render')
+        token = storages[0].render_token
+        await storages[0].put(IMAGE_BYTES)
+        expect(await leases.holds(name, token)).to_be_false()
+        expect((await storages[1].get()).buffer).to_equal(IMAGE_BYTES)
+
+    @gen_test
+    async def test_concurrent_variants_share_one_document(self):
+        url = f"variants_concurrent_{time.time()}.jpg"
+        storages = [
+            self.get_variants_storage(url, accepts_webp=webp)
+            for webp in (False, True, False, True)
+        ]
+        await storages[0].connector.indexes_ready
+        await asyncio.gather(*(
+            storage.put(IMAGE_BYTES) for storage in storages
+        ))
+
+        docs = await storages[0].storage.find(
+            {'key': f"variants:{url}"}
+        ).to_list(length=None)
+        expect(docs).to_length(1)
+        expect(list(docs[0]['variants'])).to_equal(['original'])
+
+
+@skipIf(
+    sys.version_info >= (3, 11),
+    "Motor 2 asyncio support needs asyncio.coroutine, gone in 3.11"
+)
+class AsyncIOMongoResultStorageTestCase(BaseMongoResultStorageTestCase):
+    def get_config(self):
+        config = super(AsyncIOMongoResultStorageTestCase, self).get_config()
+        config.MONGO_RESULT_STORAGE_DRIVER = 'asyncio'
+        return config
+
+    @gen_test
+    async def test_uses_asyncio_driver(self):
+        expect(self.storage.connector.bucket_class).to_equal(
+            get_driver('asyncio')[1]
+        )
+
+
+class VariantSelectionTestCase(TestCase):
+    def test_prefers_negotiated_formats_in_thumbor_order(self):
+        config = Config(AUTO_WEBP=True, AUTO_AVIF=True)
+        request = RequestParameters(accepts_webp=True)
+        request.headers = {'Accept': 'image/avif,image/webp,*/*'}
+        storage = mock.Mock(context=mock.Mock(config=config, request=request))
+
+        expect(Storage.accepted_variants(storage)).to_equal(
+            ['webp', 'avif', 'original']
+        )
+
+        config.AUTO_WEBP = False
+        expect(Storage.accepted_variants(storage)).to_equal(
+            ['avif', 'original']
+        )
+
+    def test_names_variants_by_converted_format(self):
+        expect(Storage.variant_name('webp', 'image/webp')).to_equal('webp')
+        expect(Storage.variant_name('webp', 'image/png')).to_equal(
+            'original'
+        )
+        expect(Storage.variant_name('original', 'image/webp')).to_equal(
+            'original'
+        )
+
+    def test_maps_result_keys_to_variants(self):
+        expect(Storage.variant_of('result:/a.jpg')).to_equal(
+            ('variants:/a.jpg', 'original')
+        )
+        expect(Storage.variant_of('result:/a.jpg/webp')).to_equal(
+            ('variants:/a.jpg', 'webp')
+        )
+
+    def test_selects_best_fresh_variant(self):
+        fresh = {'created_at': 1}
+        expired = {'created_at': 0}
+        doc = {
+            'variants': {'avif': expired, 'original': fresh},
+            'unavailable': ['heif'],
+        }
+
+        def is_usable(created_at):
+            return created_at != 0
+
+        expect(Storage.select_variant(
+            doc, ['webp', 'avif', 'heif', 'original'], is_usable
+        )).to_equal(('original', ['webp', 'avif']))
+        expect(Storage.select_variant(
+            doc, ['avif'], is_usable
+        )).to_equal((None, ['avif']))
+
+
+class FakeLeases:
+    def __init__(self, acquired=True):
+        self.acquired = acquired
+        self.released = []
+
+    async def acquire(self, name, token, ttl):
+        return self.acquired
+
+    async def release(self, name, token):
+        self.released.append(name)
+
+
+class StaleResultTestCase(TestCase):
+    def get_storage(self, **config):
+        config = Config(
+            RESULT_STORAGE_EXPIRATION_SECONDS=60,
+            MONGO_RESULT_STORAGE_STALE_SECONDS=30,
+            **config
+        )
+        request = RequestParameters(url='/unsafe/image.jpg')
+        context = mock.Mock(config=config, request=request)
+        storage = mock.Mock(context=context)
+        storage.get_max_age = partial(Storage.get_max_age, storage)
+        storage.get_stale_seconds = partial(Storage.get_stale_seconds, storage)
+        storage.is_expired = partial(Storage.is_expired, storage)
+        return storage
+
+    def test_serves_expired_results_within_the_grace_period(self):
+        storage = self.get_storage()
+        now = datetime.utcnow()
+
+        for age, expired, usable in ((50, False, True), (70, True, True),
+                                     (100, True, False)):
+            created_at = now - timedelta(seconds=age)
+            expect(Storage.is_expired(storage, created_at)).to_equal(expired)
+            expect(Storage.is_usable(storage, created_at)).to_equal(usable)
+
+        condition = Storage.expiration_conditions(storage)['created_at']
+        expect(condition['$gte'] < now - timedelta(seconds=89)).to_be_true()
+
+    def test_refreshes_through_the_configured_url(self):
+        storage = self.get_storage(
+            MONGO_RESULT_STORAGE_REFRESH_URL='http://thumbor:8888/'
+        )
+        expect(Storage.refresh_url(storage)).to_equal(
+            'http://thumbor:8888/unsafe/image.jpg'
+        )
+
+    def test_refresh_runs_once_and_releases_failed_leases(self):
+        client = mock.Mock(fetch=mock.AsyncMock(side_effect=OSError))
+        with mock.patch(
+            'thumbor_mongodb.result_storages.mongo_result_storage.'
+            'AsyncHTTPClient', return_value=client
+        ):
+            leases = FakeLeases(acquired=False)
+            asyncio.run(Storage.refresh(leases, 'refresh:a', 'url', {}, 5))
+            expect(client.fetch.called).to_be_false()
+
+            leases = FakeLeases()
+            asyncio.run(Storage.refresh(
+                leases, 'refresh:a', 'url', {'Accept': 'image/webp'}, 5
+            ))
+            headers = client.fetch.call_args[1]['headers']
+            expect(headers['Accept']).to_equal('image/webp')
+            expect(headers).to_include('X-Thumbor-Mongodb-Refresh')
+            expect(leases.released).to_equal(['refresh:a'])
+
+    def test_spawns_one_refresh_per_result_at_a_time(self):
+        REFRESHING.clear()
+        storage = self.get_storage()
+        storage.lease_name.return_value = 'refresh:a'
+        storage.refresh_url.return_value = 'url'
+        loop = mock.Mock()
+        with mock.patch.object(IOLoop, 'current', return_value=loop):
+            Storage.revalidate(storage, mock.Mock(), mock.Mock(metadata={}))
+            Storage.revalidate(storage, mock.Mock(), mock.Mock(metadata={}))
+            expect(loop.spawn_callback.call_count).to_equal(1)
+
+            asyncio.run(Storage.refresh(
+                FakeLeases(acquired=False), 'refresh:a', 'url', {}, 5
+            ))
+            Storage.revalidate(storage, mock.Mock(), mock.Mock(metadata={}))
+            expect(loop.spawn_callback.call_count).to_equal(2)
+
+
+class RenderLeaseTestCase(TestCase):
+    def setUp(self):
+        TIMED_OUT_RENDERS.clear()
+
+    def get_storage(self, leases):
+        config = Config(
+            MONGO_RESULT_STORAGE_RENDER_LEASE_SECONDS=30,
+            MONGO_RESULT_STORAGE_RENDER_WAIT=0.2,
+        )
+        request = RequestParameters(url='/unsafe/image.jpg')
+        storage = mock.Mock(
+            context=mock.Mock(config=config, request=request),
+            render_token=None,
+        )
+        storage.get_render_lease_seconds = partial(
+            Storage.get_render_lease_seconds, storage
+        )
+        storage.lease_name.return_value = 'render:result:/unsafe/image.jpg'
+        return storage, mock.Mock(leases=leases)
+
+    def test_lease_holder_renders(self):
+        storage, connector = self.get_storage(FakeLeases())
+        get_from = mock.AsyncMock()
+
+        expect(asyncio.run(Storage.wait_for_render(
+            storage, connector, 'key', get_from
+        ))).to_be_null()
+        expect(storage.render_token).not_to_be_null()
+        expect(get_from.called).to_be_false()
+
+    def test_others_wait_for_the_rendered_result(self):
+        storage, connector = self.get_storage(FakeLeases(acquired=False))
+        get_from = mock.AsyncMock(side_effect=[None, 'result'])
+
+        expect(asyncio.run(Storage.wait_for_render(
+            storage, connector, 'key', get_from
+        ))).to_equal('result')
+        expect(storage.render_token).to_be_null()
+
+    def test_others_render_after_waiting(self):
+        storage, connector = self.get_storage(FakeLeases(acquired=False))
+        get_from = mock.AsyncMock(return_value=None)
+
+        expect(asyncio.run(Storage.wait_for_render(
+            storage, connector, 'key', get_from
+        ))).to_be_null()
+        expect(get_from.call_count).to_equal(3)
+        storage.incr_metric.assert_called_with('render', 'wait.timeout')
+
+    def test_timed_out_leases_are_not_waited_on_again(self):
+        leases = FakeLeases(acquired=False)
+        storage, connector = self.get_storage(leases)
+        get_from = mock.AsyncMock(return_value=None)
+        asyncio.run(Storage.wait_for_render(
+            storage, connector, 'key', get_from
+        ))
+        get_from.reset_mock()
+
+        expect(asyncio.run(Storage.wait_for_render(
+            storage, connector, 'key', get_from
+        ))).to_be_null()
+        expect(get_from.called).to_be_false()
+        storage.incr_metric.assert_called_with('render', 'wait.skip')
+
+
+class WriteVariantTestCase(TestCase):
+    def get_connector(self, *results):
+        connector = mock.Mock(schema=Schema(2), hashed_key=False)
+        connector.key_fields = partial(MongoConnector.key_fields, connector)
+        connector.col_conn.find_one_and_update = mock.AsyncMock(
+            side_effect=list(results)
+        )
+        return connector
+
+    def write(self, connector, session=None):
+        return asyncio.run(MongoConnector.write_variant(
+            connector, 'result:/a', 'webp',
+            {'file_id': 2, 'created_at': datetime(2020, 1, 1)},
+            session=session,
+        ))
+
+    def test_updates_the_document_of_a_concurrent_upsert(self):
+        connector = self.get_connector(
+            DuplicateKeyError('dup'), {'_id': 1, 'vr': {}}
+        )
+        expect(self.write(connector)).to_equal((1, None))
+
+        first, second = connector.col_conn.find_one_and_update.call_args_list
+        expect(first[1]['upsert']).to_be_true()
+        expect(second[1]).not_to_include('upsert')
+
+    def test_leaves_transactions_to_the_pipeline(self):
+        connector = self.get_connector(DuplicateKeyError('dup'))
+        with self.assertRaises(DuplicateKeyError):
+            self.write(connector, session=mock.Mock())
+        expect(connector.col_conn.find_one_and_update.call_count).to_equal(1)
+
+
+class CoveringIndexesTestCase(TestCase):
+    def test_metadata_is_not_indexed(self):
+        connector = mock.Mock(
+            variants=False, hashed_key=False,
+            schemas=[Schema(2), Schema(1)],
+        )
+        connector.missing_indexes = partial(
+            MongoConnector.missing_indexes, connector
+        )
+        connector.variant_key_indexes = partial(
+            MongoConnector.variant_key_indexes, connector
+        )
+        fields = {
+            field for keys in MongoConnector.indexes(connector).values()
+            for field, _ in keys
+        }
+        expect(fields).not_to_include('metadata')
+        expect(fields).not_to_include('m')
+        expect(fields).to_include('t')
+
+
+class VariantIndexesTestCase(TestCase):
+    def get_connector(self, hashed_key):
+        connector = mock.Mock(
+            variants=True, hashed_key=hashed_key,
+            schemas=[Schema(2), Schema(1)],
+        )
+        connector.missing_indexes = partial(
+            MongoConnector.missing_indexes, connector
+        )
+        connector.variant_key_indexes = partial(
+            MongoConnector.variant_key_indexes, connector
+        )
+        return connector
+
+    def test_multi_variant_keys_are_unique(self):
+        connector = self.get_connector(hashed_key=False)
+        options = MongoConnector.index_options(connector)
+
+        expect(options['k_1']).to_equal({
+            'unique': True,
+            'partialFilterExpression': {'vr': {'$exists': True}},
+        })
+        expect(options['key_1']).to_equal({
+            'unique': True,
+            'partialFilterExpression': {'variants': {'$exists': True}},
+        })
+        expect(options['missing_1']).to_equal({'sparse': True})
+
+    def test_unique_keys_start_with_the_shard_key(self):
+        connector = self.get_connector(hashed_key=True)
+        expect(MongoConnector.variant_key_indexes(connector)).to_equal([
+            [('kh', 1), ('k', 1)], [('key_hash', 1), ('key', 1)],
+        ])
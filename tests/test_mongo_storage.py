@@ -8,18 +8,32 @@
 # http://www.opensource.org/licenses/mit-license
 # Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
 
+import io
+import sys
 import time
+from unittest import TestCase, skipIf
 
+import mock
 from preggy import expect
+from pymongo.errors import PyMongoError
 from tornado.ioloop import IOLoop
 from tornado.testing import AsyncHTTPTestCase, gen_test
 
-from tests.fixtures.fixtures import IMAGE_BYTES
+from tests.fixtures.fixtures import IMAGE_BYTES, SVG_BYTES
 from thumbor.app import ThumborServiceApp
 from thumbor.config import Config
 from thumbor.context import Context, ServerParameters
+from thumbor.engines import BaseEngine
 from thumbor.importer import Importer
-from thumbor_mongodb.storages.mongo_storage import Storage as MongoStorage
+from thumbor_mongodb.explain import explain_storage
+from thumbor_mongodb.mongodb.cache import CacheWarmer, LocalCache
+from thumbor_mongodb.mongodb.driver import get_driver
+from thumbor_mongodb.mongodb.eviction import AccessTracker, LRUEvictor
+from thumbor_mongodb.mongodb.migration import SchemaMigrator
+from thumbor_mongodb.storages.mongo_storage import (
+    COVERED_LOOKUPS, MIMETYPE_HEAD_SIZE, Storage as MongoStorage
+)
+from thumbor_mongodb.utils import key_hash
 
 
 class BaseMongoStorageTestCase(AsyncHTTPTestCase):
@@ -252,3 +266,273 @@ class BaseMongoStorageTestCase(AsyncHTTPTestCase):
         expect(got).not_to_be_null()
         expect(got).not_to_be_an_error()
         expect(got).to_equal("ACME-SEC")
+
+    @gen_test
+    async def test_can_track_last_access(self):
+        iurl = self.get_image_url("image_access.jpg")
+        await self.storage.put(iurl, IMAGE_BYTES)
+        stored = await self.storage.storage.find_one({'path': iurl})
+
+        tracker = AccessTracker(self.storage.storage, 1, 10)
+        tracker.record(stored['_id'])
+        updated = await tracker.flush()
+        expect(updated).to_equal(1)
+
+        stored = await self.storage.storage.find_one({'_id': stored['_id']})
+        expect(stored['accessed_at']).not_to_be_null()
+
+    @gen_test
+    async def test_can_evict_least_recently_used(self):
+        iurl = self.get_image_url("image_evict.jpg")
+        await self.storage.put(iurl, IMAGE_BYTES)
+
+        evictor = LRUEvictor(
+            self.storage.database, self.storage.storage, 1, 60, 100
+        )
+        removed = await evictor.evict()
+        expect(removed).to_be_greater_than(0)
+
+        got = await self.storage.get(iurl)
+        expect(got).to_be_null()
+
+    @gen_test
+    async def test_can_warm_up_popular_images(self):
+        iurl = self.get_image_url("image_popular.jpg")
+        await self.storage.put(iurl, IMAGE_BYTES)
+        await self.storage.storage.update_many(
+            {'path': iurl}, {'$set': {'hits': 1000000}}
+        )
+
+        cache = LocalCache(len(IMAGE_BYTES) * 10)
+        warmer = CacheWarmer(
+            self.storage.database, self.storage.storage, cache, 'path',
+            MongoStorage.cache_value
+        )
+        loaded = await warmer.warm_up(1, len(IMAGE_BYTES), 10)
+        expect(loaded).to_equal(1)
+        expect(cache.get(iurl)[2]).to_equal(IMAGE_BYTES)
+
+    @gen_test
+    async def test_can_store_image_with_auto_chunk_size(self):
+        iurl = self.get_image_url("image_chunk.jpg")
+        config = self.get_config()
+        config.MONGO_STORAGE_CHUNK_SIZE = 'auto'
+        storage = MongoStorage(Context(
+            config=config, server=self.get_server()
+        ))
+        await storage.put(iurl, IMAGE_BYTES)
+        stored = await storage.storage.find_one(
+            {'path': iurl}, sort=[('created_at', -1)]
+        )
+        grid_file = await storage.database['fs.files'].find_one({
+            '_id': stored['file_id']
+        })
+        expect(grid_file['chunkSize']).to_equal(len(IMAGE_BYTES))
+
+        got = await storage.get(iurl)
+        expect(got).to_equal(IMAGE_BYTES)
+
+    @gen_test
+    async def test_can_remove_gridfs_files(self):
+        iurl = self.get_image_url("image_remove_files.jpg")
+        await self.storage.put(iurl, IMAGE_BYTES)
+        await self.storage.remove(iurl)
+
+        files = await self.storage.database['fs.files'].count_documents({
+            'filename': iurl
+        })
+        expect(files).to_equal(0)
+
+    @gen_test
+    async def test_failed_put_leaves_no_gridfs_data(self):
+        pipeline = self.storage.connector.pipeline
+        index_doc = {'path': self.get_image_url("image_orphan.jpg")}
+        with mock.patch.object(
+            pipeline, 'insert', side_effect=PyMongoError('failed')
+        ):
+            with self.assertRaises(PyMongoError):
+                await pipeline.put(index_doc['path'], IMAGE_BYTES, index_doc)
+
+        chunks = await self.storage.database['fs.chunks'].count_documents({
+            'files_id': index_doc['file_id']
+        })
+        expect(chunks).to_equal(0)
+
+    @gen_test
+    async def test_can_store_image_from_stream(self):
+        iurl = self.get_image_url("image_stream.png")
+
+        async def chunks():
+            for offset in range(0, len(IMAGE_BYTES), 1000):
+                yield IMAGE_BYTES[offset:offset + 1000]
+
+        await self.storage.put_stream(iurl, chunks())
+        got = await self.storage.get(iurl)
+        expect(got).to_equal(IMAGE_BYTES)
+
+        stored = await self.storage.storage.find_one(
+            {'path': iurl}, sort=[('created_at', -1)]
+        )
+        expect(stored['content_type']).to_equal('image/png')
+        expect(stored['content_length']).to_equal(len(IMAGE_BYTES))
+
+    @gen_test
+    async def test_can_store_svg_from_stream(self):
+        iurl = self.get_image_url("image_stream.svg")
+
+        async def chunks():
+            for offset in range(0, len(SVG_BYTES), 100):
+                yield SVG_BYTES[offset:offset + 100]
+
+        await self.storage.put_stream(iurl, chunks())
+        stored = await self.storage.storage.find_one(
+            {'path': iurl}, sort=[('created_at', -1)]
+        )
+        expect(stored['content_type']).to_equal('image/svg+xml')
+
+    @gen_test
+    async def test_can_store_image_across_clusters(self):
+        config = self.get_config()
+        config.MONGO_STORAGE_URI = [
+            'mongodb://localhost:27017',
+            'mongodb://127.0.0.1:27017',
+        ]
+        storage = MongoStorage(Context(
+            config=config, server=self.get_server()
+        ))
+        expect(len(storage.router.connectors)).to_equal(2)
+
+        for name in ("image_cluster_1.jpg", "image_cluster_2.jpg"):
+            iurl = self.get_image_url(name)
+            await storage.put(iurl, IMAGE_BYTES)
+            got = await storage.get(iurl)
+            expect(got).to_equal(IMAGE_BYTES)
+
+    @gen_test
+    async def test_can_store_image_with_hashed_key(self):
+        config = self.get_config()
+        config.MONGO_STORAGE_HASHED_KEY = True
+        storage = MongoStorage(Context(
+            config=config, server=self.get_server()
+        ))
+        iurl = self.get_image_url("image_hashed.jpg")
+        await storage.put(iurl, IMAGE_BYTES)
+
+        doc = await storage.storage.find_one({'path': iurl})
+        expect(doc['path_hash']).to_equal(key_hash(iurl))
+        expect(await storage.exists(iurl)).to_be_true()
+        expect(await storage.get(iurl)).to_equal(IMAGE_BYTES)
+
+        await storage.remove(iurl)
+        expect(await storage.exists(iurl)).to_be_false()
+        files = await storage.database['fs.files'].count_documents({
+            '_id': doc['file_id']
+        })
+        expect(files).to_equal(0)
+
+    @gen_test
+    async def test_can_store_image_in_compact_schema(self):
+        config = self.get_config()
+        config.MONGO_STORAGE_SCHEMA_VERSION = 2
+        config.STORES_CRYPTO_KEY_FOR_EACH_IMAGE = True
+        storage = MongoStorage(Context(
+            config=config, server=self.get_server()
+        ))
+        iurl = self.get_image_url("image_compact.jpg")
+        await storage.put(iurl, IMAGE_BYTES)
+        await storage.put_detector_data(iurl, "some-data")
+
+        doc = await storage.storage.find_one({'p': iurl})
+        expect(doc['v']).to_equal(2)
+        expect(doc['s']).to_equal("ACME-SEC")
+        expect(doc['d']).to_equal("some-data")
+        expect(doc).Not.to_include('path')
+        file_doc = await storage.database['fs.files'].find_one({
+            '_id': doc['f']
+        })
+        expect(file_doc.get('metadata')).to_be_null()
+
+        expect(await storage.exists(iurl)).to_be_true()
+        expect(await storage.get(iurl)).to_equal(IMAGE_BYTES)
+        expect(await storage.get_crypto(iurl)).to_equal("ACME-SEC")
+        expect(await storage.get_detector_data(iurl)).to_equal("some-data")
+
+        await storage.remove(iurl)
+        expect(await storage.exists(iurl)).to_be_false()
+
+    @gen_test
+    async def test_can_read_and_migrate_version_1_documents(self):
+        iurl = self.get_image_url("image_migrate.jpg")
+        await self.storage.put(iurl, IMAGE_BYTES)
+
+        config = self.get_config()
+        config.MONGO_STORAGE_SCHEMA_VERSION = 2
+        storage = MongoStorage(Context(
+            config=config, server=self.get_server()
+        ))
+        expect(await storage.get(iurl)).to_equal(IMAGE_BYTES)
+
+        connector = storage.connector
+        migrator = SchemaMigrator(
+            connector.db_conn, connector.col_conn, connector.schema, 1000, 0,
+            on_done=connector.migration_done
+        )
+        expect(connector.read_schemas).to_length(2)
+        while await migrator.migrate():
+            pass
+        await migrator.migrate()
+        expect(connector.read_schemas).to_equal([connector.schema])
+
+        doc = await storage.storage.find_one({'p': iurl})
+        expect(doc['v']).to_equal(2)
+        expect(await storage.storage.count_documents({
+            'v': {'$exists': False}
+        })).to_equal(0)
+        expect(await storage.get(iurl)).to_equal(IMAGE_BYTES)
+
+    @gen_test
+    async def test_exists_if_expire_set_to_none(self):
+        iurl = self.get_image_url("image_no_expiration.jpg")
+        config = self.get_config()
+        config.STORAGE_EXPIRATION_SECONDS = None
+        storage = MongoStorage(Context(
+            config=config, server=self.get_server()
+        ))
+        await storage.put(iurl, IMAGE_BYTES)
+        expect(await storage.exists(iurl)).to_be_true()
+
+    @gen_test
+    async def test_lookups_are_covered_by_indexes(self):
+        await self.storage.connector.ensure_index(force=True)
+        out = io.StringIO()
+        failures = await explain_storage(
+            self.storage, self.get_image_url("image.jpg"),
+            COVERED_LOOKUPS, out
+        )
+        expect(failures).to_equal(0)
+        expect(out.getvalue()).to_include("exists")
+
+
+@skipIf(
+    sys.version_info >= (3, 11),
+    "Motor 2 asyncio support needs asyncio.coroutine, gone in 3.11"
+)
+class AsyncIOMongoStorageTestCase(BaseMongoStorageTestCase):
+    def get_config(self):
+        config = super(AsyncIOMongoStorageTestCase, self).get_config()
+        config.MONGO_STORAGE_DRIVER = 'asyncio'
+        return config
+
+    @gen_test
+    async def test_uses_asyncio_driver(self):
+        expect(self.storage.connector.bucket_class).to_equal(
+            get_driver('asyncio')[1]
+        )
+
+
+class MimetypeHeadTestCase(TestCase):
+    def test_head_covers_the_svg_window(self):
+        expect(BaseEngine.get_mimetype(SVG_BYTES[:512])).to_be_null()
+        expect(BaseEngine.get_mimetype(
+            SVG_BYTES[:MIMETYPE_HEAD_SIZE]
+        )).to_equal('image/svg+xml')
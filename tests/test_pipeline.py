@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import mock
+from preggy import expect
+from pymongo.errors import DuplicateKeyError
+
+from tests.fixtures.fixtures import IMAGE_BYTES
+from thumbor_mongodb.mongodb.pipeline import OrphanSweeper, PutPipeline
+
+
+def matches(doc, query):
+    for name, condition in query.items():
+        value = doc.get(name)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for operator, operand in condition.items():
+            if operator == '$in' and value not in operand or \
+                    operator == '$lt' and not value < operand or \
+                    operator == '$gt' and not value > operand:
+                return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, field, direction):
+        return FakeCursor(sorted(self.docs, key=lambda doc: doc[field]))
+
+    def limit(self, count):
+        return FakeCursor(self.docs[:count])
+
+    async def to_list(self, length=None):
+        return list(self.docs)
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = []
+
+    async def insert_one(self, doc, session=None):
+        self.docs.append(doc)
+
+    async def insert_many(self, docs, ordered=True):
+        self.docs.extend(docs)
+
+    def find(self, query, projection=None):
+        return FakeCursor([doc for doc in self.docs if matches(doc, query)])
+
+    async def delete_many(self, query):
+        self.docs = [doc for doc in self.docs if not matches(doc, query)]
+
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection()
+        return collection
+
+
+class PutPipelineTestCase(TestCase):
+    def test_split_in_batches_of_chunks(self):
+        pipeline = PutPipeline(None, None, batch_bytes=2048)
+        batches = pipeline.split('file', IMAGE_BYTES, 1024)
+
+        chunks = [chunk for batch in batches for chunk in batch]
+        expect(len(batches)).to_equal(4)
+        expect(len(chunks)).to_equal(8)
+        expect([chunk['n'] for chunk in chunks]).to_equal(list(range(8)))
+        expect(b''.join(chunk['data'] for chunk in chunks)).to_equal(
+            IMAGE_BYTES
+        )
+
+    def test_split_empty_file(self):
+        pipeline = PutPipeline(None, None)
+        expect(pipeline.split('file', b'', 1024)).to_equal([])
+
+
+class TransactionTestCase(TestCase):
+    def test_runs_the_transaction_again_after_a_concurrent_upsert(self):
+        database = FakeDatabase()
+        session = mock.MagicMock()
+        session.__aenter__.return_value = session
+        session.with_transaction = mock.AsyncMock(
+            side_effect=[DuplicateKeyError('dup'), None]
+        )
+        database.client = mock.Mock(
+            start_session=mock.AsyncMock(return_value=session)
+        )
+        pipeline = PutPipeline(database, database['results'])
+        pipeline.transactions = True
+
+        asyncio.run(pipeline.put('a', IMAGE_BYTES, {}, 1024))
+        expect(session.with_transaction.call_count).to_equal(2)
+
+
+class OrphanSweeperTestCase(TestCase):
+    def test_removes_chunks_of_puts_killed_before_their_file(self):
+        database = FakeDatabase()
+        pipeline = PutPipeline(database, database['images'])
+        pipeline.transactions = False
+
+        stored = asyncio.run(pipeline.put('a', IMAGE_BYTES, {}, 1024))
+        # The process dies after the chunk inserts, nothing is cleaned up.
+        with mock.patch.object(pipeline, 'insert', side_effect=SystemExit):
+            with mock.patch.object(pipeline, 'cleanup', mock.AsyncMock()):
+                with self.assertRaises(SystemExit):
+                    asyncio.run(pipeline.put('b', IMAGE_BYTES, {}, 1024))
+        expect(database['fs.chunks'].docs).to_length(16)
+
+        sweeper = OrphanSweeper(database, 60, age=3600, batch_size=5)
+        expect(asyncio.run(sweeper.sweep())).to_equal(0)
+
+        sweeper.clock = lambda: datetime.utcnow() + timedelta(hours=2)
+        expect(asyncio.run(sweeper.sweep())).to_equal(1)
+        expect({
+            chunk['files_id'] for chunk in database['fs.chunks'].docs
+        }).to_equal({stored})
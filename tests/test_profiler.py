@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+import json
+from unittest import TestCase
+
+import mock
+from bson.objectid import ObjectId
+from preggy import expect
+from thumbor.app import ThumborServiceApp
+from thumbor.config import Config
+from thumbor.context import Context
+from thumbor.importer import Importer
+from tornado.testing import AsyncHTTPTestCase
+
+from thumbor_mongodb.handler_lists.profiler import get_handlers
+from thumbor_mongodb.mongodb import profiler as profiler_module
+from thumbor_mongodb.mongodb.profiler import (
+    CommandProfiler, Profiler, SpaceSaving, command_shape, get_profiler,
+    profiled
+)
+
+
+class FakeStorage:
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    @staticmethod
+    def profile_key(path, *args):
+        return path
+
+    @profiled('storage.get')
+    async def get(self, path):
+        return b'abc'
+
+
+class SpaceSavingTestCase(TestCase):
+    def test_counts_frequent_keys_within_its_size(self):
+        sketch = SpaceSaving(2)
+        for key in 'aaabbc':
+            sketch.add(key)
+
+        expect(sketch.counts).to_length(2)
+        expect(sketch.top(1)).to_equal([('a', 3, 0)])
+        expect(sketch.top()[1]).to_equal(('c', 3, 2))
+
+
+class ShapeTestCase(TestCase):
+    def test_replaces_values_by_types(self):
+        expect(command_shape('find', {
+            'find': 'images',
+            'filter': {'k': 'a', 'c': {'$gte': 1}, '_id': ObjectId()},
+        })).to_equal(
+            'find images {"_id": "ObjectId", "c": {"$gte": "int"}, '
+            '"k": "str"}'
+        )
+        expect(command_shape('delete', {
+            'delete': 'images', 'deletes': [{'q': {'k': {'$in': [1, 2]}}}],
+        })).to_equal('delete images {"k": {"$in": ["int"]}}')
+        expect(command_shape('getMore', {
+            'getMore': 123, 'collection': 'fs.chunks',
+        })).to_equal('getMore fs.chunks {}')
+
+
+class ProfilerTestCase(TestCase):
+    def test_keeps_recent_slow_operations(self):
+        profiler = Profiler(threshold=0.1, size=2)
+        for duration in (0.2, 0.05, 0.3, 0.4):
+            profiler.record('storage.get', f"{duration}", duration, 10)
+
+        report = profiler.report()
+        expect([e['duration_ms'] for e in report['slow']]).to_equal(
+            [300, 400]
+        )
+        expect(report['hot_keys']).to_length(4)
+
+    def test_profiles_storage_operations_when_enabled(self):
+        storage = FakeStorage(None)
+        expect(asyncio.run(storage.get('a'))).to_equal(b'abc')
+
+        storage = FakeStorage(Profiler(threshold=0))
+        asyncio.run(storage.get('a'))
+        slow = storage.profiler.report()['slow']
+        expect(slow[0]['operation']).to_equal('storage.get')
+        expect(slow[0]['target']).to_equal('a')
+        expect(slow[0]['bytes']).to_equal(3)
+
+    def test_records_slow_commands_of_attached_databases(self):
+        profiler = Profiler(threshold=0.1, explain_rate=1)
+        database = mock.Mock()
+        database.name = 'thumbor'
+        database.client.nodes = {('mongo-a', 27017)}
+        profiler.attach(database)
+        profiler.attach(database)
+        profiler.pool.local.wait = 0.002
+        listener = CommandProfiler(profiler)
+        command = {'find': 'images', 'filter': {'k': 'a'}, 'limit': 1}
+
+        for request_id, address, name in (
+                (1, ('mongo-a', 27017), 'other'),
+                (2, ('mongo-b', 27017), 'thumbor'),
+                (3, ('mongo-a', 27017), 'thumbor')):
+            listener.started(mock.Mock(
+                command_name='find', database_name=name,
+                connection_id=address, request_id=request_id,
+                command=command,
+            ))
+            listener.succeeded(mock.Mock(
+                command_name='find', database_name=name,
+                connection_id=address, request_id=request_id,
+                duration_micros=200000, reply={'ok': 1},
+            ))
+
+        slow = profiler.report()['slow']
+        expect(slow).to_length(1)
+        expect(slow[0]['target']).to_equal('find images {"k": "str"}')
+        expect(slow[0]['pool_wait_ms']).to_equal(2)
+        expect(profiler.attached).to_length(1)
+
+        key, explained = listener.explain_spec(mock.Mock(
+            command_name='find', database_name='thumbor',
+            connection_id=('mongo-a', 27017),
+        ), command)
+        expect(explained).to_equal({'find': 'images', 'filter': {'k': 'a'}})
+        expect(profiler.databases[key]).to_equal(database)
+
+    def test_dump_keeps_entries_recorded_meanwhile(self):
+        profiler = Profiler(threshold=0)
+        profiler.record('storage.get', 'a', 1)
+        profiler.record('storage.get', 'b', 1)
+
+        def record_concurrently(message):
+            # As a driver thread would, while the dump is logged.
+            profiler.record('storage.get', 'c', 1)
+
+        with mock.patch.object(
+            profiler_module.logger, 'warning', side_effect=record_concurrently
+        ) as warning:
+            profiler.dump()
+        expect(warning.call_count).to_equal(2)
+        expect([entry['target'] for entry in profiler.slow]).to_equal(
+            ['c', 'c']
+        )
+
+    def test_report_route_needs_a_token(self):
+        config = Config(MONGO_PROFILER_ENABLED=True)
+        expect(get_handlers(mock.Mock(config=config))).to_equal([])
+
+    def test_is_disabled_by_default(self):
+        expect(get_profiler(Config())).to_be_null()
+
+
+class ProfilerHandlerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        config = Config(
+            MONGO_PROFILER_ENABLED=True,
+            MONGO_PROFILER_TOKEN='secret',
+            HANDLER_LISTS=['thumbor_mongodb.handler_lists.profiler'],
+        )
+        importer = Importer(config)
+        importer.import_modules()
+        return ThumborServiceApp(Context(None, config, importer))
+
+    def tearDown(self):
+        super(ProfilerHandlerTestCase, self).tearDown()
+        profiler_module.PROFILER = None
+
+    def test_reports_profiles(self):
+        response = self.fetch(
+            '/mongodb/profile', headers={'Authorization': 'Bearer secret'}
+        )
+        expect(response.code).to_equal(200)
+        expect(json.loads(response.body)).to_include('hot_keys')
+
+    def test_requires_the_token(self):
+        expect(self.fetch('/mongodb/profile').code).to_equal(401)
+        expect(self.fetch(
+            '/mongodb/profile', headers={'Authorization': 'Bearer other'}
+        ).code).to_equal(401)
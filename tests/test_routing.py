@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+from unittest import TestCase
+
+from preggy import expect
+
+from thumbor_mongodb.mongodb.routing import (
+    ClusterRouter, HashRing, cluster_name, cluster_names, cluster_uris
+)
+
+KEYS = [f"s.glbimg.com/some/image_{i}.jpg" for i in range(2000)]
+
+
+class HashRingTestCase(TestCase):
+    def test_routes_every_key_to_a_single_node(self):
+        ring = HashRing(["a"])
+        expect({ring.get_node(key) for key in KEYS}).to_equal({"a"})
+
+    def test_spreads_keys_across_nodes(self):
+        ring = HashRing(["a", "b", "c"])
+        owners = [ring.get_node(key) for key in KEYS]
+        for node in ("a", "b", "c"):
+            expect(owners.count(node)).to_be_greater_than(len(KEYS) / 5)
+
+    def test_adding_a_node_moves_few_keys(self):
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b", "c", "d"])
+        moved = [
+            key for key in KEYS if before.get_node(key) != after.get_node(key)
+        ]
+        expect(len(moved)).to_be_lesser_than(len(KEYS) / 2)
+        expect({after.get_node(key) for key in moved}).to_equal({"d"})
+
+
+class ClusterRouterTestCase(TestCase):
+    def test_returns_previous_owner_only_for_moved_keys(self):
+        router = ClusterRouter(
+            {"a": 1, "b": 2, "c": 3}, previous={"a": 1, "b": 2}
+        )
+        for key in KEYS[:200]:
+            name, connector = router.route(key)
+            previous_name, previous = router.previous_owner(key)
+            if name == "c":
+                expect(("a", "b")).to_include(previous_name)
+            else:
+                expect(previous).to_be_null()
+
+    def test_has_no_previous_owner_without_previous_clusters(self):
+        router = ClusterRouter({"a": 1, "b": 2})
+        expect(router.previous_owner(KEYS[0])).to_equal((None, None))
+
+
+class ClusterConfigTestCase(TestCase):
+    def test_cluster_uris(self):
+        expect(cluster_uris(None)).to_equal([None])
+        expect(cluster_uris("")).to_equal([None])
+        expect(cluster_uris("mongodb://a")).to_equal(["mongodb://a"])
+        expect(cluster_uris(("mongodb://a", "mongodb://b"))).to_equal(
+            ["mongodb://a", "mongodb://b"]
+        )
+
+    def test_cluster_name_ignores_credentials_and_options(self):
+        expect(cluster_name(
+            "mongodb://user:secret@a:27017,b:27017/thumbor?replicaSet=rs"
+        )).to_equal("a_27017_b_27017")
+        expect(cluster_name(host="localhost", port=27017)).to_equal(
+            "localhost_27017"
+        )
+
+    def test_cluster_names(self):
+        expect(cluster_names(
+            'MONGO_STORAGE_URI', ['mongodb://a:27017', 'mongodb://b:27017']
+        )).to_equal({
+            'a_27017': 'mongodb://a:27017', 'b_27017': 'mongodb://b:27017',
+        })
+        expect(cluster_names(
+            'MONGO_STORAGE_URI', None, host='localhost', port=27017
+        )).to_equal({'localhost_27017': None})
+
+    def test_rejects_clusters_with_the_same_name(self):
+        with expect.error_to_happen(ValueError):
+            cluster_names('MONGO_STORAGE_URI', [
+                'mongodb://a:27017/images', 'mongodb://a:27017/results',
+            ])
+        with expect.error_to_happen(ValueError):
+            cluster_names('MONGO_STORAGE_URI', [
+                'mongodb://a:27017/?replicaSet=one',
+                'mongodb://a:27017/?replicaSet=two',
+            ])
+
+    def test_checks_previous_clusters_against_current_ones(self):
+        current = {'a_27017': 'mongodb://user:new@a:27017/?replicaSet=rs'}
+        expect(cluster_names(
+            'MONGO_STORAGE_PREVIOUS_URI',
+            'mongodb://user:old@a:27017/?replicaSet=rs',
+            current=current
+        )).to_equal({'a_27017': 'mongodb://user:old@a:27017/?replicaSet=rs'})
+        with expect.error_to_happen(ValueError):
+            cluster_names(
+                'MONGO_STORAGE_PREVIOUS_URI',
+                'mongodb://a:27017/?replicaSet=other', current=current
+            )
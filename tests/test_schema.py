@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+from datetime import datetime
+from unittest import TestCase, mock
+
+from preggy import expect
+
+from thumbor_mongodb.mongodb.migration import SchemaMigrator, unchanged
+from thumbor_mongodb.mongodb.schema import Schema, expand, file_ids
+
+DOC = {
+    '_id': 1,
+    'path': 's.glbimg.com/some/image.jpg',
+    'created_at': datetime(2020, 1, 1),
+    'accessed_at': datetime(2020, 1, 2),
+    'file_id': 2,
+    'content_type': 'image/jpeg',
+    'content_length': 7339,
+    'metadata': {},
+    'crypto': None,
+}
+
+VARIANTS_DOC = {
+    '_id': 1,
+    'key': 'variants:/unsafe/image.jpg',
+    'created_at': datetime(2020, 1, 1),
+    'variants': {
+        'webp': {
+            'file_id': 2,
+            'created_at': datetime(2020, 1, 1),
+            'content_type': 'image/webp',
+            'content_length': 100,
+        },
+        'original': {
+            'file_id': 3,
+            'created_at': datetime(2020, 1, 1),
+            'content_type': 'image/jpeg',
+            'content_length': 200,
+        },
+    },
+    'missing': ['avif'],
+}
+
+
+class SchemaTestCase(TestCase):
+    def test_version_1_keeps_documents(self):
+        schema = Schema(1)
+        expect(schema.compact(DOC)).to_equal(DOC)
+        expect(schema.field('created_at')).to_equal('created_at')
+        expect(schema.gridfs_metadata(DOC)).to_equal(DOC)
+
+    def test_version_2_compacts_documents(self):
+        schema = Schema(2)
+        expect(schema.compact(DOC)).to_equal({
+            'v': 2,
+            '_id': 1,
+            'p': 's.glbimg.com/some/image.jpg',
+            'c': datetime(2020, 1, 1),
+            'accessed_at': datetime(2020, 1, 2),
+            'f': 2,
+            't': 0,
+            'l': 7339,
+        })
+        expect(schema.gridfs_metadata(DOC)).to_be_null()
+
+    def test_expand_reads_both_versions(self):
+        compacted = Schema(2).compact(DOC)
+        expanded = {
+            name: value for name, value in DOC.items()
+            if value is not None and value != {}
+        }
+        expect(expand(compacted)).to_equal(expanded)
+        expect(expand(DOC)).to_equal(DOC)
+        expect(expand(None)).to_be_null()
+
+    def test_keeps_unknown_mimetypes(self):
+        doc = Schema(2).compact({'content_type': 'image/x-unknown'})
+        expect(doc['t']).to_equal('image/x-unknown')
+        expect(expand(doc)['content_type']).to_equal('image/x-unknown')
+
+    def test_filter_uses_stored_names(self):
+        expect(Schema(2).filter({'key': 'a', 'key_hash': 1})).to_equal({
+            'k': 'a', 'kh': 1,
+        })
+
+    def test_rejects_unknown_version(self):
+        with self.assertRaises(ValueError):
+            Schema(3)
+
+    def test_compacts_nested_variants(self):
+        compacted = Schema(2).compact(VARIANTS_DOC)
+        expect(compacted['vr']['webp']).to_equal({
+            'f': 2, 'c': datetime(2020, 1, 1), 't': 3, 'l': 100,
+        })
+        expect(compacted['ms']).to_equal(['avif'])
+        expect(expand(compacted)).to_equal(VARIANTS_DOC)
+
+    def test_expands_projections(self):
+        projected = {'_id': 1, 'f': 2, 'c': datetime(2020, 1, 1)}
+        expect(Schema(2).expand(projected)).to_equal({
+            '_id': 1, 'file_id': 2, 'created_at': datetime(2020, 1, 1),
+        })
+        expect(Schema(1).expand(DOC)).to_equal(DOC)
+
+    def test_lists_file_ids(self):
+        expect(file_ids(DOC)).to_equal([2])
+        expect(file_ids(VARIANTS_DOC)).to_equal([2, 3])
+        expect(file_ids({'_id': 1})).to_equal([])
+
+
+class SchemaMigratorTestCase(TestCase):
+    def migrator(self, *batches):
+        collection = mock.MagicMock()
+        collection.find.return_value.sort.return_value.limit.return_value \
+            .to_list = mock.AsyncMock(side_effect=list(batches))
+        collection.bulk_write = mock.AsyncMock()
+        on_done = mock.AsyncMock()
+        migrator = SchemaMigrator(
+            mock.MagicMock(), collection, Schema(2), 10, 0, on_done=on_done
+        )
+        return migrator, on_done
+
+    def test_calls_on_done_once_nothing_is_left(self):
+        migrator, on_done = self.migrator([], [])
+        expect(asyncio.run(migrator.migrate())).to_equal(0)
+        expect(asyncio.run(migrator.migrate())).to_equal(0)
+        on_done.assert_awaited_once()
+
+    def test_does_not_call_on_done_after_a_migrated_pass(self):
+        migrator, on_done = self.migrator([{'_id': 1, 'path': 'a'}], [])
+        expect(asyncio.run(migrator.migrate())).to_equal(1)
+        expect(asyncio.run(migrator.migrate())).to_equal(0)
+        on_done.assert_not_awaited()
+
+    def test_only_replaces_unchanged_documents(self):
+        doc = {
+            '_id': 1, 'path': 'a', 'accessed_at': datetime(2020, 1, 1),
+            'metadata': {'a': 1},
+        }
+        migrator, _ = self.migrator([doc])
+        asyncio.run(migrator.migrate())
+
+        operation, = migrator.collection.bulk_write.call_args[0][0]
+        expect(operation._filter).to_equal(unchanged(doc))
+        expect(unchanged(doc)).to_include('hits')
+        expect(unchanged(doc)['hits']).to_equal({'$exists': False})
+        expect(unchanged(doc)['accessed_at']).to_equal(datetime(2020, 1, 1))
+        expect(unchanged(doc)['metadata']).to_equal({'a': 1})
+        expect(unchanged(doc)['v']).to_equal({'$exists': False})
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+import io
+import os
+import tempfile
+from datetime import datetime
+from functools import partial
+from unittest import TestCase
+
+from bson.objectid import ObjectId
+import mock
+from preggy import expect
+
+from tests.fixtures.fixtures import IMAGE_BYTES
+from thumbor_mongodb.transfer import (
+    ArchiveSource, Checkpoint, Entry, FileResultStorageSource, MongoSource,
+    Progress, export_entries, file_result_storage_paths, file_storage_path,
+    import_entries, legacy_result_key, read_bytes, walk
+)
+
+
+class ListSource:
+    name = 'list'
+
+    def __init__(self, entries):
+        self.list = entries
+
+    async def entries(self, after=None):
+        for entry in self.list:
+            if after is None or entry.position > after:
+                yield entry
+
+
+class FakeStorage:
+    variants_enabled = False
+
+    def __init__(self):
+        self.stored = {}
+
+    async def put_stream(self, path, chunks, length_hint=None):
+        if path == 'broken':
+            raise RuntimeError('broken')
+        self.stored[path] = b''.join([chunk async for chunk in chunks])
+
+    async def put_detector_data(self, path, data):
+        self.stored[f"{path}:detectors"] = data
+
+    async def store(self, key, image_bytes, metadata=None, content_type=None):
+        self.stored[key] = (image_bytes, metadata)
+
+
+def entry(position, kind, key, contents=IMAGE_BYTES, **fields):
+    return Entry(
+        position, kind, key, len(contents), partial(read_bytes, contents),
+        fields
+    )
+
+
+class PathsTestCase(TestCase):
+    def test_file_storage_path(self):
+        expect(file_storage_path('/data', 'image.jpg')).to_equal(
+            '/data/42/573d7391a7bc9dcdef39375562aa088c386c85'
+        )
+
+    def test_file_result_storage_paths(self):
+        paths = file_result_storage_paths('/data', '/unsafe/image.jpg')
+        expect([key for key, _ in paths]).to_equal([
+            'result:/unsafe/image.jpg', 'result:/unsafe/image.jpg/webp'
+        ])
+        expect(paths[0][1].startswith('/data/default/')).to_be_true()
+        expect(paths[1][1].startswith('/data/auto_webp/')).to_be_true()
+
+    def test_legacy_result_key(self):
+        expect(legacy_result_key('un/sa/unsafe/image.jpg')).to_equal(
+            'result:/unsafe/image.jpg'
+        )
+        expect(legacy_result_key('webp/un/sa/unsafe/image.jpg')).to_equal(
+            'result:/unsafe/image.jpg/webp'
+        )
+        expect(legacy_result_key('default/12/34/5678')).to_be_null()
+        expect(legacy_result_key('un/sa')).to_be_null()
+
+
+class WalkTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for relative in ('b/y', 'a', 'b/x/2', 'b/x/1', 'c'):
+            filename = os.path.join(self.root, relative)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            open(filename, 'w').close()
+
+    def test_walks_in_path_order(self):
+        expect(list(walk(self.root))).to_equal(
+            ['a', 'b/x/1', 'b/x/2', 'b/y', 'c']
+        )
+
+    def test_resumes_after_a_path(self):
+        expect(list(walk(self.root, 'b/x/1'))).to_equal(
+            ['b/x/2', 'b/y', 'c']
+        )
+        expect(list(walk(self.root, 'b/y'))).to_equal(['c'])
+
+
+class SourcesTestCase(TestCase):
+    def test_results_of_a_url_have_their_own_positions(self):
+        root = tempfile.mkdtemp()
+        urls = os.path.join(root, 'urls.txt')
+        with open(urls, 'w') as urls_file:
+            urls_file.write('/unsafe/image.jpg\n')
+        for _, filename in file_result_storage_paths(
+            root, '/unsafe/image.jpg'
+        ):
+            os.makedirs(os.path.dirname(filename))
+            open(filename, 'w').close()
+
+        async def positions(after=None):
+            source = FileResultStorageSource(root, urls)
+            return [entry.position async for entry in source.entries(after)]
+
+        expect(asyncio.run(positions())).to_equal([(1, 0), (1, 1)])
+        expect(asyncio.run(positions([1, 0]))).to_equal([(1, 1)])
+        expect(asyncio.run(positions([1, 1]))).to_equal([])
+
+    def test_yields_multi_variant_documents_without_chunks(self):
+        class Cursor:
+            def sort(self, *args):
+                return self
+
+            async def __aiter__(self):
+                yield {'_id': 1, 'k': 'result:/a', 'v': 2, 'vr': {}}
+                yield {'_id': 2, 'k': 'result:/b', 'v': 2, 'f': 3}
+
+        collection = mock.Mock()
+        collection.find.return_value = Cursor()
+
+        async def entries():
+            source = MongoSource('mongodb', collection, None)
+            return [entry async for entry in source.entries()]
+
+        first, second = asyncio.run(entries())
+        expect(first.key).to_equal('result:/a')
+        expect(first.chunks).to_be_null()
+        expect(second.chunks).not_to_be_null()
+
+
+class CheckpointTestCase(TestCase):
+    def setUp(self):
+        self.filename = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+
+    def test_moves_past_contiguous_entries(self):
+        checkpoint = Checkpoint(None, 'source')
+        first, second, third = (checkpoint.start(i) for i in (1, 2, 3))
+
+        checkpoint.done(second)
+        expect(checkpoint.position).to_be_null()
+        checkpoint.done(first)
+        expect(checkpoint.position).to_equal(2)
+        checkpoint.done(third)
+        expect(checkpoint.position).to_equal(3)
+
+    def test_saves_and_loads_positions(self):
+        position = ObjectId()
+        checkpoint = Checkpoint(self.filename, 'source')
+        checkpoint.done(checkpoint.start(position))
+        checkpoint.save()
+
+        expect(Checkpoint(self.filename, 'source').position).to_equal(
+            position
+        )
+        with expect.error_to_happen(ValueError):
+            Checkpoint(self.filename, 'other')
+
+
+class ProgressTestCase(TestCase):
+    def test_reports_throughput(self):
+        now = [0]
+        progress = Progress(clock=lambda: now[0])
+        progress.entries = 20
+        progress.bytes = 4 * 1024 * 1024
+        now[0] = 2
+
+        expect(progress.report()).to_equal(
+            '20 entries, 4.0 MB, 0 errors, 0 skipped, 10.0 entries/s, '
+            '2.00 MB/s'
+        )
+
+
+class TransferTestCase(TestCase):
+    def test_imports_entries_and_reports_failures(self):
+        storage = FakeStorage()
+        results = FakeStorage()
+        source = ListSource([
+            entry(1, 'storage', 'image.png', detector_data=[{'x': 1}]),
+            entry(2, 'storage', 'broken'),
+            entry(
+                3, 'result_storage', 'result:/image.png', metadata={'0': 'a'}
+            ),
+        ])
+        checkpoint = Checkpoint(None, source.name)
+        progress = Progress()
+        out = io.StringIO()
+
+        asyncio.run(import_entries(
+            {'storage': storage, 'result_storage': results},
+            source, checkpoint, 2, progress, out
+        ))
+
+        expect(storage.stored).to_equal({
+            'image.png': IMAGE_BYTES,
+            'image.png:detectors': [{'x': 1}],
+        })
+        expect(results.stored).to_equal({
+            'result:/image.png': (IMAGE_BYTES, {'0': 'a'}),
+        })
+        expect(progress.entries).to_equal(2)
+        expect(progress.errors).to_equal(1)
+        expect(progress.bytes).to_equal(len(IMAGE_BYTES) * 2)
+        expect(out.getvalue()).to_include('storage broken')
+        expect(checkpoint.position).to_equal(1)
+
+    def test_resumed_import_retries_failed_entries(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+        storage = FakeStorage()
+        source = ListSource([
+            entry(1, 'storage', 'a'),
+            entry(2, 'storage', 'broken'),
+            entry(3, 'storage', 'b'),
+        ])
+
+        checkpoint = Checkpoint(filename, source.name)
+        asyncio.run(import_entries(
+            {'storage': storage}, source, checkpoint, 2, Progress(),
+            io.StringIO()
+        ))
+        checkpoint.save()
+        expect(storage.stored).not_to_include('broken')
+
+        source.list[1] = entry(2, 'storage', 'fixed')
+        progress = Progress()
+        asyncio.run(import_entries(
+            {'storage': storage}, source, Checkpoint(filename, source.name),
+            2, progress, io.StringIO()
+        ))
+
+        expect(storage.stored).to_include('fixed')
+        expect(progress.entries).to_equal(2)
+        expect(progress.errors).to_equal(0)
+
+    def test_skips_entries_without_chunks(self):
+        results = FakeStorage()
+        source = ListSource([
+            Entry(1, 'result_storage', 'result:/a', None, None, {}),
+            entry(2, 'result_storage', 'result:/b'),
+        ])
+        progress = Progress()
+        out = io.StringIO()
+
+        asyncio.run(import_entries(
+            {'result_storage': results}, source,
+            Checkpoint(None, source.name), 2, progress, out
+        ))
+        expect(list(results.stored)).to_equal(['result:/b'])
+        expect(progress.skipped).to_equal(1)
+        expect(progress.errors).to_equal(0)
+        expect(out.getvalue()).to_include('result_storage result:/a')
+
+        progress = Progress()
+        asyncio.run(export_entries(
+            [source], io.BytesIO(), 2, progress, out=out
+        ))
+        expect(progress.entries).to_equal(1)
+        expect(progress.skipped).to_equal(1)
+
+    def test_exported_archive_can_be_imported(self):
+        source = ListSource([
+            entry(
+                1, 'storage', 'http://host/image.png',
+                created_at=datetime(2020, 1, 1), content_type='image/png',
+                detector_data=[{'x': 1}],
+            ),
+            entry(2, 'result_storage', 'result:/a/b', b'result'),
+        ])
+        archive = io.BytesIO()
+        progress = Progress()
+        asyncio.run(export_entries([source], archive, 2, progress))
+        expect(progress.entries).to_equal(2)
+
+        filename = os.path.join(tempfile.mkdtemp(), 'export.tar')
+        with open(filename, 'wb') as archive_file:
+            archive_file.write(archive.getvalue())
+
+        async def read():
+            return [item async for item in ArchiveSource(filename).entries()]
+
+        entries = asyncio.run(read())
+        expect([(e.kind, e.key) for e in entries]).to_equal([
+            ('storage', 'http://host/image.png'),
+            ('result_storage', 'result:/a/b'),
+        ])
+        expect(entries[0].length).to_equal(len(IMAGE_BYTES))
+        expect(entries[0].fields).to_equal({
+            'content_type': 'image/png', 'detector_data': [{'x': 1}],
+        })
+        expect(entries[1].fields).to_equal({})
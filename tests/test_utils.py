@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# thumbor imaging service
+# https://github.com/thumbor/thumbor/wiki
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+from unittest import TestCase
+
+from preggy import expect
+
+from thumbor_mongodb.utils import (
+    AUTO_CHUNK_SIZE_LIMIT, get_chunk_size, key_hash
+)
+
+
+class GetChunkSizeTestCase(TestCase):
+    def test_uses_bucket_default_when_not_configured(self):
+        expect(get_chunk_size(1024)).to_be_null()
+
+    def test_uses_fixed_chunk_size(self):
+        expect(get_chunk_size(1024, 512)).to_equal(512)
+
+    def test_auto_stores_small_files_in_one_chunk(self):
+        expect(get_chunk_size(7339, 'auto')).to_equal(7339)
+        expect(get_chunk_size(0, 'auto')).to_equal(1)
+
+    def test_auto_splits_big_files_evenly(self):
+        length = AUTO_CHUNK_SIZE_LIMIT * 2 + 2
+        chunk_size = get_chunk_size(length, 'auto')
+        expect(chunk_size).to_be_lesser_or_equal_to(AUTO_CHUNK_SIZE_LIMIT)
+        expect(-(-length // chunk_size)).to_equal(3)
+
+    def test_uses_size_classes(self):
+        size_classes = [(4096, 4096), (65536, 16384), (None, 65536)]
+        expect(get_chunk_size(100, 'auto', size_classes)).to_equal(4096)
+        expect(get_chunk_size(5000, None, size_classes)).to_equal(16384)
+        expect(get_chunk_size(10 ** 6, None, size_classes)).to_equal(65536)
+        expect(get_chunk_size(10 ** 6, None, [(4096, 4096)])).to_be_null()
+
+
+class KeyHashTestCase(TestCase):
+    def test_is_stable_signed_64_bit_int(self):
+        value = key_hash("result:localhost/unsafe/100x100/image.jpg")
+        expect(value).to_equal(
+            key_hash("result:localhost/unsafe/100x100/image.jpg")
+        )
+        expect(-2 ** 63 <= value < 2 ** 63).to_be_true()
+
+    def test_spreads_keys_sharing_a_prefix(self):
+        values = {
+            key_hash(f"result:localhost/unsafe/{i}x{i}/image.jpg") >> 60
+            for i in range(100)
+        }
+        expect(len(values)).to_be_greater_than(8)
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+'''Check the query plans of the MongoDB adapters.
+
+Runs ``explain()`` on every lookup of the storages enabled in a thumbor
+configuration, against every cluster and schema they read, and exits with a
+non-zero status if a plan scans the collection, or if a lookup expected to
+be covered by its index fetches documents.
+
+Usage::
+
+    thumbor-mongodb-explain -c thumbor.conf [-k KEY] [--drop-obsolete]
+'''
+
+import argparse
+import asyncio
+import sys
+from importlib import import_module
+
+from thumbor.config import Config
+from thumbor.context import Context
+from thumbor_mongodb.mongodb.plans import plan_stages
+
+STORAGES = {
+    'STORAGE': 'thumbor_mongodb.storages.mongo_storage',
+    'RESULT_STORAGE': 'thumbor_mongodb.result_storages.mongo_result_storage',
+}
+
+
+def check_plan(explain, covered):
+    '''Return the problems found in the winning plan of an explain output.
+    :param dict explain: Output of ``explain()``
+    :param bool covered: Whether the lookup should not fetch documents
+    :rtype: list
+    '''
+
+    stages = set(plan_stages(explain['queryPlanner']['winningPlan']))
+    problems = []
+    if 'COLLSCAN' in stages:
+        problems.append('COLLSCAN')
+    if covered and 'FETCH' in stages:
+        problems.append('FETCH')
+    return problems
+
+
+async def explain_storage(storage, key, covered_lookups, out=sys.stdout):
+    '''Explain every lookup of a storage and report its problems.
+    :returns: Number of lookups with problems
+    :rtype: int
+    '''
+
+    failures = 0
+    for cluster, connector in storage.router.connectors.items():
+        await connector.indexes_ready
+        for operation, (names, conditions) in storage.lookups().items():
+            covered = operation in covered_lookups
+            lookups = connector.lookups(key, names, **conditions)
+            for schema, query, projection in lookups:
+                explain = await connector.col_conn.find(
+                    query, projection
+                ).limit(1).explain()
+                problems = check_plan(explain, covered)
+                failures += bool(problems)
+                print(
+                    f"{type(storage).__module__} {cluster} {operation} "
+                    f"v{schema.version}: {', '.join(problems) or 'OK'}",
+                    file=out
+                )
+    return failures
+
+
+async def sync_indexes(storage):
+    '''Create the index set of a storage and drop its obsolete indexes.'''
+
+    for connector in storage.router.connectors.values():
+        await connector.indexes_ready
+        await connector.ensure_index(force=True)
+
+
+async def run(config, key, drop_obsolete=False):
+    context = Context(config=config)
+    failures = 0
+    checked = 0
+    for option, module_name in STORAGES.items():
+        if config.get(option) != module_name:
+            continue
+
+        module = import_module(module_name)
+        storage = module.Storage(context)
+        if drop_obsolete:
+            await sync_indexes(storage)
+        failures += await explain_storage(
+            storage, key, module.COVERED_LOOKUPS
+        )
+        checked += 1
+
+    if not checked:
+        print("No MongoDB storage is enabled in this configuration")
+        return 2
+    return 1 if failures else 0
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-c', '--conf', required=True, help='thumbor configuration file'
+    )
+    parser.add_argument(
+        '-k', '--key', default='thumbor-mongodb-explain',
+        help='path or key used in the explained queries'
+    )
+    parser.add_argument(
+        '--drop-obsolete', action='store_true',
+        help='create the index set and drop the indexes that left it first'
+    )
+    options = parser.parse_args(args)
+
+    config = Config.load(options.conf)
+    sys.exit(asyncio.run(run(config, options.key, options.drop_obsolete)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import hmac
+import json
+
+from thumbor.handlers import ContextHandler
+from thumbor.utils import logger
+from thumbor_mongodb.mongodb.profiler import get_profiler
+
+DEFAULT_PROFILER_ROUTE = '/mongodb/profile'
+
+
+class ProfilerHandler(ContextHandler):
+    '''Serve the profiler report to requests bearing the profiler token.'''
+
+    def is_authorized(self):
+        token = self.context.config.get('MONGO_PROFILER_TOKEN')
+        header = self.request.headers.get('Authorization', '')
+        scheme, _, sent = header.partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(
+            sent.encode(), token.encode()
+        )
+
+    async def get(self):
+        if not self.is_authorized():
+            self.set_status(401)
+            self.set_header('WWW-Authenticate', 'Bearer')
+            return
+
+        profiler = get_profiler(self.context.config)
+        count = self.get_argument('hot_keys', '')
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(
+            profiler.report(int(count) if count.isdigit() else None),
+            default=str
+        ))
+
+
+def get_handlers(context):
+    '''Return the profiler report handler, when the profiler is enabled.
+
+    The report lists image keys, so it is only served with a token.
+    '''
+
+    config = context.config
+    if not config.get('MONGO_PROFILER_ENABLED', False):
+        return []
+    if not config.get('MONGO_PROFILER_TOKEN'):
+        logger.warning(
+            "[MONGODB_PROFILER] MONGO_PROFILER_TOKEN is not set, the "
+            "profiler report is not served"
+        )
+        return []
+    return [
+        (config.get('MONGO_PROFILER_ROUTE', DEFAULT_PROFILER_ROUTE),
+         ProfilerHandler, {'context': context}),
+    ]
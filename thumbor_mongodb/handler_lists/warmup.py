@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+from tornado.ioloop import IOLoop
+from thumbor.utils import logger
+
+
+async def warm_up(context):
+    '''Preload the local caches of the configured MongoDB storages.
+    :returns: Number of entries loaded
+    :rtype: int
+    '''
+
+    loaded = 0
+    for storage in (context.modules.storage, context.modules.result_storage):
+        if hasattr(storage, 'warm_up'):
+            loaded += await storage.warm_up()
+    logger.info(f"[MONGODB_CACHE_WARMER] {loaded} entries preloaded")
+    return loaded
+
+
+def get_handlers(context):
+    '''Warm up the local caches when the worker starts, adding no route.
+
+    Handler lists are read before thumbor forks its workers, so the warm up
+    is only scheduled here, and runs in each worker once its loop starts.
+    '''
+
+    IOLoop.current().add_callback(warm_up, context)
+    return []
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+from collections import OrderedDict
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
+from thumbor.utils import logger
+from thumbor_mongodb.mongodb.schema import FIELDS, expand
+
+
+class LocalCache:
+    '''Process local LRU cache bounded by the total size of its values.'''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value, size):
+        '''Store a value, evicting least recently used ones to make room.
+        :param string key: Cache key
+        :param value: Value to store
+        :param int size: Size accounted for the value, in bytes
+        :returns: Whether the value was stored
+        :rtype: bool
+        '''
+
+        if size > self.max_bytes:
+            return False
+
+        self.delete(key)
+        self.entries[key] = (size, value)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+        return True
+
+    def delete(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[0]
+
+
+class CacheWarmer:
+    '''Preload the most popular entries of a collection into a LocalCache.
+
+    The top entries by sampled ``hits`` are selected with one query, their
+    sizes with another, and every chunk of the selected files is streamed
+    with a single cursor sorted by ``(files_id, n)``.
+    '''
+
+    def __init__(self, database, collection, cache, key_field, build_value):
+        self.database = database
+        self.collection = collection
+        self.cache = cache
+        self.key_field = key_field
+        self.build_value = build_value
+
+    async def warm_up(self, count, max_bytes, timeout):
+        '''Load up to ``count`` entries within ``max_bytes`` and ``timeout``.
+        :returns: Number of entries loaded
+        :rtype: int
+        '''
+
+        loaded = []
+        try:
+            await asyncio.wait_for(
+                self.load(count, max_bytes, loaded), timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning("[MONGODB_CACHE_WARMER] warm up timed out")
+        except PyMongoError as exc:
+            logger.error(f"[MONGODB_CACHE_WARMER] {exc}")
+
+        logger.debug(f"[MONGODB_CACHE_WARMER] loaded {len(loaded)} entries")
+        return len(loaded)
+
+    async def load(self, count, max_bytes, loaded):
+        await self.collection.create_index(
+            [('hits', DESCENDING)],
+            name='hits_-1'
+        )
+        docs = await self.collection.find({
+            'hits': {'$gt': 0},
+            '$or': [
+                {self.key_field: {'$exists': True}},
+                {FIELDS[self.key_field]: {'$exists': True}},
+            ],
+        }).sort('hits', DESCENDING).limit(count).to_list(length=count)
+        docs = [expand(doc) for doc in docs]
+
+        popular = {}
+        for doc in docs:
+            key = doc.get(self.key_field)
+            if key not in popular and 'file_id' in doc:
+                popular[key] = doc
+
+        files = await self.database['fs.files'].find({
+            '_id': {'$in': [doc['file_id'] for doc in popular.values()]}
+        }, {'length': True}).to_list(length=None)
+        lengths = {f['_id']: f['length'] for f in files}
+
+        budget = min(max_bytes, self.cache.max_bytes)
+        selected = {}
+        for doc in popular.values():
+            length = lengths.get(doc['file_id'])
+            if length is not None and length <= budget:
+                budget -= length
+                selected[doc['file_id']] = doc
+
+        if not selected:
+            return
+
+        cursor = self.database['fs.chunks'].find({
+            'files_id': {'$in': list(selected)}
+        }, {
+            'files_id': True,
+            'data': True,
+        }).sort([('files_id', ASCENDING), ('n', ASCENDING)])
+
+        file_id, buffer = None, bytearray()
+        async for chunk in cursor:
+            if chunk['files_id'] != file_id:
+                self.store(selected.get(file_id), buffer, loaded)
+                file_id, buffer = chunk['files_id'], bytearray()
+            buffer += chunk['data']
+        self.store(selected.get(file_id), buffer, loaded)
+
+    def store(self, doc, buffer, loaded):
+        if doc is None:
+            return
+
+        key = doc[self.key_field]
+        value = self.build_value(doc, bytes(buffer))
+        if self.cache.set(key, value, len(buffer)):
+            loaded.append(key)
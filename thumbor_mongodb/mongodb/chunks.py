@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import struct
+
+from bson.raw_bson import RawBSONDocument
+from gridfs.errors import CorruptGridFile, NoFile
+from pymongo import ASCENDING
+
+INT32 = struct.Struct('<i')
+# Chunks are projected on ``data`` alone, so it is their only element.
+DATA_ELEMENT = b'\x05data\x00'
+# Document size, element header, then the binary length and subtype.
+DATA_OFFSET = 4 + len(DATA_ELEMENT) + INT32.size + 1
+
+
+def chunk_payloads(batch):
+    '''Yield the payload of each chunk document of a raw batch.
+
+    Payloads are memoryviews over the batch, nothing is decoded or copied.
+
+    :param bytes batch: Concatenated BSON chunk documents, projected on
+        ``data``
+    :rtype: generator
+    '''
+
+    view = memoryview(batch)
+    offset = 0
+    while offset < len(view):
+        size, = INT32.unpack_from(view, offset)
+        start = offset + 4
+        if view[start:start + len(DATA_ELEMENT)] == DATA_ELEMENT:
+            length, = INT32.unpack_from(view, start + len(DATA_ELEMENT))
+            start = offset + DATA_OFFSET
+            yield view[start:start + length]
+        else:
+            # Not the layout projected, let bson find the field.
+            yield RawBSONDocument(bytes(view[offset:offset + size]))['data']
+        offset += size
+
+
+class ChunkAssembler:
+    '''Assemble the chunk payloads of a file of known length.
+
+    Payloads are checked against the length as they arrive, and copied once
+    into a single allocation of that length.
+    '''
+
+    def __init__(self, file_id, length):
+        self.file_id = file_id
+        self.length = length
+        self.position = 0
+        self.payloads = []
+
+    def add(self, payload):
+        self.position += len(payload)
+        if self.position > self.length:
+            raise CorruptGridFile(
+                f"chunks of file {self.file_id} exceed its {self.length} bytes"
+            )
+        self.payloads.append(payload)
+
+    def contents(self):
+        '''Return the file contents.
+        :raises NoFile: When chunks are missing, as when the file is removed
+            while being read
+        :rtype: bytes
+        '''
+
+        if self.position != self.length:
+            raise NoFile(
+                f"file {self.file_id} has {self.position} of its "
+                f"{self.length} bytes"
+            )
+        contents = b''.join(self.payloads)
+        self.payloads = []
+        return contents
+
+
+class ChunkReader:
+    '''Read GridFS files from raw batches of their chunk documents.
+
+    When the file length is known from the index document, this skips the
+    ``fs.files`` lookup and the per chunk document decoding of
+    ``GridOut``. Files of unknown length are read with the bucket.
+    '''
+
+    def __init__(self, database, bucket):
+        self.chunks = database['fs.chunks']
+        self.bucket = bucket
+
+    async def read(self, file_id, length=None):
+        '''Return the contents of a file.
+        :param file_id: GridFS file id
+        :param int length: File length in bytes, if known
+        :raises NoFile: When the file does not exist
+        :rtype: bytes
+        '''
+
+        if length is None:
+            grid_out = await self.bucket.open_download_stream(file_id)
+            return await grid_out.read()
+
+        assembler = ChunkAssembler(file_id, length)
+        cursor = self.chunks.find_raw_batches(
+            {'files_id': file_id}, {'_id': False, 'data': True},
+            sort=[('n', ASCENDING)]
+        )
+        async for batch in cursor:
+            for payload in chunk_payloads(batch):
+                assembler.add(payload)
+        return assembler.contents()
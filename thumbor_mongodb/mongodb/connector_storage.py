@@ -3,25 +3,39 @@
 # http://www.opensource.org/licenses/mit-license
 # Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
 
-from motor.motor_tornado import MotorClient
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, HASHED
+from pymongo.errors import PyMongoError
+from thumbor.utils import logger
 from tornado.gen import convert_yielded
+from thumbor_mongodb.mongodb.cache import CacheWarmer, LocalCache
+from thumbor_mongodb.mongodb.chunks import ChunkReader
+from thumbor_mongodb.mongodb.driver import get_driver
+from thumbor_mongodb.mongodb.eviction import AccessTracker, LRUEvictor
+from thumbor_mongodb.mongodb.indexes import IndexManager, covering_indexes
+from thumbor_mongodb.mongodb.lease import DEFAULT_LEASE_COLLECTION
+from thumbor_mongodb.mongodb.migration import (
+    SchemaMigrator, is_migrated, mark_migrated
+)
+from thumbor_mongodb.mongodb.pipeline import OrphanSweeper, PutPipeline
+from thumbor_mongodb.mongodb.schema import SCHEMA_VERSION, Schema
+from thumbor_mongodb.utils import key_hash
 
 
 class Singleton(type):
     """
     Define an Instance operation that lets clients access its unique
-    instance.
+    instance for a given set of arguments.
     """
 
     def __init__(cls, name, bases, attrs, **kwargs):
         super().__init__(name, bases, attrs)
-        cls._instance = None
+        cls._instances = {}
 
     def __call__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super().__call__(*args, **kwargs)
-        return cls._instance
+        key = (args, tuple(sorted(kwargs.items())))
+        if key not in cls._instances:
+            cls._instances[key] = super().__call__(*args, **kwargs)
+        return cls._instances[key]
 
 
 class MongoConnector(metaclass=Singleton):
@@ -31,31 +45,308 @@ class MongoConnector(metaclass=Singleton):
                  host=None,
                  port=None,
                  db_name=None,
-                 col_name=None):
+                 col_name=None,
+                 hashed_key=False,
+                 driver=None,
+                 schema_version=1,
+                 legacy_reads=True):
         self.uri = uri
         self.host = host
         self.port = port
         self.db_name = db_name
         self.col_name = col_name
+        self.hashed_key = hashed_key
+        self.client_class, self.bucket_class = get_driver(driver)
+        self.schema = Schema(schema_version)
+        # Newest layout first, older ones are still read until migrated.
+        self.schemas = [self.schema]
+        if self.schema.version > 1:
+            self.schemas.append(Schema(1))
+        self.read_schemas = self.schemas if legacy_reads else [self.schema]
+        self.access_tracker = None
+        self.evictor = None
+        self.migrator = None
+        self.sweeper = None
+        self.local_cache = None
         self.db_conn, self.col_conn = self.create_connection()
-        convert_yielded(self.ensure_index())
+        self.fs = self.bucket_class(self.db_conn)
+        self.reader = ChunkReader(self.db_conn, self.fs)
+        self.pipeline = PutPipeline(
+            self.db_conn, self.col_conn,
+            file_field=self.schema.field('file_id')
+        )
+        self.indexes_ready = convert_yielded(self.ensure_index())
+        if len(self.read_schemas) > 1:
+            convert_yielded(self.check_migration())
 
     def create_connection(self):
         if self.uri:
-            connection = MotorClient(self.uri)
+            connection = self.client_class(self.uri)
         else:
-            connection = MotorClient(self.host, self.port)
+            connection = self.client_class(self.host, self.port)
 
         db_conn = connection[self.db_name]
         col_conn = db_conn[self.col_name]
 
         return db_conn, col_conn
 
-    async def ensure_index(self):
-        index_name = 'path_1_created_at_-1'
-        indexes = await self.col_conn.index_information()
-        if index_name not in indexes:
-            await self.col_conn.create_index(
-                [('path', ASCENDING), ('created_at', DESCENDING)],
-                name=index_name
+    def key_fields(self, path):
+        '''Return the version 1 fields identifying the documents of a path.
+        :param string path: Image path
+        :rtype: dict
+        '''
+
+        fields = {'path': path}
+        if self.hashed_key:
+            fields['path_hash'] = key_hash(path)
+        return fields
+
+    def query(self, path, **conditions):
+        '''Return the filter matching the index documents of a path.
+
+        With ``hashed_key`` the filter also targets the ``path_hash``
+        field, so it is routed to a single shard when the collection is
+        sharded on it. While older schemas are read, one branch per schema
+        is combined with ``$or``.
+
+        :param string path: Image path
+        :param conditions: Extra conditions on version 1 field names
+        :rtype: dict
+        '''
+
+        conditions.update(self.key_fields(path))
+        branches = [schema.filter(conditions) for schema in self.schemas]
+        if len(branches) == 1:
+            return branches[0]
+        return {'$or': branches}
+
+    def lookups(self, path, names, **conditions):
+        '''Return the filter and projection of a lookup in every schema.
+
+        Each schema is queried on its own, newest first, so the projection
+        only names fields of the index covering that schema.
+
+        :param string path: Image path
+        :param list names: Version 1 names of the projected fields
+        :param conditions: Extra conditions on version 1 field names
+        :returns: ``(schema, filter, projection)`` tuples
+        :rtype: list
+        '''
+
+        conditions.update(self.key_fields(path))
+        return [(
+            schema,
+            schema.filter(conditions),
+            {schema.field(name): True for name in names},
+        ) for schema in self.read_schemas]
+
+    async def find_one(self, path, names, **conditions):
+        '''Return the first document found by :meth:`lookups`.
+        :returns: Document with version 1 field names, or None
+        :rtype: dict
+        '''
+
+        lookups = self.lookups(path, names, **conditions)
+        for schema, query, projection in lookups:
+            doc = await self.col_conn.find_one(query, projection)
+            if doc:
+                return schema.expand(doc)
+        return None
+
+    def projection(self, *names):
+        '''Return a projection of version 1 field names in every schema.
+        :rtype: dict
+        '''
+
+        projection = {
+            schema.field(name): True
+            for schema in self.schemas for name in names
+        }
+        projection['v'] = True
+        return projection
+
+    async def update(self, path, values):
+        '''Set fields on the index documents of a path in every schema.
+        :param string path: Image path
+        :param dict values: Values by version 1 field name
+        '''
+
+        fields = self.key_fields(path)
+        for schema in self.schemas:
+            await self.col_conn.update_many(
+                schema.filter(fields), {'$set': schema.filter(values)}
+            )
+
+    def indexes(self):
+        '''Return the managed indexes of the collection by name.
+
+        Lookups filter on the path and creation time and project the
+        file id, its length and ``_id``, so they are covered by these
+        indexes.
+
+        :rtype: dict
+        '''
+
+        fields = [
+            'path', 'created_at', 'file_id', 'content_length'
+        ]
+        if self.hashed_key:
+            fields.insert(0, 'path_hash')
+        return covering_indexes(
+            self.schemas, fields,
+            shard_key='path_hash' if self.hashed_key else None
+        )
+
+    async def ensure_index(self, force=False):
+        owned_fields = {
+            Schema(version).field(name)
+            for version in (1, SCHEMA_VERSION)
+            for name in ('path', 'path_hash')
+        }
+        await IndexManager(
+            self.db_conn, self.col_conn, f"{self.col_name}.path",
+            self.indexes(), owned_fields
+        ).sync(force)
+
+        if self.hashed_key:
+            await self.ensure_hashed_index()
+
+        chunks = self.db_conn['fs.chunks']
+        if 'files_id_1_n_1' not in await chunks.index_information():
+            await chunks.create_index(
+                [('files_id', ASCENDING), ('n', ASCENDING)],
+                name='files_id_1_n_1',
+                unique=True
+            )
+
+        files = self.db_conn['fs.files']
+        if 'filename_1_uploadDate_1' not in await files.index_information():
+            await files.create_index(
+                [('filename', ASCENDING), ('uploadDate', ASCENDING)],
+                name='filename_1_uploadDate_1'
+            )
+
+    async def ensure_hashed_index(self):
+        '''Create the GridFS indexes needed to shard on hashed keys.
+
+        ``fs.files`` and ``fs.chunks`` are sharded on ``_id`` and
+        ``files_id``, whose ObjectId values would otherwise all land on the
+        last chunk. The ``path_hash`` shard key index of the collection is
+        part of :meth:`indexes`.
+        '''
+
+        files = self.db_conn['fs.files']
+        if '_id_hashed' not in await files.index_information():
+            await files.create_index([('_id', HASHED)], name='_id_hashed')
+
+        chunks = self.db_conn['fs.chunks']
+        if 'files_id_hashed' not in await chunks.index_information():
+            await chunks.create_index(
+                [('files_id', HASHED)],
+                name='files_id_hashed'
+            )
+
+    def setup_eviction(self,
+                       sample_rate=0,
+                       flush_interval=10,
+                       max_bytes=0,
+                       interval=60,
+                       batch_size=100):
+        '''Enable access tracking and the LRU evictor once per process.
+        :param float sample_rate: Fraction of reads recorded, 0 to disable
+        :param int flush_interval: Seconds between access flushes
+        :param int max_bytes: GridFS byte budget, 0 to disable eviction
+        :param int interval: Seconds between eviction runs
+        :param int batch_size: Entries deleted per eviction batch
+        '''
+
+        if sample_rate and self.access_tracker is None:
+            self.access_tracker = AccessTracker(
+                self.col_conn, sample_rate, flush_interval
+            )
+
+        if max_bytes and self.evictor is None:
+            self.evictor = LRUEvictor(
+                self.db_conn, self.col_conn, max_bytes, interval, batch_size
+            )
+            self.evictor.start()
+
+    def setup_sweeper(self, interval=0, age=3600,
+                      lease_collection=DEFAULT_LEASE_COLLECTION):
+        '''Remove the chunks of interrupted puts once per process.
+        :param int interval: Seconds between sweeps, 0 to disable
+        :param int age: Seconds before chunks without a file are removed
+        :param string lease_collection: Collection of the sweep lease
+        '''
+
+        if interval and self.sweeper is None:
+            self.sweeper = OrphanSweeper(
+                self.db_conn, interval, age,
+                lease_collection=lease_collection
+            )
+            self.sweeper.start()
+
+    def setup_migration(self, batch_size=0, interval=1):
+        '''Migrate older index documents to the current schema.
+        :param int batch_size: Documents rewritten per batch, 0 to disable
+        :param float interval: Seconds between batches
+        '''
+
+        if self.schema.version == 1 or not batch_size:
+            return
+
+        if self.migrator is None:
+            self.migrator = SchemaMigrator(
+                self.db_conn, self.col_conn, self.schema, batch_size, interval,
+                on_done=self.migration_done
             )
+            self.migrator.start()
+
+    async def check_migration(self):
+        '''Stop reading older schemas once their documents are migrated.'''
+
+        try:
+            migrated = await is_migrated(
+                self.db_conn, self.col_name, self.schema.version
+            )
+        except PyMongoError as exc:
+            logger.error(f"[MONGODB_SCHEMA_MIGRATOR] {exc}")
+            return
+        if migrated:
+            self.read_schemas = [self.schema]
+
+    async def migration_done(self):
+        '''Record that no older document is left and stop reading them.'''
+
+        await mark_migrated(self.db_conn, self.col_name, self.schema.version)
+        self.read_schemas = [self.schema]
+
+    def setup_cache(self, max_bytes=0):
+        '''Enable the local cache tier once per process.
+        :param int max_bytes: Local cache size in bytes, 0 to disable
+        '''
+
+        if max_bytes and self.local_cache is None:
+            self.local_cache = LocalCache(max_bytes)
+
+    async def warm_up(self, count, max_bytes, timeout, build_value):
+        '''Preload the local cache with the most popular entries.
+        :param int count: Number of popular entries to preload
+        :param int max_bytes: Byte budget of the warm up, 0 for the cache size
+        :param int timeout: Seconds allowed for the warm up
+        :param callable build_value: Build a cache value from an index
+            document and its contents
+        :returns: Number of entries loaded
+        :rtype: int
+        '''
+
+        if not count or self.local_cache is None:
+            return 0
+
+        warmer = CacheWarmer(
+            self.db_conn, self.col_conn, self.local_cache, 'path',
+            build_value
+        )
+        return await warmer.warm_up(
+            count, max_bytes or self.local_cache.max_bytes, timeout
+        )
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import sys
+from importlib import import_module
+
+import motor
+
+DEFAULT_DRIVER = 'tornado'
+
+DRIVERS = {
+    'tornado': ('motor.motor_tornado', 'MotorClient', 'MotorGridFSBucket'),
+    'asyncio': (
+        'motor.motor_asyncio',
+        'AsyncIOMotorClient',
+        'AsyncIOMotorGridFSBucket',
+    ),
+}
+
+
+def get_driver(name=None):
+    '''Return the Motor client and GridFS bucket classes of a driver.
+
+    The ``tornado`` driver wraps every operation in Tornado futures, while
+    the ``asyncio`` driver returns asyncio futures directly, which is what
+    Thumbor 7 awaits anyway. Driver modules are imported on first use.
+
+    :param string name: ``tornado`` or ``asyncio``, None for the default
+    :raises ValueError: When the driver is unknown, or cannot run on this
+        Python and Motor, as ``asyncio`` with Motor 2 on Python 3.11
+    :returns: Client class and GridFS bucket class
+    :rtype: tuple
+    '''
+
+    try:
+        module_name, client_name, bucket_name = DRIVERS[name or DEFAULT_DRIVER]
+    except KeyError:
+        raise ValueError(
+            f"Unknown MongoDB driver {name!r}, use one of {sorted(DRIVERS)}"
+        ) from None
+
+    try:
+        module = import_module(module_name)
+    except ImportError as exc:
+        python = '.'.join(str(part) for part in sys.version_info[:3])
+        raise ValueError(
+            f"MongoDB driver {name!r} cannot be loaded with Motor "
+            f"{motor.version} on Python {python}: Motor 2 asyncio support "
+            f"requires Python 3.10 or older ({exc})"
+        ) from exc
+    return getattr(module, client_name), getattr(module, bucket_name)
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+import random
+from datetime import datetime
+from uuid import uuid4
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+from thumbor.utils import logger
+from thumbor_mongodb.mongodb.lease import (
+    DEFAULT_LEASE_COLLECTION, LeaseManager
+)
+from thumbor_mongodb.mongodb.schema import FIELDS, expand, file_ids
+from tornado.ioloop import IOLoop
+
+
+class AccessTracker:
+    '''Record sampled reads and flush their last access time in batches.
+
+    Only a fraction (``sample_rate``) of reads is recorded, and the recorded
+    accesses are kept in memory until the next flush, so the write load is
+    bounded by the flush interval instead of the read rate. Each flush also
+    increments the sampled ``hits`` counter used to rank popular entries.
+    '''
+
+    def __init__(self, collection, sample_rate, flush_interval):
+        self.collection = collection
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.running = False
+
+    def record(self, doc_id):
+        '''Record a read of the given index document.
+        :param ObjectId doc_id: The index document _id
+        '''
+
+        if random.random() >= self.sample_rate:
+            return
+
+        _, hits = self.pending.get(doc_id, (None, 0))
+        self.pending[doc_id] = (datetime.utcnow(), hits + 1)
+
+        if not self.running:
+            self.running = True
+            IOLoop.current().spawn_callback(self.run)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        '''Write all pending accesses with a single unordered bulk write.
+        :returns: Number of documents updated
+        :rtype: int
+        '''
+
+        if not self.pending:
+            return 0
+
+        pending, self.pending = self.pending, {}
+        requests = [
+            UpdateOne({'_id': doc_id}, {
+                '$max': {'accessed_at': accessed_at},
+                '$inc': {'hits': hits},
+            })
+            for doc_id, (accessed_at, hits) in pending.items()
+        ]
+
+        try:
+            await self.collection.bulk_write(requests, ordered=False)
+        except PyMongoError as exc:
+            logger.error(f"[MONGODB_ACCESS_TRACKER] {exc}")
+            return 0
+
+        return len(requests)
+
+
+def length_sum(field):
+    '''Return an aggregation expression summing the lengths of variants.
+    :param string field: Variants field, in either schema
+    :rtype: dict
+    '''
+
+    return {'$sum': {'$map': {
+        'input': {'$objectToArray': {'$ifNull': [f"${field}", {}]}},
+        'as': 'variant',
+        'in': {'$ifNull': [
+            '$$variant.v.content_length', {'$ifNull': ['$$variant.v.l', 0]}
+        ]},
+    }}}
+
+
+# Bytes referenced by an index document of either schema.
+STORED_LENGTH = {'$add': [
+    {'$ifNull': [
+        '$content_length', {'$ifNull': [f"${FIELDS['content_length']}", 0]}
+    ]},
+    length_sum('variants'),
+    length_sum(FIELDS['variants']),
+]}
+
+
+def stored_length(doc):
+    '''Return the bytes referenced by an expanded index document.
+    :param dict doc: Document with version 1 field names
+    :rtype: int
+    '''
+
+    return (doc.get('content_length') or 0) + sum(
+        variant.get('content_length') or 0
+        for variant in doc.get('variants', {}).values()
+    )
+
+
+class LRUEvictor:
+    '''Keep the GridFS data of a collection under a byte budget.
+
+    The budget is checked against the lengths recorded in the index
+    documents of the collection, so storages sharing the GridFS bucket of a
+    database are measured apart. Entries are evicted in batches, least
+    recently accessed first, until the excess is freed. Only the process
+    holding the eviction lease evicts at a time.
+    '''
+
+    def __init__(self, database, collection, max_bytes, interval, batch_size,
+                 lease_collection=DEFAULT_LEASE_COLLECTION, lease_seconds=300):
+        self.database = database
+        self.collection = collection
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.batch_size = batch_size
+        self.leases = LeaseManager(database[lease_collection])
+        self.lease_seconds = lease_seconds
+
+    def start(self):
+        IOLoop.current().spawn_callback(self.run)
+
+    async def run(self):
+        await self.collection.create_index(
+            [('accessed_at', ASCENDING)],
+            name='accessed_at_1'
+        )
+        await self.leases.ensure_index()
+        name = f"evict:{self.collection.name}"
+        while True:
+            await asyncio.sleep(self.interval)
+            token = uuid4().hex
+            try:
+                if not await self.leases.acquire(
+                    name, token, self.lease_seconds
+                ):
+                    continue
+                try:
+                    await self.evict()
+                finally:
+                    await self.leases.release(name, token)
+            except PyMongoError as exc:
+                logger.error(f"[MONGODB_LRU_EVICTOR] {exc}")
+
+    async def total_bytes(self):
+        '''Return the bytes referenced by the collection.
+        :returns: Size in bytes
+        :rtype: int
+        '''
+
+        totals = await self.collection.aggregate([
+            {'$group': {'_id': None, 'size': {'$sum': STORED_LENGTH}}},
+        ]).to_list(length=1)
+        return totals[0]['size'] if totals else 0
+
+    async def evict(self):
+        '''Delete least recently accessed entries until under budget.
+
+        No more entries are deleted than needed to free the excess found
+        at the start of the pass.
+
+        :returns: Number of index documents removed
+        :rtype: int
+        '''
+
+        excess = await self.total_bytes() - self.max_bytes
+        removed = 0
+
+        while excess > 0:
+            cursor = self.collection.find(
+                {}, {
+                    'v': True,
+                    'file_id': True, FIELDS['file_id']: True,
+                    'content_length': True, FIELDS['content_length']: True,
+                    'variants': True, FIELDS['variants']: True,
+                }
+            ).sort('accessed_at', ASCENDING).limit(self.batch_size)
+            docs = []
+            freed = 0
+            for doc in await cursor.to_list(length=self.batch_size):
+                doc = expand(doc)
+                docs.append(doc)
+                freed += stored_length(doc)
+                if freed >= excess:
+                    break
+            if not docs:
+                break
+
+            ids = [file_id for doc in docs for file_id in file_ids(doc)]
+            # Index documents go first so readers never see a dangling file.
+            await self.collection.delete_many({
+                '_id': {'$in': [doc['_id'] for doc in docs]}
+            })
+            await self.database['fs.chunks'].delete_many({
+                'files_id': {'$in': ids}
+            })
+            await self.database['fs.files'].delete_many({
+                '_id': {'$in': ids}
+            })
+
+            removed += len(docs)
+            if not freed:
+                # Entries of unknown length, the budget cannot tell.
+                break
+            excess -= freed
+
+        if removed:
+            logger.debug(f"[MONGODB_LRU_EVICTOR] evicted {removed} entries")
+
+        return removed
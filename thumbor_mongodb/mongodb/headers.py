@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+from functools import lru_cache
+
+DEFAULT_METADATA_HEADERS = ('Cache-Control', 'Vary')
+DEFAULT_METADATA_MAX_BYTES = 1024
+
+# Append only, the position is what gets stored.
+HEADERS = (
+    'Cache-Control',
+    'Expires',
+    'Vary',
+    'Access-Control-Allow-Origin',
+    'Content-Type',
+    'Content-Length',
+    'Content-Disposition',
+    'Content-Language',
+    'Last-Modified',
+    'Etag',
+    'Server',
+)
+HEADER_CODES = {name: str(code) for code, name in enumerate(HEADERS)}
+
+
+def normalize_name(name):
+    '''Return a header name the way Tornado normalizes it.
+    :rtype: string
+    '''
+
+    return '-'.join(part.capitalize() for part in name.strip().split('-'))
+
+
+def encode_headers(headers):
+    '''Return headers with well known names replaced by their code.'''
+
+    return {HEADER_CODES.get(name, name): value
+            for name, value in headers.items()}
+
+
+def decode_headers(encoded):
+    '''Return headers encoded by :func:`encode_headers` with their names.'''
+
+    return {HEADERS[int(name)] if name.isdigit() else name: value
+            for name, value in encoded.items()}
+
+
+class HeaderFilter:
+    '''Select the response headers persisted along a result.
+
+    Names are normalized, repeated headers are merged into one value
+    without duplicates, and headers are kept in allowlist order as long as
+    their names and values fit in ``max_bytes``.
+    '''
+
+    def __init__(self, allowlist, max_bytes):
+        self.allowlist = list(dict.fromkeys(
+            normalize_name(name) for name in allowlist
+        ))
+        self.allowed = set(self.allowlist)
+        self.max_bytes = max_bytes
+
+    def filter(self, headers):
+        '''Return the allowlisted headers of a response.
+        :param headers: Tornado ``HTTPHeaders`` or a dict
+        :rtype: dict
+        '''
+
+        if hasattr(headers, 'get_all'):
+            items = headers.get_all()
+        else:
+            items = headers.items()
+
+        values = {}
+        for name, value in items:
+            name = normalize_name(name)
+            if name in self.allowed:
+                values.setdefault(name, {})[str(value).strip()] = None
+
+        selected = {}
+        size = 0
+        for name in self.allowlist:
+            if name not in values:
+                continue
+            value = ', '.join(values[name])
+            size += len(name) + len(value)
+            if size > self.max_bytes:
+                break
+            selected[name] = value
+        return selected
+
+
+@lru_cache(maxsize=None)
+def get_header_filter(allowlist=DEFAULT_METADATA_HEADERS,
+                      max_bytes=DEFAULT_METADATA_MAX_BYTES):
+    return HeaderFilter(allowlist, max_bytes)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+from pymongo import ASCENDING, DESCENDING, HASHED
+from pymongo.errors import OperationFailure
+from thumbor.utils import logger
+
+# Bump whenever covering_indexes() changes the indexes it returns.
+INDEX_SET_VERSION = 4
+VERSIONS_COLLECTION = 'thumbor_indexes'
+
+
+def index_name(keys):
+    '''Return the default MongoDB name of an index.
+    :param list keys: ``(field, direction)`` pairs
+    :rtype: string
+    '''
+
+    return '_'.join(f"{field}_{direction}" for field, direction in keys)
+
+
+def covering_indexes(schemas, fields, shard_key=None):
+    '''Return the indexes covering the lookups of a collection.
+
+    One index per schema holds ``fields`` followed by ``_id``, so lookups
+    projecting any of them are answered from the index alone. ``created_at``
+    is indexed in descending order, every other field ascending.
+
+    :param list schemas: Schemas read by the connector
+    :param list fields: Version 1 names of the filtered and projected fields
+    :param string shard_key: Version 1 name of a hashed shard key, if any
+    :returns: Index keys by index name
+    :rtype: dict
+    '''
+
+    indexes = {}
+    for schema in schemas:
+        keys = [
+            (schema.field(field),
+             DESCENDING if field == 'created_at' else ASCENDING)
+            for field in fields
+        ]
+        keys.append(('_id', ASCENDING))
+        indexes[index_name(keys)] = keys
+
+        if shard_key:
+            keys = [(schema.field(shard_key), HASHED)]
+            indexes[index_name(keys)] = keys
+    return indexes
+
+
+class IndexManager:
+    '''Keep the managed index set of a collection up to date.
+
+    The applied set is recorded in the ``thumbor_indexes`` collection, so
+    processes only inspect the indexes when ``INDEX_SET_VERSION`` or the
+    configuration changes. Missing indexes are then created. Indexes whose
+    first field is one of ``owned_fields`` but that are not part of the set
+    are only dropped when the set moves up a version, see :meth:`actions`.
+    ``options`` holds extra ``create_index`` arguments by index name.
+    '''
+
+    def __init__(self, database, collection, name, indexes, owned_fields,
+                 options=None):
+        self.database = database
+        self.collection = collection
+        self.name = name
+        self.indexes = indexes
+        self.owned_fields = set(owned_fields)
+        self.options = options or {}
+
+    @property
+    def record(self):
+        return {
+            'version': INDEX_SET_VERSION,
+            'indexes': sorted(self.indexes),
+        }
+
+    def obsolete(self, existing):
+        '''Return the names of the owned indexes not in the set.
+        :param dict existing: Result of ``index_information()``
+        :rtype: list
+        '''
+
+        return [
+            name for name, info in existing.items()
+            if name not in self.indexes
+            and info['key'][0][0] in self.owned_fields
+        ]
+
+    def actions(self, current, force=False):
+        '''Return whether to create missing and drop obsolete indexes.
+
+        Processes never touch a set recorded by a newer release, and only
+        drop indexes when moving the recorded set up a version, so old and
+        new processes of a rolling deploy, or processes configured
+        differently, do not drop each other's indexes.
+
+        :param dict current: Recorded set, or None
+        :param bool force: Create and drop regardless of the recorded set
+        :returns: ``(create, drop)``
+        :rtype: tuple
+        '''
+
+        if force:
+            return True, True
+        if current == self.record:
+            return False, False
+        recorded = (current or {}).get('version', 0)
+        if recorded > INDEX_SET_VERSION:
+            return False, False
+        return True, recorded < INDEX_SET_VERSION
+
+    async def sync(self, force=False):
+        '''Create missing indexes and drop obsolete ones.
+        :param bool force: Sync and drop obsolete indexes even if the
+            recorded set is current or newer
+        :returns: Whether the indexes were inspected
+        :rtype: bool
+        '''
+
+        versions = self.database[VERSIONS_COLLECTION]
+        current = await versions.find_one({'_id': self.name}, {'_id': False})
+        create, drop = self.actions(current, force)
+        if not create:
+            return False
+
+        existing = await self.collection.index_information()
+        for name, keys in self.indexes.items():
+            if name not in existing:
+                try:
+                    await self.collection.create_index(
+                        keys, name=name, **self.options.get(name, {})
+                    )
+                except OperationFailure as exc:
+                    # For instance a unique index over duplicate documents.
+                    logger.error(
+                        f"[MONGODB_INDEX_MANAGER] cannot create {name}: {exc}"
+                    )
+
+        for name in self.obsolete(existing) if drop else ():
+            try:
+                await self.collection.drop_index(name)
+            except OperationFailure as exc:
+                # Already dropped by another process, or a shard key.
+                logger.warning(
+                    f"[MONGODB_INDEX_MANAGER] cannot drop {name}: {exc}"
+                )
+
+        await versions.replace_one(
+            {'_id': self.name}, self.record, upsert=True
+        )
+        return True
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import time
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+
+DEFAULT_LEASE_COLLECTION = 'thumbor_leases'
+
+
+def backoff(wait, initial=0.05, maximum=0.5):
+    '''Yield poll delays doubling up to ``maximum``, ``wait`` in total.
+    :param float wait: Total seconds to wait
+    :param float initial: First delay in seconds
+    :param float maximum: Longest delay in seconds
+    :rtype: generator
+    '''
+
+    delay = initial
+    while wait > 0:
+        step = min(delay, wait)
+        yield step
+        wait -= step
+        delay = min(delay * 2, maximum)
+
+
+class LocalNames:
+    '''Names remembered by the current process for a limited time.
+
+    At most ``size`` names are kept, the oldest are forgotten first.
+    '''
+
+    def __init__(self, size=10000, clock=time.monotonic):
+        self.size = size
+        self.clock = clock
+        self.names = {}
+
+    def __contains__(self, name):
+        expires_at = self.names.get(name)
+        if expires_at is None:
+            return False
+        if expires_at <= self.clock():
+            del self.names[name]
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, ttl):
+        '''Remember a name.
+        :param string name: Name
+        :param float ttl: Seconds before it is forgotten
+        '''
+
+        self.names.pop(name, None)
+        if len(self.names) >= self.size:
+            del self.names[next(iter(self.names))]
+        self.names[name] = self.clock() + ttl
+
+    def discard(self, name):
+        self.names.pop(name, None)
+
+    def clear(self):
+        self.names.clear()
+
+
+class LeaseManager:
+    '''Short lived, fleet wide locks stored in a MongoDB collection.
+
+    A lease is a document whose ``_id`` is the lease name. Acquiring it is
+    a single insert, so only one process can hold it at a time. Leases are
+    taken over once expired, and removed by a TTL index on ``expires_at``
+    when nobody takes them over.
+    '''
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_index(self):
+        if 'expires_at_1' not in await self.collection.index_information():
+            await self.collection.create_index(
+                'expires_at', name='expires_at_1', expireAfterSeconds=0
+            )
+
+    async def acquire(self, name, token, ttl):
+        '''Acquire a lease unless another process holds it.
+        :param string name: Lease name
+        :param string token: Random value identifying the holder
+        :param float ttl: Seconds before the lease expires
+        :returns: Whether the lease was acquired
+        :rtype: bool
+        '''
+
+        now = datetime.utcnow()
+        lease = {'token': token, 'expires_at': now + timedelta(seconds=ttl)}
+        try:
+            await self.collection.insert_one(dict(lease, _id=name))
+            return True
+        except DuplicateKeyError:
+            pass
+
+        # The TTL monitor only runs every minute, take over expired leases.
+        result = await self.collection.update_one(
+            {'_id': name, 'expires_at': {'$lte': now}}, {'$set': lease}
+        )
+        return result.modified_count == 1
+
+    async def holds(self, name, token):
+        '''Return whether ``token`` holds an unexpired lease.
+        :rtype: bool
+        '''
+
+        lease = await self.collection.find_one({
+            '_id': name,
+            'token': token,
+            'expires_at': {'$gt': datetime.utcnow()},
+        }, {'_id': True})
+        return lease is not None
+
+    async def release(self, name, token):
+        '''Release a lease held by ``token``.'''
+
+        await self.collection.delete_one({'_id': name, 'token': token})
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+from pymongo import ASCENDING, ReplaceOne
+from pymongo.errors import PyMongoError
+from thumbor.utils import logger
+from thumbor_mongodb.mongodb.indexes import VERSIONS_COLLECTION
+from thumbor_mongodb.mongodb.schema import FIELDS, file_ids
+from tornado.ioloop import IOLoop
+
+# Fields that may be written to a document after it was read, by other
+# processes or the access tracker.
+UPDATED_FIELDS = tuple(FIELDS) + ('accessed_at', 'hits')
+
+
+def unchanged(doc):
+    '''Return a filter matching a version 1 document only if unchanged.
+
+    Every field read must still hold its value, and fields it did not have
+    must still be missing.
+
+    :param dict doc: Version 1 document as read
+    :rtype: dict
+    '''
+
+    query = {
+        name: {'$exists': False} for name in UPDATED_FIELDS
+        if name not in doc
+    }
+    query.update(doc)
+    query['v'] = {'$exists': False}
+    return query
+
+
+async def is_migrated(database, name, version):
+    '''Return whether a collection has no documents older than a version.
+    :param database: Motor database
+    :param string name: Collection name
+    :param int version: Schema version
+    :rtype: bool
+    '''
+
+    record = await database[VERSIONS_COLLECTION].find_one(
+        {'_id': f"{name}.migrated"}
+    )
+    return record is not None and record['version'] >= version
+
+
+async def mark_migrated(database, name, version):
+    '''Record that a collection has no documents older than a version.'''
+
+    await database[VERSIONS_COLLECTION].replace_one(
+        {'_id': f"{name}.migrated"}, {'version': version}, upsert=True
+    )
+
+
+class SchemaMigrator:
+    '''Rewrite version 1 index documents in a newer schema.
+
+    Documents are rewritten in batches of ``batch_size`` every ``interval``
+    seconds, walking the collection in ``_id`` order so each pass reads
+    every document once. Once a pass finds nothing left to migrate, the
+    next one starts after ``idle_interval`` seconds, to pick up documents
+    written by processes still on version 1. The first pass finding no
+    version 1 document at all calls ``on_done``. Documents changed after
+    they were read are left for the next pass, so no update is lost.
+    '''
+
+    def __init__(self, database, collection, schema, batch_size, interval,
+                 idle_interval=300, on_done=None):
+        self.database = database
+        self.collection = collection
+        self.schema = schema
+        self.batch_size = batch_size
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.on_done = on_done
+        self.last_id = None
+
+    def start(self):
+        IOLoop.current().spawn_callback(self.run)
+
+    async def run(self):
+        while True:
+            try:
+                migrated = await self.migrate()
+            except PyMongoError as exc:
+                logger.error(f"[MONGODB_SCHEMA_MIGRATOR] {exc}")
+                migrated = 0
+
+            if self.last_id is None and not migrated:
+                await asyncio.sleep(self.idle_interval)
+            else:
+                await asyncio.sleep(self.interval)
+
+    async def migrate(self):
+        '''Migrate the next batch of version 1 documents.
+        :returns: Number of documents migrated, 0 at the end of a pass
+        :rtype: int
+        '''
+
+        query = {'v': {'$exists': False}}
+        if self.last_id is not None:
+            query['_id'] = {'$gt': self.last_id}
+        docs = await self.collection.find(query).sort(
+            '_id', ASCENDING
+        ).limit(self.batch_size).to_list(length=self.batch_size)
+
+        if not docs:
+            if self.last_id is None and self.on_done:
+                await self.on_done()
+                self.on_done = None
+            self.last_id = None
+            return 0
+
+        self.last_id = docs[-1]['_id']
+        # Skip documents another process migrated or updated meanwhile.
+        await self.collection.bulk_write([
+            ReplaceOne(unchanged(doc), self.schema.compact(doc))
+            for doc in docs
+        ], ordered=False)
+
+        ids = [file_id for doc in docs for file_id in file_ids(doc)]
+        if ids:
+            await self.database['fs.files'].update_many({
+                '_id': {'$in': ids},
+                'metadata': {'$exists': True},
+            }, {'$unset': {'metadata': ''}})
+
+        logger.debug(f"[MONGODB_SCHEMA_MIGRATOR] migrated {len(docs)}")
+        return len(docs)
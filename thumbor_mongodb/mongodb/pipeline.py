@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+from datetime import datetime, timedelta
+from functools import partial
+from uuid import uuid4
+from bson import ObjectId
+from gridfs.grid_file import DEFAULT_CHUNK_SIZE
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from thumbor.utils import logger
+from thumbor_mongodb.mongodb.lease import (
+    DEFAULT_LEASE_COLLECTION, LeaseManager
+)
+from tornado.ioloop import IOLoop
+
+CHUNK_BATCH_BYTES = 4 * 1024 * 1024
+
+
+class PutPipeline:
+    '''Write a GridFS file together with its index document.
+
+    Chunks are written with concurrent, batched ``insert_many`` calls. The
+    ``fs.files`` document and the index document are then written in one
+    transaction when the deployment supports it, or in order otherwise. If
+    any step fails, everything already written for the file is removed, so
+    a failed put never leaves dangling GridFS data behind. Chunks of a put
+    interrupted by the process dying are removed by :class:`OrphanSweeper`.
+    '''
+
+    def __init__(self, database, collection, batch_bytes=CHUNK_BATCH_BYTES,
+                 file_field='file_id'):
+        self.database = database
+        self.collection = collection
+        self.batch_bytes = batch_bytes
+        self.file_field = file_field
+        self.transactions = None
+
+    async def supports_transactions(self):
+        '''Return whether the deployment supports multi-document transactions.
+        :rtype: bool
+        '''
+
+        if self.transactions is None:
+            hello = await self.database.client.admin.command('ismaster')
+            wire_version = hello.get('maxWireVersion', 0)
+            if hello.get('msg') == 'isdbgrid':
+                self.transactions = wire_version >= 8
+            else:
+                self.transactions = 'setName' in hello and wire_version >= 7
+        return self.transactions
+
+    def split(self, file_id, data, chunk_size):
+        '''Return the chunk documents of a file grouped in insert batches.
+        :rtype: list
+        '''
+
+        per_batch = max(1, self.batch_bytes // chunk_size)
+        chunks = [{
+            'files_id': file_id,
+            'n': n,
+            'data': data[offset:offset + chunk_size],
+        } for n, offset in enumerate(range(0, len(data), chunk_size))]
+        return [
+            chunks[i:i + per_batch] for i in range(0, len(chunks), per_batch)
+        ]
+
+    async def put(self, filename, data, index_doc, chunk_size=None,
+                  metadata=None, write_index=None):
+        '''Store ``data`` in GridFS and insert its index document.
+
+        ``index_doc`` gets the new file id set in ``file_field`` before it
+        is inserted.
+
+        :param string filename: GridFS filename
+        :param bytes data: File contents
+        :param dict index_doc: Index document to insert along the file
+        :param int chunk_size: GridFS chunk size, None for the default
+        :param dict metadata: GridFS metadata
+        :param write_index: Coroutine function writing the index instead of
+            inserting ``index_doc``, called with the file id and the
+            transaction session, or None
+        :returns: The GridFS file id
+        :rtype: bson.ObjectId
+        '''
+
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        file_id = ObjectId()
+        file_doc = {
+            '_id': file_id,
+            'length': len(data),
+            'chunkSize': chunk_size,
+            'uploadDate': datetime.utcnow(),
+            'filename': filename,
+            'metadata': metadata,
+        }
+        if write_index is None:
+            index_doc[self.file_field] = file_id
+            write_index = partial(self.insert_index, index_doc)
+
+        try:
+            # Let every batch settle before a cleanup can run.
+            results = await asyncio.gather(*[
+                self.database['fs.chunks'].insert_many(batch, ordered=False)
+                for batch in self.split(file_id, data, chunk_size)
+            ], return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            await self.insert(file_doc, file_id, write_index)
+        except BaseException:
+            await self.cleanup(file_id)
+            raise
+
+        return file_id
+
+    async def insert(self, file_doc, file_id, write_index):
+        if not await self.supports_transactions():
+            await self.database['fs.files'].insert_one(file_doc)
+            await write_index(file_id, None)
+            return
+
+        async def write(session):
+            await self.database['fs.files'].insert_one(
+                file_doc, session=session
+            )
+            await write_index(file_id, session)
+
+        client = self.database.client
+        async with await client.start_session() as session:
+            try:
+                await session.with_transaction(write)
+            except DuplicateKeyError:
+                # A concurrent upsert committed first, running the
+                # transaction again updates its document instead.
+                await session.with_transaction(write)
+
+    async def insert_index(self, index_doc, file_id, session):
+        await self.collection.insert_one(index_doc, session=session)
+
+    async def cleanup(self, file_id):
+        try:
+            await self.delete_files([file_id])
+        except PyMongoError as exc:
+            logger.error(
+                f"[MONGODB_PUT_PIPELINE] cleanup of {file_id} failed: {exc}"
+            )
+
+    async def delete_files(self, file_ids):
+        '''Delete GridFS files, the files documents first.
+        :param list file_ids: GridFS file ids
+        '''
+
+        await self.database['fs.files'].delete_many({
+            '_id': {'$in': file_ids}
+        })
+        await self.database['fs.chunks'].delete_many({
+            'files_id': {'$in': file_ids}
+        })
+
+    async def delete(self, filename):
+        '''Delete every GridFS file stored under the given filename.
+        :param string filename: GridFS filename
+        '''
+
+        files = await self.database['fs.files'].find(
+            {'filename': filename}, {'_id': True}
+        ).to_list(length=None)
+        if files:
+            await self.delete_files([f['_id'] for f in files])
+
+
+class OrphanSweeper:
+    '''Remove GridFS chunks left without their ``fs.files`` document.
+
+    A put interrupted between its chunk inserts and its files document, as
+    when the process is killed, leaves chunks nothing references. Files ids
+    are ObjectIds created by the put, so chunks of files older than ``age``
+    seconds whose files document does not exist are removed. Only the
+    process holding the sweep lease of the database sweeps at a time.
+    '''
+
+    def __init__(self, database, interval, age=3600, batch_size=1000,
+                 lease_collection=DEFAULT_LEASE_COLLECTION, lease_seconds=300,
+                 clock=datetime.utcnow):
+        self.database = database
+        self.interval = interval
+        self.age = age
+        self.batch_size = batch_size
+        self.leases = LeaseManager(database[lease_collection])
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+
+    def start(self):
+        IOLoop.current().spawn_callback(self.run)
+
+    async def run(self):
+        await self.leases.ensure_index()
+        while True:
+            await asyncio.sleep(self.interval)
+            token = uuid4().hex
+            try:
+                if not await self.leases.acquire(
+                    'sweep:fs', token, self.lease_seconds
+                ):
+                    continue
+                try:
+                    await self.sweep()
+                finally:
+                    await self.leases.release('sweep:fs', token)
+            except PyMongoError as exc:
+                logger.error(f"[MONGODB_ORPHAN_SWEEPER] {exc}")
+
+    async def sweep(self):
+        '''Remove the orphan chunks of files older than ``age`` seconds.
+        :returns: Number of files whose chunks were removed
+        :rtype: int
+        '''
+
+        cutoff = ObjectId.from_datetime(
+            self.clock() - timedelta(seconds=self.age)
+        )
+        chunks = self.database['fs.chunks']
+        removed = 0
+        last_id = None
+        while True:
+            files_id = {'$lt': cutoff}
+            if last_id is not None:
+                files_id['$gt'] = last_id
+            found = await chunks.find(
+                {'files_id': files_id}, {'_id': False, 'files_id': True}
+            ).sort('files_id', ASCENDING).limit(self.batch_size).to_list(
+                length=self.batch_size
+            )
+            if not found:
+                break
+
+            ids = list(dict.fromkeys(chunk['files_id'] for chunk in found))
+            last_id = ids[-1]
+            files = await self.database['fs.files'].find(
+                {'_id': {'$in': ids}}, {'_id': True}
+            ).to_list(length=None)
+            existing = {file_doc['_id'] for file_doc in files}
+            orphans = [file_id for file_id in ids if file_id not in existing]
+            if orphans:
+                await chunks.delete_many({'files_id': {'$in': orphans}})
+                removed += len(orphans)
+
+        if removed:
+            logger.warning(
+                f"[MONGODB_ORPHAN_SWEEPER] removed chunks of {removed} files"
+            )
+        return removed
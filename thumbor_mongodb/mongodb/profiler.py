@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from functools import wraps
+
+import bson
+from bson.errors import InvalidDocument
+from bson.son import SON
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+from thumbor.utils import logger
+from tornado.ioloop import IOLoop
+from thumbor_mongodb.mongodb.plans import plan_stages
+
+# Commands reading or writing documents, others are not profiled.
+PROFILED_COMMANDS = {
+    'find', 'getMore', 'insert', 'update', 'delete', 'findAndModify',
+    'aggregate', 'count', 'distinct',
+}
+# Commands whose plans can be explained, with their filter argument.
+EXPLAINED_COMMANDS = {'find': 'filter', 'count': 'query'}
+
+PROFILER = None
+
+
+def get_profiler(config):
+    '''Return the profiler of the process, or None when disabled.
+
+    It is created on first use and its pymongo listeners registered, so it
+    must be enabled before the first client is created.
+
+    :param thumbor.config.Config config: Thumbor configuration
+    :rtype: Profiler
+    '''
+
+    global PROFILER  # pylint: disable=global-statement
+    if not config.get('MONGO_PROFILER_ENABLED', False):
+        return None
+
+    if PROFILER is None:
+        PROFILER = Profiler(
+            threshold=config.get('MONGO_PROFILER_THRESHOLD_MS', 100) / 1000,
+            size=config.get('MONGO_PROFILER_SLOW_OPS', 100),
+            top_k=config.get('MONGO_PROFILER_HOT_KEYS', 50),
+            explain_rate=config.get('MONGO_PROFILER_EXPLAIN_RATE', 0),
+        )
+        monitoring.register(PROFILER.commands)
+        monitoring.register(PROFILER.pool)
+        interval = config.get('MONGO_PROFILER_DUMP_INTERVAL', 0)
+        if interval:
+            IOLoop.current().spawn_callback(PROFILER.dump_every, interval)
+    return PROFILER
+
+
+def query_shape(value):
+    '''Return a query with its values replaced by their type names.
+    :param value: Query, or part of it
+    '''
+
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [query_shape(item) for item in value[:1]]
+    return type(value).__name__
+
+
+def command_shape(name, command):
+    '''Return the query shape of a command, as a string.
+    :param string name: Command name
+    :param dict command: Command document
+    :rtype: string
+    '''
+
+    shape = {}
+    if 'filter' in command:
+        shape = command['filter']
+    elif 'query' in command:
+        shape = command['query']
+    elif command.get('updates') or command.get('deletes'):
+        shape = (command.get('updates') or command.get('deletes'))[0]['q']
+    elif command.get('pipeline'):
+        shape = command['pipeline'][0]
+    # getMore names the cursor, and the collection apart.
+    collection = command.get('collection' if name == 'getMore' else name)
+    return (
+        f"{name} {collection} "
+        f"{json.dumps(query_shape(shape), sort_keys=True)}"
+    )
+
+
+def moved_bytes(args, result):
+    '''Return the bytes written or read by a storage operation.
+    :param tuple args: Operation arguments
+    :param result: Operation result
+    :rtype: int
+    '''
+
+    moved = sum(len(arg) for arg in args if isinstance(arg, bytes))
+    buffer = getattr(result, 'buffer', result)
+    if isinstance(buffer, bytes):
+        moved += len(buffer)
+    return moved
+
+
+def profiled(operation):
+    '''Record the calls of a storage coroutine in its ``profiler``.
+
+    The storage's ``profile_key(*args)`` returns the key of a call. Calls
+    are not timed when the profiler is disabled.
+
+    :param string operation: Operation name
+    '''
+
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            if self.profiler is None:
+                return await method(self, *args, **kwargs)
+
+            start = time.perf_counter()
+            result = None
+            try:
+                result = await method(self, *args, **kwargs)
+                return result
+            finally:
+                self.profiler.record(
+                    operation, self.profile_key(*args),
+                    time.perf_counter() - start, moved_bytes(args, result)
+                )
+        return wrapper
+    return decorator
+
+
+class SpaceSaving:
+    '''Space-Saving sketch of the most frequent keys.
+
+    At most ``size`` keys are counted. A new key replaces the least counted
+    one and inherits its count, recorded as the error bound of its own.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = {}
+
+    def add(self, key):
+        counts = self.counts
+        if key in counts:
+            counts[key][0] += 1
+        elif len(counts) < self.size:
+            counts[key] = [1, 0]
+        else:
+            evicted = min(counts, key=lambda item: counts[item][0])
+            count, _ = counts.pop(evicted)
+            counts[key] = [count + 1, count]
+
+    def top(self, count=None):
+        '''Return the most frequent keys.
+        :returns: ``(key, count, error)`` tuples, most frequent first
+        :rtype: list
+        '''
+
+        items = sorted(
+            self.counts.items(), key=lambda item: item[1][0], reverse=True
+        )
+        return [(key, hits, error) for key, (hits, error) in items[:count]]
+
+
+class CommandProfiler(monitoring.CommandListener):
+    '''Record the commands of attached databases slower than a threshold.'''
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.pending = {}
+
+    def started(self, event):
+        if event.command_name not in PROFILED_COMMANDS or \
+                self.profiler.database(
+                    event.connection_id, event.database_name
+                ) is None:
+            return
+        self.pending[event.request_id] = (
+            event.command, self.profiler.pool.take_wait()
+        )
+
+    def succeeded(self, event):
+        started = self.pending.pop(event.request_id, None)
+        if started is None:
+            return
+        duration = event.duration_micros / 1000000
+        if duration < self.profiler.threshold:
+            return
+
+        command, pool_wait = started
+        try:
+            moved = len(bson.encode(event.reply))
+        except (InvalidDocument, TypeError):
+            moved = 0
+        self.profiler.record_slow(
+            'command', command_shape(event.command_name, command), duration,
+            moved, pool_wait=pool_wait,
+            explain=self.explain_spec(event, command),
+        )
+
+    def failed(self, event):
+        self.pending.pop(event.request_id, None)
+
+    def explain_spec(self, event, command):
+        '''Return the database key and command to explain, when sampled.'''
+
+        name = event.command_name
+        if name not in EXPLAINED_COMMANDS or \
+                random.random() >= self.profiler.explain_rate:
+            return None
+        explained = SON([(name, command[name])])
+        for field in (EXPLAINED_COMMANDS[name], 'projection', 'sort'):
+            if field in command:
+                explained[field] = command[field]
+        return (event.connection_id, event.database_name), explained
+
+
+class PoolProfiler(monitoring.ConnectionPoolListener):
+    '''Measure how long operations wait for a pooled connection.
+
+    Operations check a connection out and run their command on the same
+    thread, so the wait is handed over through a thread local.
+    '''
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def take_wait(self):
+        wait = getattr(self.local, 'wait', 0)
+        self.local.wait = 0
+        return wait
+
+    def connection_check_out_started(self, event):
+        self.local.check_out = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        self.local.wait = time.perf_counter() - getattr(
+            self.local, 'check_out', time.perf_counter()
+        )
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+class Profiler:
+    '''Recent slow operations and hot keys of the MongoDB adapters.
+
+    Storage operations are recorded with their key, and commands with their
+    query shape, bytes moved and connection pool wait. Operations slower
+    than ``threshold`` are kept in a ring buffer of ``size`` entries, and a
+    fraction ``explain_rate`` of slow ``find`` commands is explained.
+    '''
+
+    def __init__(self, threshold=0.1, size=100, top_k=50, explain_rate=0):
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        self.slow = deque(maxlen=size)
+        self.hot_keys = SpaceSaving(top_k)
+        self.attached = {}
+        self.databases = {}
+        self.commands = CommandProfiler(self)
+        self.pool = PoolProfiler()
+        self.loop = None
+
+    def attach(self, database):
+        '''Profile the commands run against a database.
+        :param database: Motor database
+        '''
+
+        # Connectors are shared by the process, storages attach them on
+        # every request.
+        self.attached[(id(database.client), database.name)] = database
+        if self.loop is None:
+            self.loop = IOLoop.current()
+
+    def database(self, address, name):
+        '''Return the attached database a command ran against.
+
+        Databases of the same name on different clusters are told apart by
+        the servers their client knows of.
+
+        :param tuple address: Server ``(host, port)``, as the
+            ``connection_id`` of command events
+        :param string name: Database name
+        :returns: Motor database, or None when not attached
+        '''
+
+        key = (address, name)
+        database = self.databases.get(key)
+        if database is None:
+            for attached in list(self.attached.values()):
+                if attached.name == name and \
+                        address in attached.client.nodes:
+                    database = self.databases[key] = attached
+                    break
+        return database
+
+    def record(self, operation, key, duration, moved=0):
+        '''Record a storage operation.
+        :param string operation: Operation name
+        :param string key: Image path or result key
+        :param float duration: Seconds taken
+        :param int moved: Bytes read or written
+        '''
+
+        self.hot_keys.add(key)
+        if duration >= self.threshold:
+            self.record_slow(operation, key, duration, moved)
+
+    def record_slow(self, operation, target, duration, moved, pool_wait=None,
+                    explain=None):
+        entry = {
+            'at': datetime.utcnow().isoformat(),
+            'operation': operation,
+            'target': target,
+            'duration_ms': round(duration * 1000, 3),
+            'bytes': moved,
+        }
+        if pool_wait is not None:
+            entry['pool_wait_ms'] = round(pool_wait * 1000, 3)
+        self.slow.append(entry)
+
+        if explain and self.loop:
+            # Commands complete on driver threads.
+            self.loop.add_callback(self.explain, entry, *explain)
+
+    async def explain(self, entry, database_key, command):
+        '''Add the winning plan of a slow command to its entry.
+        :param dict entry: Slow operation entry
+        :param tuple database_key: Server address and database name
+        :param command: Command to explain
+        '''
+
+        try:
+            explain = await self.databases[database_key].command(SON([
+                ('explain', command), ('verbosity', 'queryPlanner'),
+            ]))
+        except PyMongoError as exc:
+            entry['plan'] = f"explain failed: {exc}"
+            return
+        stages = plan_stages(explain['queryPlanner']['winningPlan'])
+        entry['plan'] = ' <- '.join(stages)
+
+    def report(self, count=None):
+        '''Return the slow operations and hot keys.
+        :param int count: Number of hot keys, all when None
+        :rtype: dict
+        '''
+
+        return {
+            'threshold_ms': self.threshold * 1000,
+            'slow': list(self.slow),
+            'hot_keys': [
+                {'key': key, 'count': hits, 'error': error}
+                for key, hits, error in self.hot_keys.top(count)
+            ],
+        }
+
+    def drain(self):
+        '''Remove and return the slow operations recorded so far.
+
+        Commands are recorded from driver threads, so entries are popped
+        one by one and none recorded meanwhile is lost.
+
+        :rtype: list
+        '''
+
+        drained = []
+        while True:
+            try:
+                drained.append(self.slow.popleft())
+            except IndexError:
+                return drained
+
+    def dump(self, count=10):
+        '''Log and forget the slow operations, and log the hot keys.'''
+
+        for entry in self.drain():
+            logger.warning(
+                f"[MONGODB_PROFILER] slow {json.dumps(entry, default=str)}"
+            )
+        for key, hits, error in self.hot_keys.top(count):
+            logger.info(
+                f"[MONGODB_PROFILER] hot {key} {hits} (+/- {error})"
+            )
+
+    async def dump_every(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.dump()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+import bisect
+import hashlib
+import re
+from functools import lru_cache
+
+DEFAULT_VIRTUAL_NODES = 160
+
+
+def cluster_uris(value):
+    '''Return the list of cluster URIs configured in ``value``.
+    :param value: A URI, a list of URIs or a falsy value
+    :returns: List of URIs, ``[None]`` when no URI is configured
+    :rtype: list
+    '''
+
+    if not value:
+        return [None]
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def cluster_name(uri=None, host=None, port=None):
+    '''Return a stable, metric friendly name for a cluster.
+
+    Only the host list of the URI is used, so changing credentials or
+    options does not move keys to another cluster.
+
+    :rtype: string
+    '''
+
+    if uri:
+        hosts = uri.split('://', 1)[-1].split('/', 1)[0].split('?', 1)[0]
+        hosts = hosts.rsplit('@', 1)[-1]
+    else:
+        hosts = f"{host}:{port}"
+    return re.sub(r'[^A-Za-z0-9]+', '_', hosts).strip('_')
+
+
+def without_credentials(uri):
+    '''Return ``uri`` without its user and password.'''
+
+    return re.sub(r'://[^/]*@', '://', uri) if uri else uri
+
+
+def cluster_names(setting, value, host=None, port=None, current=None):
+    '''Return the cluster URIs configured in ``setting`` by name.
+
+    Names only depend on the hosts, so two URIs with the same hosts but
+    another database or replica set would silently be routed as one
+    cluster. The clusters of the previous ring are checked against the
+    ``current`` ones in the same way.
+
+    :param string setting: Name of the setting, used in errors
+    :param value: A URI, a list of URIs or a falsy value
+    :param dict current: Current cluster URIs by name
+    :raises ValueError: When a name is given to different clusters
+    :rtype: dict
+    '''
+
+    names = {}
+    for uri in cluster_uris(value):
+        name = cluster_name(uri, host, port)
+        if name in names:
+            raise ValueError(
+                f"{setting} lists several URIs of cluster {name}, clusters "
+                "are named after their hosts, which must differ"
+            )
+        if current and name in current and (
+            without_credentials(uri) != without_credentials(current[name])
+        ):
+            raise ValueError(
+                f"{setting} lists cluster {name} with another URI than the "
+                "current clusters, only its credentials may differ"
+            )
+        names[name] = uri
+    return names
+
+
+class HashRing:
+    '''Consistent hash ring with virtual nodes.'''
+
+    def __init__(self, nodes, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        self.nodes = list(nodes)
+        ring = sorted(
+            (self.hash(f"{node}#{index}"), node)
+            for node in self.nodes
+            for index in range(virtual_nodes)
+        )
+        self.hashes = [point for point, _ in ring]
+        self.owners = [node for _, node in ring]
+
+    @staticmethod
+    def hash(value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=8)
+        return int.from_bytes(digest.digest(), 'big')
+
+    def get_node(self, key):
+        '''Return the node owning ``key``.
+        :param string key: Key to route
+        :rtype: string
+        '''
+
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+
+        index = bisect.bisect(self.hashes, self.hash(key))
+        return self.owners[index % len(self.owners)]
+
+
+@lru_cache(maxsize=None)
+def get_ring(nodes, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+    return HashRing(nodes, virtual_nodes)
+
+
+class ClusterRouter:
+    '''Route keys to one of several independent clusters.
+
+    ``previous`` holds the clusters of the ring before the last change of
+    membership, so reads can fall back to the previous owner of a key while
+    data is being rebalanced.
+    '''
+
+    def __init__(self, connectors, previous=None,
+                 virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        self.connectors = connectors
+        self.ring = get_ring(tuple(connectors), virtual_nodes)
+        self.previous = previous or {}
+        self.previous_ring = None
+        if self.previous:
+            self.previous_ring = get_ring(tuple(self.previous), virtual_nodes)
+
+    def route(self, key):
+        '''Return the name and connector of the cluster owning ``key``.
+        :rtype: tuple
+        '''
+
+        name = self.ring.get_node(key)
+        return name, self.connectors[name]
+
+    def previous_owner(self, key):
+        '''Return the previous owner of ``key`` if it moved, else None.
+        :rtype: tuple
+        '''
+
+        if self.previous_ring is None:
+            return None, None
+
+        name = self.previous_ring.get_node(key)
+        if name == self.ring.get_node(key):
+            return None, None
+        return name, self.previous[name]
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+SCHEMA_VERSION = 2
+
+# Long (version 1) field names and their version 2 counterparts. The access
+# tracking fields keep their names so eviction and warm up indexes cover
+# both versions.
+FIELDS = {
+    'path': 'p',
+    'path_hash': 'ph',
+    'key': 'k',
+    'key_hash': 'kh',
+    'created_at': 'c',
+    'file_id': 'f',
+    'crypto': 's',
+    'detector_data': 'd',
+    'content_type': 't',
+    'content_length': 'l',
+    'metadata': 'm',
+    'variants': 'vr',
+    'missing': 'ms',
+    'unavailable': 'un',
+}
+LONG_FIELDS = {short: name for name, short in FIELDS.items()}
+
+# Append only, the position is what gets stored.
+MIMETYPES = (
+    'image/jpeg',
+    'image/png',
+    'image/gif',
+    'image/webp',
+    'image/svg+xml',
+    'image/tiff',
+    'image/bmp',
+    'image/avif',
+    'image/heif',
+    'video/mp4',
+    'video/webm',
+)
+MIMETYPE_CODES = {mimetype: code for code, mimetype in enumerate(MIMETYPES)}
+
+
+def encode_mimetype(mimetype):
+    '''Return the enum code of a mimetype, or the mimetype if unknown.'''
+
+    return MIMETYPE_CODES.get(mimetype, mimetype)
+
+
+def decode_mimetype(value):
+    '''Return the mimetype of an enum code, or the value if not a code.'''
+
+    if isinstance(value, int) and 0 <= value < len(MIMETYPES):
+        return MIMETYPES[value]
+    return value
+
+
+def expand(doc):
+    '''Return a stored document with version 1 field names.
+
+    Version 1 documents are returned as they are, so callers can read both
+    versions with the same code.
+
+    :param dict doc: Stored document or None
+    :rtype: dict
+    '''
+
+    if doc is None or 'v' not in doc:
+        return doc
+    return expand_fields(doc)
+
+
+def expand_fields(fields):
+    '''Return version 2 fields with version 1 names, dropping the version.
+    :param dict fields: Stored fields
+    :rtype: dict
+    '''
+
+    expanded = {}
+    for name, value in fields.items():
+        if name == 'v':
+            continue
+        name = LONG_FIELDS.get(name, name)
+        if name == 'content_type':
+            value = decode_mimetype(value)
+        elif name == 'variants':
+            value = {
+                variant: expand_fields(variant_fields)
+                for variant, variant_fields in value.items()
+            }
+        expanded[name] = value
+    return expanded
+
+
+def file_ids(doc):
+    '''Return the GridFS file ids referenced by an expanded document.
+
+    Multi-variant result documents reference one file per variant.
+
+    :param dict doc: Document with version 1 field names
+    :rtype: list
+    '''
+
+    if 'file_id' in doc:
+        return [doc['file_id']]
+    return [
+        variant['file_id'] for variant in doc.get('variants', {}).values()
+        if 'file_id' in variant
+    ]
+
+
+class Schema:
+    '''Field layout of the index documents written by a connector.'''
+
+    def __init__(self, version=1):
+        if version not in (1, SCHEMA_VERSION):
+            raise ValueError(f"Unknown schema version {version!r}")
+        self.version = version
+
+    def field(self, name):
+        '''Return the stored name of a version 1 field name.
+        :rtype: string
+        '''
+
+        if self.version < 2:
+            return name
+        return FIELDS.get(name, name)
+
+    def expand(self, doc):
+        '''Return a document read in this layout with version 1 names.
+
+        Unlike :func:`expand`, this does not need the version field, so it
+        also works on projections.
+
+        :param dict doc: Stored document or None
+        :rtype: dict
+        '''
+
+        if doc is None or self.version < 2:
+            return doc
+        return expand_fields(doc)
+
+    def filter(self, conditions):
+        '''Return ``conditions`` with stored field names.
+        :param dict conditions: Conditions on version 1 field names
+        :rtype: dict
+        '''
+
+        return {self.field(name): value for name, value in conditions.items()}
+
+    def compact(self, doc):
+        '''Return a document with version 1 field names in this layout.
+
+        Empty values are left out and the mimetype is stored as an enum.
+
+        :param dict doc: Document with version 1 field names
+        :rtype: dict
+        '''
+
+        if self.version < 2:
+            return doc
+
+        compacted = {'v': self.version}
+        compacted.update(self.compact_fields(doc))
+        return compacted
+
+    def compact_fields(self, doc):
+        '''Return the fields of a document in this layout, without version.
+
+        Used for the variants nested in multi-variant result documents.
+
+        :param dict doc: Fields with version 1 names
+        :rtype: dict
+        '''
+
+        if self.version < 2:
+            return doc
+
+        compacted = {}
+        for name, value in doc.items():
+            if value is None or value == {}:
+                continue
+            if name == 'content_type':
+                value = encode_mimetype(value)
+            elif name == 'variants':
+                value = {
+                    variant: self.compact_fields(fields)
+                    for variant, fields in value.items()
+                }
+            compacted[self.field(name)] = value
+        return compacted
+
+    def gridfs_metadata(self, doc):
+        '''Return the metadata stored in ``fs.files`` along a document.
+
+        Version 2 does not copy the index document into GridFS.
+
+        :rtype: dict
+        '''
+
+        return doc if self.version < 2 else None
@@ -3,58 +3,218 @@
 # http://www.opensource.org/licenses/mit-license
 # Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
 
+import asyncio
 from datetime import datetime, timedelta
-from motor.motor_tornado import MotorGridFSBucket
+from uuid import uuid4
+from gridfs.errors import NoFile
 from pymongo.errors import PyMongoError
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.ioloop import IOLoop
 from thumbor.engines import BaseEngine
 from thumbor.result_storages import BaseStorage, ResultStorageResult
 from thumbor.utils import deprecated, logger
 from thumbor_mongodb.mongodb.connector_result_storage import MongoConnector
-from thumbor_mongodb.utils import OnException
+from thumbor_mongodb.mongodb.headers import (
+    DEFAULT_METADATA_HEADERS, DEFAULT_METADATA_MAX_BYTES, decode_headers,
+    encode_headers, get_header_filter
+)
+from thumbor_mongodb.mongodb.lease import (
+    DEFAULT_LEASE_COLLECTION, LocalNames, backoff
+)
+from thumbor_mongodb.mongodb.profiler import get_profiler, profiled
+from thumbor_mongodb.mongodb.routing import (
+    DEFAULT_VIRTUAL_NODES, ClusterRouter, cluster_names
+)
+from thumbor_mongodb.mongodb.schema import expand
+from thumbor_mongodb.utils import OnException, get_chunk_size
 import pytz
 
+# Lookups answered from the covering indexes alone.
+COVERED_LOOKUPS = ('get',)
+
+VARIANTS_KEY_PREFIX = 'variants:'
+ORIGINAL_VARIANT = 'original'
+# Formats negotiated from the Accept header, in thumbor's order of
+# preference, with their mimetype and the option enabling them.
+NEGOTIATED_VARIANTS = (
+    ('webp', 'image/webp', 'AUTO_WEBP'),
+    ('avif', 'image/avif', 'AUTO_AVIF'),
+    ('heif', 'image/heif', 'AUTO_HEIF'),
+)
+
+# Carries the lease token of background refreshes of stale results.
+REFRESH_HEADER = 'X-Thumbor-Mongodb-Refresh'
+
+# Render leases this process waited on in vain, until they expire. Their
+# holder may have failed without storing anything, so they are not waited
+# on again.
+TIMED_OUT_RENDERS = LocalNames()
+# Refresh leases this process is refreshing, so stale hits do not spawn
+# more refreshes, each looking the lease up.
+REFRESHING = LocalNames()
+
 
 class Storage(BaseStorage):
 
     def __init__(self, context):
         BaseStorage.__init__(self, context)
-        self.database, self.storage = self.__conn__()
+        self.profiler = get_profiler(context.config)
+        self.missing_variants = []
+        self.render_token = None
+        self.router = self.__conn__()
+        self.connector = next(iter(self.router.connectors.values()))
+        self.database = self.connector.db_conn
+        self.storage = self.connector.col_conn
         super(Storage, self).__init__(context)
 
     def __conn__(self):
-        '''Return the MongoDB database and collection object.
-        :returns: MongoDB DB and Collection
-        :rtype: pymongo.database.Database, pymongo.database.Collection
+        '''Return the router over the MongoDB clusters of this storage.
+        :returns: Router holding one connector per cluster
+        :rtype: ClusterRouter
         '''
 
-        db_name = self.context.config.MONGO_RESULT_STORAGE_SERVER_DB
-        col_name = self.context.config.MONGO_RESULT_STORAGE_SERVER_COLLECTION
-        uri = None
+        config = self.context.config
         host = None
         port = None
-        try:
-            uri = self.context.config.MONGO_RESULT_STORAGE_URI
-        except AttributeError:
-            pass
-
         try:
             host = self.context.config.MONGO_RESULT_STORAGE_SERVER_HOST
             port = self.context.config.MONGO_RESULT_STORAGE_SERVER_PORT
         except AttributeError:
             pass
 
+        clusters = cluster_names(
+            'MONGO_RESULT_STORAGE_URI',
+            config.get('MONGO_RESULT_STORAGE_URI'),
+            host, port
+        )
+        connectors = {
+            name: self.connect(uri, host, port)
+            for name, uri in clusters.items()
+        }
+        previous = {}
+        if config.get('MONGO_RESULT_STORAGE_PREVIOUS_URI'):
+            previous = {
+                name: self.connect(uri, host, port)
+                for name, uri in cluster_names(
+                    'MONGO_RESULT_STORAGE_PREVIOUS_URI',
+                    config.get('MONGO_RESULT_STORAGE_PREVIOUS_URI'),
+                    host, port, clusters
+                ).items()
+            }
+
+        return ClusterRouter(
+            connectors,
+            previous,
+            config.get(
+                'MONGO_RESULT_STORAGE_VIRTUAL_NODES', DEFAULT_VIRTUAL_NODES
+            ),
+        )
+
+    def connect(self, uri, host, port):
+        '''Return the MongoDB connector of a single cluster.
+        :returns: MongoDB connector holding the DB and Collection
+        :rtype: MongoConnector
+        '''
+
+        config = self.context.config
         mongo_conn = MongoConnector(
-            db_name=db_name,
-            col_name=col_name,
+            db_name=config.MONGO_RESULT_STORAGE_SERVER_DB,
+            col_name=config.MONGO_RESULT_STORAGE_SERVER_COLLECTION,
             uri=uri,
             host=host,
             port=port,
+            hashed_key=config.get('MONGO_RESULT_STORAGE_HASHED_KEY', False),
+            driver=config.get('MONGO_RESULT_STORAGE_DRIVER'),
+            schema_version=config.get(
+                'MONGO_RESULT_STORAGE_SCHEMA_VERSION', 1
+            ),
+            variants=self.variants_enabled,
+            legacy_reads=config.get(
+                'MONGO_RESULT_STORAGE_LEGACY_READS', True
+            ),
+        )
+
+        mongo_conn.setup_eviction(
+            sample_rate=config.get(
+                'MONGO_RESULT_STORAGE_ACCESS_SAMPLE_RATE', 0
+            ),
+            flush_interval=config.get(
+                'MONGO_RESULT_STORAGE_ACCESS_FLUSH_INTERVAL', 10
+            ),
+            max_bytes=config.get('MONGO_RESULT_STORAGE_MAX_BYTES', 0),
+            interval=config.get('MONGO_RESULT_STORAGE_EVICTION_INTERVAL', 60),
+            batch_size=config.get(
+                'MONGO_RESULT_STORAGE_EVICTION_BATCH_SIZE', 100
+            ),
+            lease_collection=config.get(
+                'MONGO_RESULT_STORAGE_LEASE_COLLECTION',
+                DEFAULT_LEASE_COLLECTION
+            ),
         )
+        mongo_conn.setup_sweeper(
+            interval=config.get(
+                'MONGO_RESULT_STORAGE_ORPHAN_SWEEP_INTERVAL', 0
+            ),
+            age=config.get('MONGO_RESULT_STORAGE_ORPHAN_AGE', 3600),
+            lease_collection=config.get(
+                'MONGO_RESULT_STORAGE_LEASE_COLLECTION',
+                DEFAULT_LEASE_COLLECTION
+            ),
+        )
+        mongo_conn.setup_cache(
+            config.get('MONGO_RESULT_STORAGE_LOCAL_CACHE_SIZE', 0)
+        )
+        mongo_conn.setup_migration(
+            batch_size=config.get(
+                'MONGO_RESULT_STORAGE_MIGRATION_BATCH_SIZE', 0
+            ),
+            interval=config.get('MONGO_RESULT_STORAGE_MIGRATION_INTERVAL', 1),
+        )
+        if self.profiler:
+            self.profiler.attach(mongo_conn.db_conn)
+        if self.get_stale_seconds() or self.get_render_lease_seconds():
+            mongo_conn.setup_leases(config.get(
+                'MONGO_RESULT_STORAGE_LEASE_COLLECTION',
+                DEFAULT_LEASE_COLLECTION
+            ))
+
+        return mongo_conn
+
+    async def warm_up(self):
+        '''Preload the local cache of every cluster with popular results.
+        :returns: Number of entries loaded
+        :rtype: int
+        '''
 
-        database = mongo_conn.db_conn
-        storage = mongo_conn.col_conn
+        config = self.context.config
+        loaded = 0
+        for connector in self.router.connectors.values():
+            loaded += await connector.warm_up(
+                config.get('MONGO_RESULT_STORAGE_WARMUP_COUNT', 0),
+                config.get('MONGO_RESULT_STORAGE_WARMUP_MAX_BYTES', 0),
+                config.get('MONGO_RESULT_STORAGE_WARMUP_TIMEOUT', 30),
+                self.cache_value,
+            )
+        return loaded
+
+    def profile_key(self, *args):
+        return self.get_key_from_request()
+
+    def incr_metric(self, cluster, operation):
+        metrics = getattr(self.context, 'metrics', None)
+        if metrics:
+            metrics.incr(f"mongodb.result_storage.{cluster}.{operation}")
+
+    def route(self, key, operation):
+        '''Return the connector of the cluster owning the key.
+        :param string key: Result key
+        :param string operation: Operation name, used for metrics
+        :rtype: MongoConnector
+        '''
 
-        return database, storage
+        name, connector = self.router.route(key)
+        self.incr_metric(name, operation)
+        return connector
 
     def on_mongodb_error(self, fname, exc_type, exc_value):
         '''Callback executed when there is a mongo error.
@@ -81,12 +241,76 @@ class Storage(BaseStorage):
         return self.context.config.AUTO_WEBP \
             and self.context.request.accepts_webp
 
+    @property
+    def variants_enabled(self):
+        '''Whether results are stored in multi-variant documents.
+        :rettype: boolean
+        '''
+
+        return self.context.config.get('MONGO_RESULT_STORAGE_VARIANTS', False)
+
+    def accepted_variants(self):
+        '''Return the variants the client accepts, preferred first.
+
+        These are the formats thumbor would negotiate for the request, in
+        its order, followed by the original format.
+
+        :rtype: list
+        '''
+
+        config = self.context.config
+        request = self.context.request
+        accept = (request.headers or {}).get('Accept', '')
+        variants = [
+            name for name, mimetype, option in NEGOTIATED_VARIANTS
+            if config.get(option, False) and (
+                request.accepts_webp if name == 'webp' else mimetype in accept
+            )
+        ]
+        variants.append(ORIGINAL_VARIANT)
+        return variants
+
+    @staticmethod
+    def variant_name(preferred, content_type):
+        '''Return the variant a result is stored as.
+
+        A result is only stored as the preferred variant if thumbor did
+        convert it to that format.
+
+        :param string preferred: Variant thumbor negotiated
+        :param string content_type: Result mimetype
+        :rtype: string
+        '''
+
+        for name, mimetype, _ in NEGOTIATED_VARIANTS:
+            if name == preferred and mimetype == content_type:
+                return name
+        return ORIGINAL_VARIANT
+
+    @staticmethod
+    def variant_of(key):
+        '''Return the multi-variant key and variant of a single result key.
+
+        Keys of results converted by ``AUTO_WEBP`` end with ``/webp``.
+
+        :param string key: Key built without multi-variant documents
+        :rtype: tuple
+        '''
+
+        url = key[len('result:'):] if key.startswith('result:') else key
+        if url.endswith('/webp'):
+            return f"{VARIANTS_KEY_PREFIX}{url[:-len('/webp')]}", 'webp'
+        return f"{VARIANTS_KEY_PREFIX}{url}", ORIGINAL_VARIANT
+
     def get_key_from_request(self):
         '''Return a key for the current request url.
         :return: The storage key for the current url
         :rettype: string
         '''
 
+        if self.variants_enabled:
+            return f"{VARIANTS_KEY_PREFIX}{self.context.request.url}"
+
         path = f"result:{self.context.request.url}"
 
         if self.is_auto_webp:
@@ -102,6 +326,186 @@ class Storage(BaseStorage):
 
         return self.context.config.RESULT_STORAGE_EXPIRATION_SECONDS
 
+    def get_stale_seconds(self):
+        '''Return how long expired results are still served while refreshed.
+        :returns: Grace period in seconds, 0 when disabled
+        :rtype: int
+        '''
+
+        return self.context.config.get('MONGO_RESULT_STORAGE_STALE_SECONDS', 0)
+
+    def get_chunk_size(self, length):
+        '''Return the GridFS chunk size for a file of the given length.
+        :param int length: File length in bytes
+        :returns: Chunk size in bytes, or None for the bucket default
+        :rtype: int
+        '''
+
+        return get_chunk_size(
+            length,
+            self.context.config.get('MONGO_RESULT_STORAGE_CHUNK_SIZE'),
+            self.context.config.get('MONGO_RESULT_STORAGE_CHUNK_SIZE_CLASSES'),
+        )
+
+    def get_render_lease_seconds(self):
+        '''Return how long a process may render a missing result alone.
+        :returns: Render lease TTL in seconds, 0 when disabled
+        :rtype: float
+        '''
+
+        return self.context.config.get(
+            'MONGO_RESULT_STORAGE_RENDER_LEASE_SECONDS', 0
+        )
+
+    def is_expired(self, created_at, grace=0):
+        '''Return whether an entry created at the given time is expired.
+        :param datetime.datetime created_at: Entry creation time
+        :param int grace: Seconds the entry is kept past the TTL
+        :rtype: bool
+        '''
+
+        max_age = self.get_max_age()
+        if not max_age:
+            return False
+        return created_at < datetime.utcnow() - timedelta(
+            seconds=max_age + grace
+        )
+
+    def is_usable(self, created_at):
+        '''Return whether an entry can be served, even if stale.
+        :param datetime.datetime created_at: Entry creation time
+        :rtype: bool
+        '''
+
+        return not self.is_expired(created_at, self.get_stale_seconds())
+
+    def expiration_conditions(self):
+        '''Return the ``created_at`` condition of the current TTL.
+
+        Stale entries within the grace period are still matched.
+
+        :returns: Conditions on version 1 field names, empty without a TTL
+        :rtype: dict
+        '''
+
+        max_age = self.get_max_age()
+        if not max_age:
+            return {}
+        return {'created_at': {
+            '$gte': datetime.utcnow() - timedelta(
+                seconds=max_age + self.get_stale_seconds()
+            )
+        }}
+
+    def lookups(self):
+        '''Return the projected fields and conditions of each lookup.
+        :returns: ``(names, conditions)`` by operation name
+        :rtype: dict
+        '''
+
+        if self.variants_enabled:
+            # Variants expire on their own, so expiration is checked after.
+            return {
+                'get_variants': (('variants', 'missing', 'unavailable'), {}),
+            }
+
+        return {
+            'get': ((
+                'file_id', 'created_at', 'content_type', 'content_length',
+            ), self.expiration_conditions()),
+        }
+
+    def lookup(self, connector, operation, key):
+        '''Run the lookup of an operation against a connector.
+        :returns: Document with version 1 field names, or None
+        :rtype: dict
+        '''
+
+        names, conditions = self.lookups()[operation]
+        return connector.find_one(key, names, **conditions)
+
+    async def get_metadata(self, connector, doc_id):
+        '''Return the response metadata stored along a result.
+
+        The covering index leaves the metadata out, so it is read by
+        ``_id``, along the file contents.
+
+        :param MongoConnector connector: Connector of the cluster owning it
+        :param ObjectId doc_id: Index document ``_id``
+        :returns: Stored metadata, or None when metadata is not stored
+        :rtype: dict
+        '''
+
+        if not self.context.config.get('MONGO_STORE_METADATA', False):
+            return None
+        doc = await connector.col_conn.find_one(
+            {'_id': doc_id}, connector.projection('metadata')
+        )
+        return (expand(doc) or {}).get('metadata')
+
+    @staticmethod
+    def build_metadata(doc):
+        '''Return the result metadata for an index document.
+        :param dict doc: Index document
+        :rtype: dict
+        '''
+
+        metadata = doc.get('metadata') or {}
+        if 'ContentType' not in metadata:
+            # Precomputed metadata is served as stored.
+            metadata = decode_headers(metadata)
+            metadata['ContentLength'] = doc.get('content_length')
+            metadata['ContentType'] = doc.get('content_type')
+        metadata['LastModified'] = doc['created_at'].replace(
+            tzinfo=pytz.utc
+        )
+        return metadata
+
+    def build_stored_metadata(self, content_type, content_length):
+        '''Return the response metadata persisted along a result.
+
+        Only allowlisted response headers are kept, within a size cap.
+        They are stored with encoded names, or, when precomputed, as the
+        metadata ``get`` returns, at the cost of bigger documents.
+
+        :param string content_type: Result mimetype
+        :param int content_length: Result length in bytes
+        :rtype: dict
+        '''
+
+        config = self.context.config
+        if not config.get('MONGO_STORE_METADATA', False):
+            return {}
+
+        headers = get_header_filter(
+            tuple(config.get(
+                'MONGO_STORE_METADATA_HEADERS', DEFAULT_METADATA_HEADERS
+            )),
+            config.get(
+                'MONGO_STORE_METADATA_MAX_BYTES', DEFAULT_METADATA_MAX_BYTES
+            ),
+        ).filter(self.context.headers)
+
+        if not config.get('MONGO_STORE_METADATA_PRECOMPUTED', False):
+            return encode_headers(headers)
+
+        headers['ContentType'] = content_type
+        headers['ContentLength'] = content_length
+        return headers
+
+    @classmethod
+    def cache_value(cls, doc, contents):
+        '''Return the local cache value for an index document.
+        :param dict doc: Index document
+        :param bytes contents: Stored file contents
+        :rtype: tuple
+        '''
+
+        return (
+            doc['_id'], doc['created_at'], contents, cls.build_metadata(doc)
+        )
+
+    @profiled('result_storage.put')
     @OnException(on_mongodb_error, PyMongoError)
     async def put(self, image_bytes):
         '''Save to mongodb
@@ -110,71 +514,454 @@ class Storage(BaseStorage):
         :rettype: string
         '''
 
+        content_type = BaseEngine.get_mimetype(image_bytes)
+        metadata = self.build_stored_metadata(content_type, len(image_bytes))
+        if self.variants_enabled:
+            await self.store_variant(
+                self.get_key_from_request(), self.accepted_variants()[0],
+                image_bytes, metadata, content_type,
+            )
+        else:
+            await self.store(
+                self.get_key_from_request(), image_bytes, metadata,
+                content_type,
+            )
+
+        connector = self.router.route(self.get_key_from_request())[1]
+        token = self.refresh_token()
+        if token and connector.leases:
+            await connector.leases.release(self.lease_name('refresh'), token)
+        if self.render_token:
+            await connector.leases.release(
+                self.lease_name('render'), self.render_token
+            )
+            self.render_token = None
+        return self.context.request.url
+
+    async def store(self, key, image_bytes, metadata=None, content_type=None):
+        '''Save a result under an explicit key.
+        :param string key: Result key, as built by ``get_key_from_request``
+        :param bytes image_bytes: Result contents
+        :param dict metadata: Stored metadata, as ``build_stored_metadata``
+            returns it
+        :param string content_type: Result mimetype, detected if omitted
+        '''
+
+        if content_type is None:
+            content_type = BaseEngine.get_mimetype(image_bytes)
         doc = {
-            'key': self.get_key_from_request(),
-            'created_at': datetime.utcnow()
+            'key': key,
+            'created_at': datetime.utcnow(),
+            'metadata': metadata or {},
         }
 
-        if self.context.config.get("MONGO_STORE_METADATA", False):
-            doc['metadata'] = dict(self.context.headers)
-        else:
-            doc['metadata'] = {}
-
         file_doc = dict(doc)
+        file_doc['content_type'] = content_type
+        file_doc['content_length'] = len(image_bytes)
+        file_doc['accessed_at'] = file_doc['created_at']
 
-        fs = MotorGridFSBucket(self.database)
-        file_id = await fs.upload_from_stream(
+        connector = self.route(file_doc['key'], 'put')
+        file_doc.update(connector.key_fields(file_doc['key']))
+        index_doc = connector.schema.compact(file_doc)
+        await connector.pipeline.put(
             filename=file_doc.get('key'),
-            source=image_bytes,
-            metadata=file_doc
+            data=image_bytes,
+            index_doc=index_doc,
+            chunk_size=self.get_chunk_size(len(image_bytes)),
+            metadata=connector.schema.gridfs_metadata(doc)
         )
 
-        file_doc['file_id'] = file_id
-        file_doc['content_type'] = BaseEngine.get_mimetype(image_bytes)
-        file_doc['content_length'] = len(image_bytes)
+        if connector.local_cache:
+            connector.local_cache.set(
+                file_doc['key'],
+                self.cache_value(expand(index_doc), image_bytes),
+                len(image_bytes)
+            )
+
+    async def store_variant(self, key, preferred, image_bytes, metadata=None,
+                            content_type=None):
+        '''Save a result as a variant of a multi-variant document.
+
+        The file of the variant it replaces, if any, is removed. If thumbor
+        did not convert the result to the ``preferred`` variant, that
+        variant is recorded as unavailable instead of being reported
+        missing on every read.
+
+        :param string key: Multi-variant document key
+        :param string preferred: Variant thumbor negotiated for the request
+        :param bytes image_bytes: Result contents
+        :param dict metadata: Stored metadata
+        :param string content_type: Result mimetype, detected if omitted
+        '''
 
-        await self.storage.insert_one(file_doc)
-        return self.context.request.url
+        if content_type is None:
+            content_type = BaseEngine.get_mimetype(image_bytes)
+        name = self.variant_name(preferred, content_type)
+        variant = {
+            'created_at': datetime.utcnow(),
+            'content_type': content_type,
+            'content_length': len(image_bytes),
+            'metadata': metadata or {},
+        }
+
+        connector = self.route(key, 'put')
+        written = {}
+
+        async def write_index(file_id, session):
+            variant['file_id'] = file_id
+            written['id'], written['previous'] = await connector.write_variant(
+                key, name, variant,
+                unavailable=preferred if preferred != name else None,
+                session=session,
+            )
+
+        await connector.pipeline.put(
+            filename=key,
+            data=image_bytes,
+            index_doc=None,
+            chunk_size=self.get_chunk_size(len(image_bytes)),
+            write_index=write_index,
+        )
 
+        previous = written['previous']
+        if previous and 'file_id' in previous:
+            await connector.pipeline.cleanup(previous['file_id'])
+
+        if connector.local_cache:
+            variant['_id'] = written['id']
+            connector.local_cache.set(
+                f"{key}/{name}", self.cache_value(variant, image_bytes),
+                len(image_bytes)
+            )
+
+    @profiled('result_storage.get')
     @OnException(on_mongodb_error, PyMongoError)
     async def get(self):
         '''Get the item from MongoDB.'''
 
         key = self.get_key_from_request()
-        age = datetime.utcnow() - timedelta(
-            seconds=self.get_max_age()
+        get_from = self.get_from
+        if self.variants_enabled:
+            get_from = self.get_variant_from
+
+        connector = self.route(key, 'get')
+        if connector.leases and await self.is_refresh(connector):
+            # Render again instead of serving the stale result.
+            return None
+
+        result = await get_from(connector, key)
+        if result is None:
+            name, previous = self.router.previous_owner(key)
+            if previous is not None:
+                self.incr_metric(name, 'get.fallback')
+                result = await get_from(previous, key)
+        if result is None and self.get_render_lease_seconds():
+            result = await self.wait_for_render(connector, key, get_from)
+        return result
+
+    async def wait_for_render(self, connector, key, get_from):
+        '''Render a missing result once across the fleet.
+
+        The first process missing the result acquires the render lease and
+        renders it, ``put`` releases the lease. Others poll the lookup with
+        a doubling delay, for up to ``MONGO_RESULT_STORAGE_RENDER_WAIT``
+        seconds, before rendering the result themselves. Once a wait timed
+        out, the process renders the result without waiting until the
+        lease expires.
+
+        :returns: The result rendered by another process, or None
+        :rtype: ResultStorageResult
+        '''
+
+        config = self.context.config
+        name = self.lease_name('render')
+        if name in TIMED_OUT_RENDERS:
+            self.incr_metric('render', 'wait.skip')
+            return None
+
+        token = uuid4().hex
+        if await connector.leases.acquire(
+            name, token, self.get_render_lease_seconds()
+        ):
+            self.render_token = token
+            return None
+
+        self.incr_metric('render', 'wait')
+        wait = config.get('MONGO_RESULT_STORAGE_RENDER_WAIT', 2)
+        for delay in backoff(wait):
+            await asyncio.sleep(delay)
+            result = await get_from(connector, key)
+            if result is not None:
+                self.incr_metric('render', 'wait.hit')
+                return result
+        self.incr_metric('render', 'wait.timeout')
+        TIMED_OUT_RENDERS.add(name, self.get_render_lease_seconds())
+        return None
+
+    def refresh_token(self):
+        '''Return the lease token sent by a background refresh, if any.
+        :rtype: string
+        '''
+
+        headers = self.context.request.headers
+        return headers.get(REFRESH_HEADER) if headers else None
+
+    def lease_name(self, kind):
+        '''Return the name of a lease on the current result.
+        :param string kind: ``refresh`` or ``render``
+        :rtype: string
+        '''
+
+        name = f"{kind}:{self.get_key_from_request()}"
+        if self.variants_enabled:
+            return f"{name}/{self.accepted_variants()[0]}"
+        return name
+
+    async def is_refresh(self, connector):
+        '''Return whether the request is a background refresh.
+
+        Only requests holding the refresh lease are trusted, so clients
+        cannot bypass the result storage by sending the header.
+
+        :rtype: bool
+        '''
+
+        token = self.refresh_token()
+        if not token:
+            return False
+        return await connector.leases.holds(self.lease_name('refresh'), token)
+
+    def revalidate(self, connector, result):
+        '''Mark a result served past its TTL and refresh it off the request.
+        :param MongoConnector connector: Connector of the cluster owning it
+        :param ResultStorageResult result: Served result
+        '''
+
+        result.metadata['Stale'] = True
+        self.incr_metric('stale', 'get')
+
+        # Thumbor cleans the request context up once it responded.
+        name = self.lease_name('refresh')
+        if name in REFRESHING:
+            return
+
+        timeout = self.context.config.get(
+            'MONGO_RESULT_STORAGE_REFRESH_TIMEOUT', 60
         )
-        stored = await self.storage.find_one({
-            'key': key,
-            'created_at': {
-                '$gte': age
-            },
-        }, {
-            'file_id': True,
-            'created_at': True,
-            'metadata': True,
-            'content_type': True,
-            'content_length': True,
-        })
+        headers = {}
+        accept = (self.context.request.headers or {}).get('Accept')
+        if accept:
+            headers['Accept'] = accept
+        REFRESHING.add(name, timeout)
+        IOLoop.current().spawn_callback(
+            self.refresh, connector.leases, name, self.refresh_url(), headers,
+            timeout
+        )
+
+    @staticmethod
+    async def refresh(leases, name, url, headers, timeout):
+        '''Render a result again through thumbor.
+
+        The request is sent back to thumbor with the client's ``Accept``
+        header, so the same result is negotiated, and stored by ``put``,
+        which releases the lease. Only the holder of the lease renders it
+        across the fleet, and the process does not spawn another refresh of
+        it until this one is done.
+
+        :param LeaseManager leases: Leases of the cluster owning the result
+        :param string name: Refresh lease name
+        :param string url: Url to request
+        :param dict headers: Request headers
+        :param float timeout: Request timeout and lease TTL in seconds
+        '''
+
+        token = uuid4().hex
+        try:
+            if not await leases.acquire(name, token, timeout):
+                return
+            try:
+                await AsyncHTTPClient().fetch(
+                    url, headers=dict(headers, **{REFRESH_HEADER: token}),
+                    request_timeout=timeout
+                )
+            except (HTTPClientError, OSError) as exc:
+                logger.warning(
+                    f"[MONGODB_RESULT_STORAGE] refresh of {name} failed: {exc}"
+                )
+                await leases.release(name, token)
+        except PyMongoError as exc:
+            logger.error(f"[MONGODB_RESULT_STORAGE] refresh of {name}: {exc}")
+        finally:
+            REFRESHING.discard(name)
+
+    def refresh_url(self):
+        '''Return the url background refreshes are requested at.
+        :rtype: string
+        '''
+
+        base = self.context.config.get('MONGO_RESULT_STORAGE_REFRESH_URL')
+        if not base:
+            base = f"http://127.0.0.1:{self.context.server.port}"
+        return f"{base.rstrip('/')}/{self.context.request.url.lstrip('/')}"
+
+    @staticmethod
+    def select_variant(doc, accepted, is_usable):
+        '''Return the best stored variant for a client.
+        :param dict doc: Multi-variant document
+        :param list accepted: Variants the client accepts, preferred first
+        :param callable is_usable: Whether a creation time can be served
+        :returns: The variant name, or None, and the better variants that
+            are missing
+        :rtype: tuple
+        '''
 
+        variants = doc.get('variants', {})
+        unavailable = doc.get('unavailable', [])
+        missing = []
+        for name in accepted:
+            variant = variants.get(name)
+            if variant and is_usable(variant['created_at']):
+                return name, missing
+            if name not in unavailable:
+                missing.append(name)
+        return None, missing
+
+    async def get_variant_from(self, connector, key):
+        accepted = self.accepted_variants()
+        cache = connector.local_cache
+        tracker = connector.access_tracker
+        if cache:
+            # Only the preferred variant is served without a lookup.
+            cached = cache.get(f"{key}/{accepted[0]}")
+            if cached and not self.is_expired(cached[1]):
+                if tracker:
+                    tracker.record(cached[0])
+                return ResultStorageResult(
+                    buffer=cached[2],
+                    metadata=dict(cached[3]),
+                    successful=True
+                )
+
+        stored = await self.lookup(connector, 'get_variants', key)
         if not stored:
             return None
 
-        fs = MotorGridFSBucket(self.database)
-        grid_out = await fs.open_download_stream(stored['file_id'])
-        contents = await grid_out.read()
+        name, missing = self.select_variant(stored, accepted, self.is_usable)
+        if name is None:
+            # Nothing to serve, thumbor renders the preferred variant.
+            return None
 
-        metadata = stored['metadata']
-        metadata['LastModified'] = stored['created_at'].replace(
-            tzinfo=pytz.utc
+        if missing:
+            await self.report_missing(connector, key, stored, missing)
+        if tracker:
+            tracker.record(stored['_id'])
+
+        variant = dict(stored['variants'][name], _id=stored['_id'])
+        try:
+            contents = await connector.reader.read(
+                variant['file_id'], variant.get('content_length')
+            )
+        except NoFile:
+            # Evicted between the index lookup and the download.
+            return None
+
+        stale = self.is_expired(variant['created_at'])
+        if cache and name == accepted[0] and not stale:
+            cache.set(
+                f"{key}/{name}", self.cache_value(variant, contents),
+                len(contents)
+            )
+        result = ResultStorageResult(
+            buffer=contents,
+            metadata=self.build_metadata(variant),
+            successful=True
         )
-        metadata['ContentLength'] = stored['content_length']
-        metadata['ContentType'] = stored['content_type']
-        return ResultStorageResult(
+        if stale:
+            self.revalidate(connector, result)
+        return result
+
+    async def report_missing(self, connector, key, doc, missing):
+        '''Report the better variants missing for a served result.
+
+        They are exposed in ``missing_variants``, counted in metrics and
+        recorded in the document, where :meth:`find_missing_variants` finds
+        them.
+        '''
+
+        self.missing_variants = missing
+        for name in missing:
+            self.incr_metric('variants', f"missing.{name}")
+
+        recorded = doc.get('missing', [])
+        new = [name for name in missing if name not in recorded]
+        if new:
+            await connector.update(
+                key, {'missing': {'$each': new}}, '$addToSet'
+            )
+
+    async def find_missing_variants(self, limit=100):
+        '''Yield the urls of results with missing variants.
+        :param int limit: Maximum documents read per cluster and schema
+        :returns: ``(url, variants)`` pairs
+        :rtype: async generator
+        '''
+
+        for connector in self.router.connectors.values():
+            for schema in connector.schemas:
+                missing = schema.field('missing')
+                cursor = connector.col_conn.find(
+                    {missing: {'$exists': True, '$ne': []}},
+                    {schema.field('key'): True, missing: True},
+                ).limit(limit)
+                async for doc in cursor:
+                    doc = schema.expand(doc)
+                    url = doc['key'][len(VARIANTS_KEY_PREFIX):]
+                    yield url, doc['missing']
+
+    async def get_from(self, connector, key):
+        cache = connector.local_cache
+        tracker = connector.access_tracker
+        if cache:
+            cached = cache.get(key)
+            if cached and not self.is_expired(cached[1]):
+                if tracker:
+                    tracker.record(cached[0])
+                return ResultStorageResult(
+                    buffer=cached[2],
+                    metadata=dict(cached[3]),
+                    successful=True
+                )
+
+        stored = await self.lookup(connector, 'get', key)
+
+        if not stored:
+            return None
+
+        if tracker:
+            tracker.record(stored['_id'])
+
+        try:
+            contents, stored['metadata'] = await asyncio.gather(
+                connector.reader.read(
+                    stored['file_id'], stored.get('content_length')
+                ),
+                self.get_metadata(connector, stored['_id']),
+            )
+        except NoFile:
+            # Evicted between the index lookup and the download.
+            return None
+
+        stale = self.is_expired(stored['created_at'])
+        if cache and not stale:
+            cache.set(key, self.cache_value(stored, contents), len(contents))
+        result = ResultStorageResult(
             buffer=contents,
-            metadata=metadata,
+            metadata=self.build_metadata(stored),
             successful=True
         )
+        if stale:
+            self.revalidate(connector, result)
+        return result
 
     @deprecated("Use result's last_modified instead")
     def last_updated(self):
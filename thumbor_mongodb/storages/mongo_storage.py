@@ -6,12 +6,26 @@
 # Copyright (c) 2011 globo.com timehome@corp.globo.com
 
 from datetime import datetime, timedelta
-from motor.motor_tornado import MotorGridFSBucket
+from gridfs.errors import NoFile
 from pymongo.errors import PyMongoError
+from thumbor.engines import BaseEngine
 from thumbor.storages import BaseStorage
 from thumbor.utils import logger
-from thumbor_mongodb.utils import OnException
+from thumbor_mongodb.utils import (
+    AUTO_CHUNK_SIZE_LIMIT, OnException, get_chunk_size
+)
 from thumbor_mongodb.mongodb.connector_storage import MongoConnector
+from thumbor_mongodb.mongodb.profiler import get_profiler, profiled
+from thumbor_mongodb.mongodb.routing import (
+    DEFAULT_VIRTUAL_NODES, ClusterRouter, cluster_names
+)
+from thumbor_mongodb.mongodb.schema import expand
+
+# BaseEngine.get_mimetype looks for an svg element in the first 2048 bytes.
+MIMETYPE_HEAD_SIZE = 2048
+
+# Lookups answered from the covering indexes alone.
+COVERED_LOOKUPS = ('exists', 'get')
 
 
 class Storage(BaseStorage):
@@ -22,43 +36,157 @@ class Storage(BaseStorage):
         :param thumbor.context.Context shared_client: Current context
         '''
         BaseStorage.__init__(self, context)
-        self.database, self.storage = self.__conn__()
+        self.profiler = get_profiler(context.config)
+        self.router = self.__conn__()
+        self.connector = next(iter(self.router.connectors.values()))
+        self.database = self.connector.db_conn
+        self.storage = self.connector.col_conn
         super(Storage, self).__init__(context)
 
     def __conn__(self):
-        '''Return the MongoDB database and collection object.
-        :returns: MongoDB DB and Collection
-        :rtype: pymongo.database.Database, pymongo.database.Collection
+        '''Return the router over the MongoDB clusters of this storage.
+        :returns: Router holding one connector per cluster
+        :rtype: ClusterRouter
         '''
 
-        db_name = self.context.config.MONGO_STORAGE_SERVER_DB
-        col_name = self.context.config.MONGO_STORAGE_SERVER_COLLECTION
-        uri = None
+        config = self.context.config
         host = None
         port = None
-        try:
-            uri = self.context.config.MONGO_STORAGE_URI
-        except AttributeError:
-            pass
-
         try:
             host = self.context.config.MONGO_STORAGE_SERVER_HOST
             port = self.context.config.MONGO_STORAGE_SERVER_PORT
         except AttributeError:
             pass
 
+        clusters = cluster_names(
+            'MONGO_STORAGE_URI', config.get('MONGO_STORAGE_URI'), host, port
+        )
+        connectors = {
+            name: self.connect(uri, host, port)
+            for name, uri in clusters.items()
+        }
+        previous = {}
+        if config.get('MONGO_STORAGE_PREVIOUS_URI'):
+            previous = {
+                name: self.connect(uri, host, port)
+                for name, uri in cluster_names(
+                    'MONGO_STORAGE_PREVIOUS_URI',
+                    config.get('MONGO_STORAGE_PREVIOUS_URI'),
+                    host, port, clusters
+                ).items()
+            }
+
+        return ClusterRouter(
+            connectors,
+            previous,
+            config.get('MONGO_STORAGE_VIRTUAL_NODES', DEFAULT_VIRTUAL_NODES),
+        )
+
+    def connect(self, uri, host, port):
+        '''Return the MongoDB connector of a single cluster.
+        :returns: MongoDB connector holding the DB and Collection
+        :rtype: MongoConnector
+        '''
+
+        config = self.context.config
         mongo_conn = MongoConnector(
-            db_name=db_name,
-            col_name=col_name,
+            db_name=config.MONGO_STORAGE_SERVER_DB,
+            col_name=config.MONGO_STORAGE_SERVER_COLLECTION,
             uri=uri,
             host=host,
             port=port,
+            hashed_key=config.get('MONGO_STORAGE_HASHED_KEY', False),
+            driver=config.get('MONGO_STORAGE_DRIVER'),
+            schema_version=config.get('MONGO_STORAGE_SCHEMA_VERSION', 1),
+            legacy_reads=config.get('MONGO_STORAGE_LEGACY_READS', True),
+        )
+
+        mongo_conn.setup_eviction(
+            sample_rate=config.get('MONGO_STORAGE_ACCESS_SAMPLE_RATE', 0),
+            flush_interval=config.get(
+                'MONGO_STORAGE_ACCESS_FLUSH_INTERVAL', 10
+            ),
+            max_bytes=config.get('MONGO_STORAGE_MAX_BYTES', 0),
+            interval=config.get('MONGO_STORAGE_EVICTION_INTERVAL', 60),
+            batch_size=config.get('MONGO_STORAGE_EVICTION_BATCH_SIZE', 100),
+        )
+        mongo_conn.setup_sweeper(
+            interval=config.get('MONGO_STORAGE_ORPHAN_SWEEP_INTERVAL', 0),
+            age=config.get('MONGO_STORAGE_ORPHAN_AGE', 3600),
+        )
+        mongo_conn.setup_cache(config.get('MONGO_STORAGE_LOCAL_CACHE_SIZE', 0))
+        mongo_conn.setup_migration(
+            batch_size=config.get('MONGO_STORAGE_MIGRATION_BATCH_SIZE', 0),
+            interval=config.get('MONGO_STORAGE_MIGRATION_INTERVAL', 1),
         )
+        if self.profiler:
+            self.profiler.attach(mongo_conn.db_conn)
+
+        return mongo_conn
+
+    async def warm_up(self):
+        '''Preload the local cache of every cluster with popular entries.
+        :returns: Number of entries loaded
+        :rtype: int
+        '''
+
+        config = self.context.config
+        loaded = 0
+        for connector in self.router.connectors.values():
+            loaded += await connector.warm_up(
+                config.get('MONGO_STORAGE_WARMUP_COUNT', 0),
+                config.get('MONGO_STORAGE_WARMUP_MAX_BYTES', 0),
+                config.get('MONGO_STORAGE_WARMUP_TIMEOUT', 30),
+                self.cache_value,
+            )
+        return loaded
 
-        database = mongo_conn.db_conn
-        storage = mongo_conn.col_conn
+    @staticmethod
+    def profile_key(path, *args):
+        return path
+
+    def incr_metric(self, cluster, operation):
+        metrics = getattr(self.context, 'metrics', None)
+        if metrics:
+            metrics.incr(f"mongodb.storage.{cluster}.{operation}")
+
+    def route(self, path, operation):
+        '''Return the connector of the cluster owning the path.
+        :param string path: Image path
+        :param string operation: Operation name, used for metrics
+        :rtype: MongoConnector
+        '''
+
+        name, connector = self.router.route(path)
+        self.incr_metric(name, operation)
+        return connector
+
+    def owners(self, path, operation):
+        '''Return the current and, while rebalancing, previous owners.
+        :rtype: list
+        '''
+
+        connectors = [self.route(path, operation)]
+        name, previous = self.router.previous_owner(path)
+        if previous is not None:
+            self.incr_metric(name, f"{operation}.previous")
+            connectors.append(previous)
+        return connectors
+
+    async def read(self, operation, fetch, path):
+        '''Fetch from the owner, then from the previous owner on a miss.
+        :param string operation: Operation name, used for metrics
+        :param callable fetch: Coroutine function taking a connector and path
+        :param string path: Image path
+        '''
 
-        return database, storage
+        result = await fetch(self.route(path, operation), path)
+        if result is None or result is False:
+            name, previous = self.router.previous_owner(path)
+            if previous is not None:
+                self.incr_metric(name, f"{operation}.fallback")
+                result = await fetch(previous, path)
+        return result
 
     def on_mongodb_error(self, fname, exc_type, exc_value):
         '''Callback executed when there is a mongo error.
@@ -83,8 +211,87 @@ class Storage(BaseStorage):
 
         return self.context.config.STORAGE_EXPIRATION_SECONDS
 
-    @OnException(on_mongodb_error, PyMongoError)
-    async def put(self, path, file_bytes):
+    def get_chunk_size(self, length):
+        '''Return the GridFS chunk size for a file of the given length.
+        :param int length: File length in bytes
+        :returns: Chunk size in bytes, or None for the bucket default
+        :rtype: int
+        '''
+
+        return get_chunk_size(
+            length,
+            self.context.config.get('MONGO_STORAGE_CHUNK_SIZE'),
+            self.context.config.get('MONGO_STORAGE_CHUNK_SIZE_CLASSES'),
+        )
+
+    def expiration_conditions(self):
+        '''Return the ``created_at`` condition of the current TTL.
+        :returns: Conditions on version 1 field names, empty without a TTL
+        :rtype: dict
+        '''
+
+        max_age = self.get_max_age()
+        if not max_age:
+            return {}
+        return {'created_at': {
+            '$gte': datetime.utcnow() - timedelta(seconds=max_age)
+        }}
+
+    def lookups(self):
+        '''Return the projected fields and conditions of each lookup.
+        :returns: ``(names, conditions)`` by operation name
+        :rtype: dict
+        '''
+
+        expiration = self.expiration_conditions()
+        return {
+            'exists': (('_id',), expiration),
+            'get': (
+                ('file_id', 'created_at', 'content_length'), expiration
+            ),
+            'get_crypto': (('crypto',), {}),
+            'get_detector_data': (
+                ('detector_data',), {'detector_data': {'$ne': None}}
+            ),
+        }
+
+    def lookup(self, connector, operation, path):
+        '''Run the lookup of an operation against a connector.
+        :returns: Document with version 1 field names, or None
+        :rtype: dict
+        '''
+
+        names, conditions = self.lookups()[operation]
+        return connector.find_one(path, names, **conditions)
+
+    def is_expired(self, created_at):
+        '''Return whether an entry created at the given time is expired.
+        :param datetime.datetime created_at: Entry creation time
+        :rtype: bool
+        '''
+
+        max_age = self.get_max_age()
+        if not max_age:
+            return False
+        return created_at < datetime.utcnow() - timedelta(seconds=max_age)
+
+    @staticmethod
+    def cache_value(doc, contents):
+        '''Return the local cache value for an index document.
+        :param dict doc: Index document
+        :param bytes contents: Stored file contents
+        :rtype: tuple
+        '''
+
+        return doc['_id'], doc['created_at'], contents
+
+    def build_documents(self, path):
+        '''Return the GridFS metadata and the index document for a path.
+        :param string path: Image path
+        :returns: GridFS metadata and index document
+        :rtype: tuple
+        '''
+
         doc = {
             'path': path,
             'created_at': datetime.utcnow()
@@ -99,16 +306,87 @@ class Storage(BaseStorage):
                         if no SECURITY_KEY specified")
             doc_with_crypto['crypto'] = self.context.server.security_key
 
-        fs = MotorGridFSBucket(self.database)
-        file_id = await fs.upload_from_stream(
+        doc_with_crypto['accessed_at'] = doc['created_at']
+        return doc, doc_with_crypto
+
+    @profiled('storage.put')
+    @OnException(on_mongodb_error, PyMongoError)
+    async def put(self, path, file_bytes):
+        connector = self.route(path, 'put')
+        doc, doc_with_crypto = self.build_documents(path)
+        doc_with_crypto.update(connector.key_fields(path))
+        doc_with_crypto['content_type'] = BaseEngine.get_mimetype(file_bytes)
+        doc_with_crypto['content_length'] = len(file_bytes)
+        index_doc = connector.schema.compact(doc_with_crypto)
+
+        await connector.pipeline.put(
             filename=doc.get('path'),
-            source=file_bytes,
-            metadata=doc
+            data=file_bytes,
+            index_doc=index_doc,
+            chunk_size=self.get_chunk_size(len(file_bytes)),
+            metadata=connector.schema.gridfs_metadata(doc)
+        )
+
+        if connector.local_cache:
+            connector.local_cache.set(
+                path, self.cache_value(expand(index_doc), file_bytes),
+                len(file_bytes)
+            )
+        return path
+
+    @profiled('storage.put_stream')
+    @OnException(on_mongodb_error, PyMongoError)
+    async def put_stream(self, path, chunks, length_hint=None):
+        '''Save an image from an async iterator of byte chunks.
+
+        Chunks are written to GridFS as they arrive, so at most one GridFS
+        chunk is buffered in memory regardless of the image size.
+
+        :param string path: Image path
+        :param chunks: Async iterable of bytes
+        :param int length_hint: Expected length, used to pick the chunk size
+        :returns: The image path
+        :rtype: string
+        '''
+
+        connector = self.route(path, 'put')
+        doc, doc_with_crypto = self.build_documents(path)
+        doc_with_crypto.update(connector.key_fields(path))
+        if length_hint is None:
+            length_hint = AUTO_CHUNK_SIZE_LIMIT
+
+        grid_in = connector.fs.open_upload_stream(
+            path,
+            chunk_size_bytes=self.get_chunk_size(length_hint),
+            metadata=connector.schema.gridfs_metadata(doc)
         )
-        doc_with_crypto['file_id'] = file_id
-        await self.storage.insert_one(doc_with_crypto)
+        head = b''
+        try:
+            async for chunk in chunks:
+                if len(head) < MIMETYPE_HEAD_SIZE:
+                    head += chunk[:MIMETYPE_HEAD_SIZE - len(head)]
+                await grid_in.write(chunk)
+            await grid_in.close()
+        except BaseException:
+            await grid_in.abort()
+            raise
+
+        doc_with_crypto['file_id'] = grid_in._id
+        doc_with_crypto['content_type'] = BaseEngine.get_mimetype(head)
+        doc_with_crypto['content_length'] = grid_in.length
+        try:
+            await connector.col_conn.insert_one(
+                connector.schema.compact(doc_with_crypto)
+            )
+        except BaseException:
+            await connector.pipeline.cleanup(grid_in._id)
+            raise
+
+        if connector.local_cache:
+            connector.local_cache.delete(path)
         return path
 
+    @profiled('storage.put_crypto')
     @OnException(on_mongodb_error, PyMongoError)
     async def put_crypto(self, path):
         if not self.context.config.STORES_CRYPTO_KEY_FOR_EACH_IMAGE:
@@ -118,68 +396,104 @@ class Storage(BaseStorage):
             raise RuntimeError("STORES_CRYPTO_KEY_FOR_EACH_IMAGE can't be \
                 True if no SECURITY_KEY specified")
 
-        await self.storage.update_one(
-            {'path': path},
-            {'$set': {'crypto': self.context.server.security_key}}
-        )
+        for connector in self.owners(path, 'put_crypto'):
+            await connector.update(
+                path, {'crypto': self.context.server.security_key}
+            )
         return path
 
+    @profiled('storage.put_detector_data')
     @OnException(on_mongodb_error, PyMongoError)
     async def put_detector_data(self, path, data):
-        await self.storage.update_many(
-            {'path': path}, {"$set": {"detector_data": data}}
-        )
+        for connector in self.owners(path, 'put_detector_data'):
+            await connector.update(path, {'detector_data': data})
         return path
 
+    @profiled('storage.get_crypto')
     @OnException(on_mongodb_error, PyMongoError)
     async def get_crypto(self, path):
-        crypto = await self.storage.find_one({'path': path})
+        return await self.read('get_crypto', self.get_crypto_from, path)
+
+    async def get_crypto_from(self, connector, path):
+        crypto = await self.lookup(connector, 'get_crypto', path)
         return crypto.get('crypto') if crypto else None
 
+    @profiled('storage.get_detector_data')
     @OnException(on_mongodb_error, PyMongoError)
     async def get_detector_data(self, path):
-        doc = await self.storage.find_one({
-            'path': path,
-            'detector_data': {'$ne': None},
-        }, {
-            'detector_data': True,
-        })
+        return await self.read(
+            'get_detector_data', self.get_detector_data_from, path
+        )
+
+    async def get_detector_data_from(self, connector, path):
+        doc = await self.lookup(connector, 'get_detector_data', path)
 
         return doc.get('detector_data') if doc else None
 
+    @profiled('storage.get')
     @OnException(on_mongodb_error, PyMongoError)
     async def get(self, path):
-        now = datetime.utcnow()
-        query = {'path': path}
-        if self.get_max_age():
-            query['created_at'] = {
-                '$gte': now - timedelta(seconds=self.get_max_age())
-            }
-        stored = await self.storage.find_one(query, {'file_id': True})
+        return await self.read('get', self.get_from, path)
+
+    async def get_from(self, connector, path):
+        cache = connector.local_cache
+        tracker = connector.access_tracker
+        if cache:
+            cached = cache.get(path)
+            if cached and not self.is_expired(cached[1]):
+                if tracker:
+                    tracker.record(cached[0])
+                return cached[2]
+
+        stored = await self.lookup(connector, 'get', path)
 
         if not stored:
             return None
 
-        fs = MotorGridFSBucket(self.database)
-        grid_out = await fs.open_download_stream(stored['file_id'])
-        return await grid_out.read()
+        if tracker:
+            tracker.record(stored['_id'])
 
+        try:
+            contents = await connector.reader.read(
+                stored['file_id'], stored.get('content_length')
+            )
+        except NoFile:
+            # Evicted between the index lookup and the download.
+            return None
+
+        if cache:
+            cache.set(path, self.cache_value(stored, contents), len(contents))
+        return contents
+
+    @profiled('storage.exists')
     @OnException(on_mongodb_error, PyMongoError)
     async def exists(self, path):
-        return await self.storage.count_documents({
-            'path': path,
-            'created_at': {
-                '$gte':
-                    datetime.utcnow() - timedelta(seconds=self.get_max_age())
-            },
-        }, limit=1) >= 1
+        return await self.read('exists', self.exists_in, path)
+
+    async def exists_in(self, connector, path):
+        return await self.lookup(connector, 'exists', path) is not None
 
+    @profiled('storage.remove')
     @OnException(on_mongodb_error, PyMongoError)
     async def remove(self, path):
-        await self.storage.delete_many({'path': path})
+        for connector in self.owners(path, 'remove'):
+            if connector.local_cache:
+                connector.local_cache.delete(path)
+            query = connector.query(path)
+            if not connector.hashed_key:
+                await connector.col_conn.delete_many(query)
+                await connector.pipeline.delete(path)
+                continue
 
-        fs = MotorGridFSBucket(self.database)
-        cursor = fs.find({'path': path})
-        while await cursor.fetch_next:
-            grid_data = cursor.next_object()
-            await fs.delete(grid_data["_id"])
+            # fs.files is sharded on _id, so look the files up by the ids
+            # held in the index documents instead of their filename.
+            docs = await connector.col_conn.find(
+                query, connector.projection('file_id')
+            ).to_list(length=None)
+            await connector.col_conn.delete_many(query)
+            file_ids = [
+                doc['file_id'] for doc in map(expand, docs)
+                if 'file_id' in doc
+            ]
+            if file_ids:
+                await connector.pipeline.delete_files(file_ids)
@@ -0,0 +1,781 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/mit-license
+# Copyright (c) 2020 Eka Cahya Pratama <ekapratama93@gmail.com>
+
+'''Copy images between thumbor storages and MongoDB.
+
+``import`` loads originals and results into the MongoDB storages enabled in
+a thumbor configuration, from a thumbor file storage tree, another MongoDB
+database or an archive written by ``export``. Entries are copied by a
+bounded pool of workers, and the position below which every entry was
+copied is saved to a checkpoint file, so an interrupted import resumes
+where it stopped.
+
+``export`` streams every entry of the enabled storages to a tar archive.
+
+Usage::
+
+    thumbor-mongodb-transfer import -c thumbor.conf --file-storage ROOT \\
+        --paths PATHS [--checkpoint FILE] [-j JOBS]
+    thumbor-mongodb-transfer import -c thumbor.conf \\
+        --file-result-storage ROOT [--paths URLS]
+    thumbor-mongodb-transfer import -c thumbor.conf --from-uri URI \\
+        --from-db DB [--from-collection COLLECTION]
+    thumbor-mongodb-transfer import -c thumbor.conf --archive FILE
+    thumbor-mongodb-transfer export -c thumbor.conf [-o FILE] [-z]
+'''
+
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+from collections import deque, namedtuple
+from functools import partial
+from importlib import import_module
+from urllib.parse import unquote
+
+from bson import json_util
+from pymongo import ASCENDING
+from thumbor.config import Config
+from thumbor.context import Context, ServerParameters
+import pytz
+
+from thumbor_mongodb.explain import STORAGES
+from thumbor_mongodb.mongodb.driver import get_driver
+from thumbor_mongodb.mongodb.schema import expand
+
+READ_SIZE = 255 * 1024
+MEGABYTE = 1024 * 1024
+
+# Entry kinds and the configuration option enabling their storage.
+KINDS = {
+    'storage': 'STORAGE',
+    'result_storage': 'RESULT_STORAGE',
+}
+# Index document fields carried along an entry, stored as archive headers.
+ENTRY_FIELDS = ('content_type', 'metadata', 'detector_data')
+JSON_FIELDS = ('metadata', 'detector_data')
+PAX_PREFIX = 'THUMBOR.'
+
+# Entries without ``chunks`` cannot be copied, and are counted as skipped.
+Entry = namedtuple(
+    'Entry', ['position', 'kind', 'key', 'length', 'chunks', 'fields']
+)
+
+
+async def read_file(filename, size=READ_SIZE):
+    '''Yield the contents of a file, read outside of the event loop.'''
+
+    loop = asyncio.get_event_loop()
+    with open(filename, 'rb') as image_file:
+        while True:
+            chunk = await loop.run_in_executor(None, image_file.read, size)
+            if not chunk:
+                return
+            yield chunk
+
+
+async def read_gridfs(bucket, file_id):
+    '''Yield the chunks of a GridFS file.'''
+
+    grid_out = await bucket.open_download_stream(file_id)
+    while True:
+        chunk = await grid_out.readchunk()
+        if not chunk:
+            return
+        yield chunk
+
+
+async def read_bytes(contents):
+    yield contents
+
+
+async def counted(chunks, progress):
+    '''Yield ``chunks`` while adding their size to the progress.'''
+
+    async for chunk in chunks:
+        progress.bytes += len(chunk)
+        yield chunk
+
+
+def walk(root, after=None):
+    '''Yield the files under a directory, relative to it, in a stable order.
+
+    Files are sorted by path components, so the files up to ``after``, a
+    path previously yielded, are skipped without listing the directories
+    they are in.
+
+    :param string root: Directory to walk
+    :param string after: Relative path to resume after
+    :rtype: generator
+    '''
+
+    after = tuple(after.split('/')) if after else ()
+
+    def visit(parts):
+        with os.scandir(os.path.join(root, *parts)) as entries:
+            names = sorted((entry.name, entry.is_dir()) for entry in entries)
+        for name, is_dir in names:
+            current = parts + (name,)
+            if current < after[:len(current)]:
+                continue
+            if is_dir:
+                yield from visit(current)
+            elif current > after:
+                yield '/'.join(current)
+
+    yield from visit(())
+
+
+def file_storage_path(root, path):
+    '''Return where thumbor's file storage keeps an original.
+    :rtype: string
+    '''
+
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return os.path.join(root, digest[:2], digest[2:])
+
+
+def file_result_storage_paths(root, url):
+    '''Return where thumbor's file result storage keeps the results of a url.
+    :returns: ``(key, filename)`` pairs, without and with ``AUTO_WEBP``
+    :rtype: list
+    '''
+
+    digest = hashlib.sha1(unquote(url).encode('utf-8')).hexdigest()
+    key = f"result:{url}"
+    return [
+        (key if prefix == 'default' else f"{key}/webp", os.path.join(
+            root, prefix, digest[:2], digest[2:4], digest[4:]
+        ))
+        for prefix in ('default', 'auto_webp')
+    ]
+
+
+def legacy_result_key(relative):
+    '''Return the result key of a file in the legacy file result layout.
+
+    That layout stores results under ``[webp/]<partition>/<url>``, where
+    the partition is made of the first four characters of the url.
+
+    :param string relative: Path relative to the result storage root
+    :returns: Result key, or None if the path is not in that layout
+    :rtype: string
+    '''
+
+    parts = relative.split('/')
+    webp = parts[0] == 'webp'
+    if webp:
+        parts = parts[1:]
+    if len(parts) < 3:
+        return None
+
+    url = '/'.join(parts[2:])
+    if parts[0] != url[:2] or parts[1] != url[2:4]:
+        return None
+
+    key = f"result:/{url}"
+    return f"{key}/webp" if webp else key
+
+
+def load_detector_data(filename):
+    '''Return the detector data saved next to a file storage original.'''
+
+    try:
+        with open(f"{filename}.detectors.txt", 'r') as detectors_file:
+            return json.loads(detectors_file.read())
+    except FileNotFoundError:
+        return None
+
+
+def read_lines(filename):
+    '''Yield the non empty lines of a file with their line number.'''
+
+    with open(filename, 'r') as lines_file:
+        for number, line in enumerate(lines_file, 1):
+            line = line.strip()
+            if line:
+                yield number, line
+
+
+class FileStorageSource:
+    '''Originals of a thumbor file storage.
+
+    The file storage only keeps a digest of each path, so the paths to
+    import are read from a file, one per line.
+    '''
+
+    def __init__(self, root, paths):
+        self.root = root
+        self.paths = paths
+
+    @property
+    def name(self):
+        return f"file_storage:{os.path.abspath(self.root)}"
+
+    async def entries(self, after=None):
+        for number, path in read_lines(self.paths):
+            if after and number <= after:
+                continue
+            filename = file_storage_path(self.root, path)
+            fields = {}
+            detector_data = load_detector_data(filename)
+            if detector_data:
+                fields['detector_data'] = detector_data
+            yield Entry(
+                number, 'storage', path, None,
+                partial(read_file, filename), fields
+            )
+
+
+class FileResultStorageSource:
+    '''Results of a thumbor file result storage.
+
+    Results are looked up by the urls read from a file, one per line, or
+    found by walking the tree when it uses the legacy layout, which keeps
+    the urls in the file names. The results of a url are positioned by its
+    line number and their index in :func:`file_result_storage_paths`.
+    '''
+
+    def __init__(self, root, urls=None):
+        self.root = root
+        self.urls = urls
+
+    @property
+    def name(self):
+        return f"file_result_storage:{os.path.abspath(self.root)}"
+
+    async def entries(self, after=None):
+        if self.urls:
+            after = tuple(after) if after else None
+            for number, url in read_lines(self.urls):
+                if after and number < after[0]:
+                    continue
+                paths = file_result_storage_paths(self.root, url)
+                for index, (key, filename) in enumerate(paths):
+                    position = (number, index)
+                    if after and position <= after:
+                        continue
+                    if os.path.exists(filename):
+                        yield Entry(
+                            position, 'result_storage', key, None,
+                            partial(read_file, filename), {}
+                        )
+            return
+
+        for relative in walk(self.root, after):
+            key = legacy_result_key(relative)
+            if key:
+                yield Entry(
+                    relative, 'result_storage', key, None,
+                    partial(read_file, os.path.join(self.root, relative)), {}
+                )
+
+
+class MongoSource:
+    '''Originals and results of a MongoDB storage collection.
+
+    Index documents of both schema versions are read in ``_id`` order.
+    Multi-variant result documents have no single file to copy, and are
+    yielded without chunks.
+    '''
+
+    def __init__(self, name, collection, bucket):
+        self.name = name
+        self.collection = collection
+        self.bucket = bucket
+
+    async def entries(self, after=None):
+        query = {'_id': {'$gt': after}} if after is not None else {}
+        cursor = self.collection.find(query).sort('_id', ASCENDING)
+        async for doc in cursor:
+            doc = expand(doc)
+            if 'path' in doc:
+                kind, key = 'storage', doc['path']
+            elif 'key' in doc:
+                kind, key = 'result_storage', doc['key']
+            else:
+                continue
+            if 'file_id' not in doc:
+                yield Entry(doc['_id'], kind, key, None, None, {})
+                continue
+
+            fields = {
+                name: doc[name] for name in ENTRY_FIELDS if doc.get(name)
+            }
+            if doc.get('created_at'):
+                fields['created_at'] = doc['created_at']
+            yield Entry(
+                doc['_id'], kind, key, doc.get('content_length'),
+                partial(read_gridfs, self.bucket, doc['file_id']), fields
+            )
+
+
+class ArchiveSource:
+    '''Entries of an archive written by ``export``.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @property
+    def name(self):
+        return f"archive:{os.path.abspath(self.filename)}"
+
+    async def entries(self, after=None):
+        with tarfile.open(self.filename, 'r|*') as archive:
+            for number, info in enumerate(archive, 1):
+                kind, _, name = info.name.partition('/')
+                if not info.isfile() or kind not in KINDS:
+                    continue
+                if after and number <= after:
+                    continue
+
+                contents = archive.extractfile(info).read()
+                yield Entry(
+                    number, kind,
+                    info.pax_headers.get(f"{PAX_PREFIX}key", name),
+                    len(contents), partial(read_bytes, contents),
+                    archive_fields(info),
+                )
+
+
+def archive_member(entry, size):
+    '''Return the archive member of an entry.
+
+    The exact key and the index document fields are stored as PAX headers.
+
+    :param Entry entry: Exported entry
+    :param int size: Entry contents length
+    :rtype: tarfile.TarInfo
+    '''
+
+    info = tarfile.TarInfo(f"{entry.kind}/{entry.key}")
+    info.size = size
+    created_at = entry.fields.get('created_at')
+    if created_at:
+        info.mtime = created_at.replace(tzinfo=pytz.utc).timestamp()
+
+    info.pax_headers = {f"{PAX_PREFIX}key": entry.key}
+    for name in ENTRY_FIELDS:
+        value = entry.fields.get(name)
+        if value:
+            info.pax_headers[f"{PAX_PREFIX}{name}"] = (
+                json.dumps(value) if name in JSON_FIELDS else str(value)
+            )
+    return info
+
+
+def archive_fields(info):
+    '''Return the index document fields stored along an archive member.
+    :rtype: dict
+    '''
+
+    fields = {}
+    for name in ENTRY_FIELDS:
+        value = info.pax_headers.get(f"{PAX_PREFIX}{name}")
+        if value:
+            fields[name] = json.loads(value) if name in JSON_FIELDS else value
+    return fields
+
+
+class Checkpoint:
+    '''Position below which every entry of a source was copied.
+
+    Entries complete out of order, so the position only moves past an entry
+    once every entry started before it has completed. It never moves past a
+    failed entry, so a resumed import retries it. Positions are saved as
+    extended JSON, so MongoDB ids survive a restart.
+    '''
+
+    def __init__(self, filename, source):
+        self.filename = filename
+        self.source = source
+        self.position = None
+        self.pending = deque()
+        self.failed = False
+        self.saved = True
+
+        if filename and os.path.exists(filename):
+            with open(filename, 'r') as checkpoint_file:
+                state = json_util.loads(checkpoint_file.read())
+            if state['source'] != source:
+                raise ValueError(
+                    f"Checkpoint {filename} belongs to {state['source']}"
+                )
+            self.position = state['position']
+
+    def start(self, position):
+        '''Record that the entry at ``position`` is being copied.
+        :returns: Marker to pass to :meth:`done`
+        :rtype: list
+        '''
+
+        marker = [position, False]
+        # Nothing started after a failure can move the position anymore.
+        if not self.failed:
+            self.pending.append(marker)
+        return marker
+
+    def done(self, marker, copied=True):
+        '''Record that an entry was copied, or failed when not ``copied``.'''
+
+        if not copied:
+            self.failed = True
+            return
+
+        marker[1] = True
+        while self.pending and self.pending[0][1]:
+            self.position = self.pending.popleft()[0]
+            self.saved = False
+
+    def save(self):
+        if self.saved or not self.filename:
+            return
+
+        temp_filename = f"{self.filename}.tmp"
+        with open(temp_filename, 'w') as checkpoint_file:
+            checkpoint_file.write(json_util.dumps({
+                'source': self.source,
+                'position': self.position,
+            }))
+        os.replace(temp_filename, self.filename)
+        self.saved = True
+
+
+class Progress:
+    '''Count the copied entries and bytes and report the throughput.'''
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.entries = 0
+        self.bytes = 0
+        self.errors = 0
+        self.skipped = 0
+
+    def skip(self, entry, out=sys.stderr):
+        '''Count and report an entry that cannot be copied.'''
+
+        self.skipped += 1
+        print(f"{entry.kind} {entry.key}: skipped, no single file", file=out)
+
+    def report(self):
+        elapsed = max(self.clock() - self.started, 1e-6)
+        megabytes = self.bytes / MEGABYTE
+        return (
+            f"{self.entries} entries, {megabytes:.1f} MB, "
+            f"{self.errors} errors, {self.skipped} skipped, "
+            f"{self.entries / elapsed:.1f} entries/s, "
+            f"{megabytes / elapsed:.2f} MB/s"
+        )
+
+
+async def report_every(interval, progress, checkpoint=None, out=sys.stderr):
+    '''Print the progress and save the checkpoint every ``interval``.'''
+
+    while True:
+        await asyncio.sleep(interval)
+        print(progress.report(), file=out)
+        if checkpoint:
+            checkpoint.save()
+
+
+async def copy(storages, entry, progress):
+    '''Write an entry to the MongoDB storage of its kind.'''
+
+    storage = storages.get(entry.kind)
+    if storage is None:
+        raise ValueError(f"{KINDS[entry.kind]} is not a MongoDB storage")
+
+    chunks = counted(entry.chunks(), progress)
+    if entry.kind == 'storage':
+        await storage.put_stream(entry.key, chunks, entry.length)
+        if entry.fields.get('detector_data'):
+            await storage.put_detector_data(
+                entry.key, entry.fields['detector_data']
+            )
+        return
+
+    contents = b''.join([chunk async for chunk in chunks])
+    if storage.variants_enabled:
+        key, variant = storage.variant_of(entry.key)
+        await storage.store_variant(
+            key, variant, contents,
+            entry.fields.get('metadata'), entry.fields.get('content_type')
+        )
+        return
+
+    await storage.store(
+        entry.key, contents,
+        entry.fields.get('metadata'), entry.fields.get('content_type')
+    )
+
+
+async def import_entries(storages, source, checkpoint, jobs, progress,
+                         out=sys.stderr):
+    '''Copy the entries of a source with at most ``jobs`` in flight.
+
+    Failed entries are reported and counted, and do not stop the import.
+    The checkpoint stays before the first of them, so they are retried when
+    the import is resumed.
+    '''
+
+    queue = asyncio.Queue(maxsize=jobs)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            entry, marker = item
+            try:
+                await copy(storages, entry, progress)
+                progress.entries += 1
+                checkpoint.done(marker)
+            except Exception as exc:
+                progress.errors += 1
+                print(f"{entry.kind} {entry.key}: {exc!r}", file=out)
+                checkpoint.done(marker, copied=False)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(jobs)]
+    try:
+        async for entry in source.entries(checkpoint.position):
+            if entry.chunks is None:
+                progress.skip(entry, out)
+                continue
+            await queue.put((entry, checkpoint.start(entry.position)))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+async def export_entries(sources, fileobj, jobs, progress, compression='',
+                         out=sys.stderr):
+    '''Write the entries of sources to a streamed tar archive.
+
+    Up to ``jobs`` entries are downloaded ahead of the one being written,
+    and entries are written in source order.
+    '''
+
+    queue = asyncio.Queue(maxsize=jobs)
+
+    async def fetch(entry):
+        return b''.join([
+            chunk async for chunk in counted(entry.chunks(), progress)
+        ])
+
+    async def produce():
+        for source in sources:
+            async for entry in source.entries():
+                if entry.chunks is None:
+                    progress.skip(entry, out)
+                    continue
+                await queue.put(
+                    (entry, asyncio.ensure_future(fetch(entry)))
+                )
+        await queue.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    with tarfile.open(
+        fileobj=fileobj, mode=f"w|{compression}", format=tarfile.PAX_FORMAT
+    ) as archive:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            entry, download = item
+            try:
+                contents = await download
+            except Exception as exc:
+                progress.errors += 1
+                print(f"{entry.kind} {entry.key}: {exc!r}", file=out)
+                continue
+            archive.addfile(
+                archive_member(entry, len(contents)), io.BytesIO(contents)
+            )
+            progress.entries += 1
+    await producer
+
+
+def build_context(options):
+    '''Return a thumbor context for the configuration of the command.
+
+    Errors are raised instead of being ignored, so they are reported.
+    '''
+
+    config = Config.load(options.conf)
+    config.MONGODB_STORAGE_IGNORE_ERRORS = False
+    config.MONGODB_RESULT_STORAGE_IGNORE_ERRORS = False
+
+    server = ServerParameters(
+        None, None, options.conf, None, 'info', None
+    )
+    server.security_key = config.SECURITY_KEY
+    return Context(server=server, config=config)
+
+
+def enabled_storages(context):
+    '''Return the enabled MongoDB storages by entry kind.
+    :rtype: dict
+    '''
+
+    storages = {}
+    for kind, option in KINDS.items():
+        module_name = STORAGES[option]
+        if context.config.get(option) == module_name:
+            storages[kind] = import_module(module_name).Storage(context)
+    return storages
+
+
+def import_source(options):
+    if options.file_storage:
+        if not options.paths:
+            raise ValueError('--file-storage requires --paths')
+        return FileStorageSource(options.file_storage, options.paths)
+    if options.file_result_storage:
+        return FileResultStorageSource(
+            options.file_result_storage, options.paths
+        )
+    if options.archive:
+        return ArchiveSource(options.archive)
+
+    client_class, bucket_class = get_driver(options.from_driver)
+    database = client_class(options.from_uri)[options.from_db]
+    return MongoSource(
+        f"mongodb:{options.from_db}.{options.from_collection}",
+        database[options.from_collection],
+        bucket_class(database),
+    )
+
+
+def export_sources(storages):
+    '''Return one source per collection of the enabled storages.
+
+    Storages sharing a collection, which is the default, share a source.
+    '''
+
+    sources = {}
+    for kind, storage in storages.items():
+        for cluster, connector in storage.router.connectors.items():
+            name = f"{cluster}/{connector.db_name}.{connector.col_name}"
+            if name not in sources:
+                sources[name] = MongoSource(
+                    name, connector.col_conn, connector.fs
+                )
+    return list(sources.values())
+
+
+async def run(options, out=sys.stderr):
+    context = build_context(options)
+    storages = enabled_storages(context)
+    if not storages:
+        print("No MongoDB storage is enabled in this configuration", file=out)
+        return 2
+
+    progress = Progress()
+    if options.command == 'import':
+        source = import_source(options)
+        checkpoint = Checkpoint(options.checkpoint, source.name)
+        task = report_every(options.interval, progress, checkpoint, out)
+    else:
+        checkpoint = None
+        task = report_every(options.interval, progress, out=out)
+
+    reporter = asyncio.ensure_future(task)
+    try:
+        if options.command == 'import':
+            await import_entries(
+                storages, source, checkpoint, options.jobs, progress, out
+            )
+        elif options.output == '-':
+            await export_entries(
+                export_sources(storages), sys.stdout.buffer, options.jobs,
+                progress, 'gz' if options.gzip else '', out
+            )
+        else:
+            with open(options.output, 'wb') as archive_file:
+                await export_entries(
+                    export_sources(storages), archive_file, options.jobs,
+                    progress, 'gz' if options.gzip else '', out
+                )
+    finally:
+        reporter.cancel()
+        if checkpoint:
+            checkpoint.save()
+        print(progress.report(), file=out)
+    return 1 if progress.errors else 0
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-c', '--conf', required=True, help='thumbor configuration file'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=8,
+        help='entries copied concurrently'
+    )
+    parser.add_argument(
+        '-i', '--interval', type=float, default=5,
+        help='seconds between progress reports'
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    importer = commands.add_parser(
+        'import', help='import into the enabled MongoDB storages'
+    )
+    sources = importer.add_mutually_exclusive_group(required=True)
+    sources.add_argument(
+        '--file-storage', help='root path of a thumbor file storage'
+    )
+    sources.add_argument(
+        '--file-result-storage',
+        help='root path of a thumbor file result storage'
+    )
+    sources.add_argument('--from-uri', help='URI of a MongoDB source')
+    sources.add_argument('--archive', help='archive written by export')
+    importer.add_argument(
+        '--paths',
+        help='file listing the paths (file storage) or urls (file result '
+             'storage) to import, one per line'
+    )
+    importer.add_argument('--from-db', default='thumbor')
+    importer.add_argument('--from-collection', default='images')
+    importer.add_argument(
+        '--from-driver', default=None, help="'tornado' or 'asyncio'"
+    )
+    importer.add_argument(
+        '--checkpoint', help='file where the import position is saved'
+    )
+
+    exporter = commands.add_parser(
+        'export', help='export the enabled MongoDB storages to a tar archive'
+    )
+    exporter.add_argument(
+        '-o', '--output', default='-', help="archive path, '-' for stdout"
+    )
+    exporter.add_argument(
+        '-z', '--gzip', action='store_true', help='compress the archive'
+    )
+
+    options = parser.parse_args(args)
+    try:
+        sys.exit(asyncio.run(run(options)))
+    except ValueError as exc:
+        parser.error(str(exc))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+
 
 class OnException(object):  # NOQA
 
@@ -32,3 +34,49 @@ class OnException(object):  # NOQA
                     raise
 
         return wrapper
+
+
+AUTO_CHUNK_SIZE_LIMIT = 1024 * 1024
+
+
+def get_chunk_size(length, chunk_size=None, size_classes=None):
+    '''Return the GridFS chunk size to use for a file of the given length.
+
+    ``size_classes`` is a list of ``(max_length, chunk_size)`` pairs checked
+    in order, where a ``max_length`` of None matches any length. Otherwise
+    ``chunk_size`` is either a fixed size, None for the GridFS default, or
+    ``'auto'`` to store files up to AUTO_CHUNK_SIZE_LIMIT in a single chunk
+    and split bigger ones in the fewest chunks of even size.
+
+    :param int length: File length in bytes
+    :param chunk_size: Fixed chunk size, 'auto' or None
+    :param list size_classes: Chunk size per size class
+    :returns: Chunk size in bytes, or None for the bucket default
+    :rtype: int
+    '''
+
+    if size_classes:
+        for max_length, class_chunk_size in size_classes:
+            if max_length is None or length <= max_length:
+                return class_chunk_size
+        return None
+
+    if chunk_size != 'auto':
+        return chunk_size
+
+    chunks = max(1, -(-length // AUTO_CHUNK_SIZE_LIMIT))
+    return max(1, -(-length // chunks))
+
+
+def key_hash(value):
+    '''Return a truncated digest of a path or key, as a signed 64-bit int.
+
+    The digest spreads keys sharing long prefixes evenly, so it can be used
+    as a shard key, and fits a BSON int64 to keep index entries small.
+
+    :param string value: Path or key
+    :rtype: int
+    '''
+
+    digest = hashlib.blake2b(value.encode('utf-8'), digest_size=8)
+    return int.from_bytes(digest.digest(), 'big', signed=True)